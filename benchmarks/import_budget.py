@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Import time budget of the package, for CI: `import widefield_plate_solver` must stay fast, and must not pull in the
+heavy dependencies, which are only imported by the parts that use them (e.g. no astroquery nor matplotlib for a
+local solve).
+
+    python benchmarks/import_budget.py --budget 0.1
+
+Exits with status 1 if over budget or if a module is imported where it should not be.
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+package_dir = Path(__file__).resolve().parent.parent
+
+# statement run in a fresh interpreter, and the modules it must not import.
+import_checks = {
+    'import widefield_plate_solver':
+        ['numpy', 'scipy', 'astropy', 'sep', 'matplotlib', 'astroquery', 'requests'],
+    'from widefield_plate_solver import plate_solve, extract_stars, plate_solve_locally, plate_solve_many':
+        ['matplotlib', 'astroquery', 'requests'],
+    'from widefield_plate_solver import solve_with_strategy, SolutionIndex, SourceCache':
+        ['matplotlib', 'astroquery'],
+}
+
+
+def _run(statement):
+    """
+    Seconds taken by the statement in a fresh interpreter, and the top-level modules imported then.
+    """
+    code = (f"import sys, time; t0 = time.perf_counter(); {statement}; t = time.perf_counter() - t0; "
+            f"import json; print(json.dumps([t, sorted({{m.split('.')[0] for m in sys.modules}})]))")
+    output = subprocess.run([sys.executable, '-c', code], cwd=package_dir, capture_output=True, text=True,
+                            check=True).stdout
+    elapsed, modules = json.loads(output.splitlines()[-1])
+    return elapsed, set(modules)
+
+
+def measure(statement='import widefield_plate_solver', repeats=5):
+    """
+    Best time of the statement over a few fresh interpreters (the others being disturbed by the disk cache, etc.)
+
+    Returns:
+    seconds, set of the top-level modules imported.
+    """
+    runs = [_run(statement) for _ in range(repeats)]
+    return min(elapsed for elapsed, _ in runs), runs[0][1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time budget of widefield_plate_solver.")
+    parser.add_argument("--budget", type=float, default=0.1,
+                        help="Seconds allowed for `import widefield_plate_solver`, default 0.1.")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    failures = []
+    for statement, forbidden in import_checks.items():
+        elapsed, modules = measure(statement, args.repeats)
+        unexpected = sorted(set(forbidden) & modules)
+        print(f"{elapsed:7.3f} s  {statement}" + (f"  imports {', '.join(unexpected)}" if unexpected else ''))
+        if unexpected:
+            failures.append(f"`{statement}` imports {', '.join(unexpected)}")
+        if statement == 'import widefield_plate_solver' and elapsed > args.budget:
+            failures.append(f"`{statement}` takes {elapsed:.3f} s, over the budget of {args.budget} s")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
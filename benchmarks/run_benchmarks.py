@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the extraction and of the solve, on synthetic frames, without index files nor network.
+
+Frames of several sizes, star densities and noise levels are generated (see synthetic.py) and cached in the work
+directory. solve-field is replaced by stub_solve_field/solve-field, returning the WCS the frame was made with, so
+that the solves measure our own overhead (reading, extraction, xylist, subprocess, WCS write), not astrometry.net.
+
+Measured:
+- extraction: median time of extract_stars, its peak memory (numpy and python allocations, traced with
+  tracemalloc), the number of sources and the fraction of the 50 brightest stars found,
+- plate_solve: median end-to-end latency on one frame of each size,
+- plate_solve_many: throughput on a batch of frames, in frames per second,
+- the time of `import widefield_plate_solver` in a fresh interpreter (see also import_budget.py).
+
+Each run is appended to a JSON lines history (benchmarks/results/history.jsonl by default), with the commit and
+the machine, and compared with the previous run of the same machine and mode:
+
+    python benchmarks/run_benchmarks.py --quick
+    python benchmarks/run_benchmarks.py --quick --max_regression 0.25  # exit status 1 if 25% slower, for CI
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+import import_budget
+from synthetic import make_star_field, recall
+
+benchmarks_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(benchmarks_dir.parent))
+
+from widefield_plate_solver import extract_stars, plate_solve, plate_solve_many  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+sizes = {'small': (1024, 1536), 'medium': (2048, 3072), 'large': (4096, 6144)}
+# stars per million pixels
+densities = {'sparse': 100, 'dense': 1500}
+noises = {'low': 5., 'high': 30.}
+
+# metrics where more is better, the others being times and memory.
+higher_is_better = ('frames_per_s', 'recall')
+
+
+def scenario_frame(work_dir, size, density, noise):
+    """
+    The frame of this scenario, generated on first use. Returns its path and the true star list.
+    """
+    shape = sizes[size]
+    n_stars = int(densities[density] * shape[0] * shape[1] / 1e6)
+    fits_file_path = Path(work_dir) / f"{size}_{density}_{noise}.fits"
+    truth_path = fits_file_path.with_suffix('.npz')
+    if fits_file_path.exists() and truth_path.exists():
+        return fits_file_path, dict(np.load(truth_path))
+    logger.info(f"generating {fits_file_path.name}")
+    truth, _ = make_star_field(fits_file_path, shape=shape, n_stars=n_stars, noise=noises[noise],
+                               stub_wcs_dir=Path(work_dir) / 'stub_wcs')
+    np.savez(truth_path, **truth)
+    return fits_file_path, truth
+
+
+def bench_extraction(fits_file_path, truth, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        sources = extract_stars(fits_file_path)
+        times.append(time.perf_counter() - t0)
+    # separately, tracing slows things down.
+    tracemalloc.start()
+    extract_stars(fits_file_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'extract_s': statistics.median(times), 'extract_peak_mb': peak / 1024**2,
+            'n_sources': len(sources), 'recall': recall(sources, truth)}
+
+
+def bench_plate_solve(fits_file_path, repeats):
+    # a first solve writes the WCS to the header (which may grow the file), not representative.
+    plate_solve(fits_file_path, use_api=False, redo_if_done=True, use_existing_wcs_as_guess=False)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        plate_solve(fits_file_path, use_api=False, redo_if_done=True, use_existing_wcs_as_guess=False)
+        times.append(time.perf_counter() - t0)
+    return {'plate_solve_s': statistics.median(times)}
+
+
+def bench_batch(fits_file_path, n_frames, work_dir):
+    batch_dir = Path(work_dir) / 'batch'
+    batch_dir.mkdir(exist_ok=True)
+    data = Path(fits_file_path).read_bytes()
+    paths = []
+    for i in range(n_frames):
+        path = batch_dir / f"frame_{i:03d}.fits"
+        path.write_bytes(data)
+        paths.append(path)
+    t0 = time.perf_counter()
+    results = plate_solve_many(paths, redo_if_done=True, use_api=False, use_existing_wcs_as_guess=False)
+    elapsed = time.perf_counter() - t0
+    n_failed = sum(result.error is not None for result in results)
+    if n_failed:
+        logger.warning(f"batch: {n_failed} of {n_frames} frames failed")
+    return {'batch_s': elapsed, 'frames_per_s': n_frames / elapsed}
+
+
+def run(work_dir, quick):
+    """
+    Run all the benchmarks. Returns {benchmark name: {metric: value}}.
+    """
+    repeats = 3 if quick else 5
+    results = {'import': {'import_s': import_budget.measure()[0]}}
+    run_sizes = ['small', 'medium'] if quick else list(sizes)
+    for size in run_sizes:
+        for density in densities:
+            for noise in noises:
+                fits_file_path, truth = scenario_frame(work_dir, size, density, noise)
+                name = f"extract/{size}/{density}/{noise}"
+                results[name] = bench_extraction(fits_file_path, truth, repeats)
+                logger.info(f"{name}: {results[name]}")
+
+    for size in run_sizes:
+        fits_file_path, _ = scenario_frame(work_dir, size, 'sparse', 'low')
+        name = f"plate_solve/{size}"
+        results[name] = bench_plate_solve(fits_file_path, repeats)
+        logger.info(f"{name}: {results[name]}")
+
+    fits_file_path, _ = scenario_frame(work_dir, 'small', 'sparse', 'low')
+    n_frames = 8 if quick else 32
+    name = f"batch/small/{n_frames}"
+    results[name] = bench_batch(fits_file_path, n_frames, work_dir)
+    logger.info(f"{name}: {results[name]}")
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchmarks_dir, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'machine': platform.node(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def load_history(history_path):
+    if not history_path.exists():
+        return []
+    with open(history_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(previous, current):
+    """
+    Relative change of each metric, positive when worse. Returns {(benchmark, metric): change}.
+    """
+    changes = {}
+    for name, metrics in current.items():
+        for metric, value in metrics.items():
+            if metric == 'n_sources':
+                continue
+            before = previous.get(name, {}).get(metric)
+            if not before:
+                continue
+            change = (value - before) / before
+            changes[(name, metric)] = -change if metric in higher_is_better else change
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of widefield_plate_solver on synthetic frames.")
+    parser.add_argument("--quick", action="store_true", help="Skip the largest frames, fewer repeats (for CI).")
+    parser.add_argument("--work_dir", help="Where to cache the synthetic frames. Default: a temporary directory.")
+    parser.add_argument("--history", default=benchmarks_dir / 'results' / 'history.jsonl', type=Path,
+                        help="JSON lines file the results are appended to and compared with.")
+    parser.add_argument("--no_record", action="store_true", help="Compare with the history but do not append.")
+    parser.add_argument("--max_regression", type=float,
+                        help="Exit with status 1 if a metric got worse than this fraction (e.g. 0.25) "
+                             "compared with the previous run on the same machine.")
+    parser.add_argument("--solve_time", type=float, default=0.,
+                        help="Seconds the stub solve-field takes, to stand for a real solve.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # the progress of the benchmarks, not the logs of each solve.
+    logging.getLogger('widefield_plate_solver').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        work_dir = Path(args.work_dir or tmpdirname)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        # the stub solve-field first in the PATH, and where it finds the solutions.
+        os.environ['PATH'] = f"{benchmarks_dir / 'stub_solve_field'}{os.pathsep}{os.environ['PATH']}"
+        os.environ['WPS_STUB_WCS_DIR'] = str(work_dir / 'stub_wcs')
+        os.environ['WPS_STUB_SOLVE_TIME'] = str(args.solve_time)
+        record = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'quick': args.quick, **environment(),
+                  'results': run(work_dir, args.quick)}
+
+    history = load_history(args.history)
+    previous = [r for r in history if r['machine'] == record['machine'] and r['quick'] == record['quick']]
+    regressions = []
+    print(f"{'benchmark':32s} {'metric':16s} {'value':>12s} {'previous':>12s} {'change':>8s}")
+    changes = compare(previous[-1]['results'], record['results']) if previous else {}
+    for name, metrics in record['results'].items():
+        for metric, value in metrics.items():
+            line = f"{name:32s} {metric:16s} {value:12.4g}"
+            if (name, metric) in changes:
+                change = changes[(name, metric)]
+                line += f" {previous[-1]['results'][name][metric]:12.4g} {100 * change:+7.1f}%"
+                if args.max_regression is not None and change > args.max_regression:
+                    regressions.append((name, metric, change))
+                    line += '  REGRESSION'
+            print(line)
+
+    if not args.no_record:
+        args.history.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    if regressions:
+        print(f"{len(regressions)} metrics regressed by more than {100 * args.max_regression:.0f}% "
+              f"(compared with {previous[-1]['commit']} of {previous[-1]['timestamp']}).")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
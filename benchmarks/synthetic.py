@@ -0,0 +1,120 @@
+"""
+Synthetic wide-field frames with a known WCS, for the benchmarks.
+
+Stars are drawn at random pixel positions with a power law of fluxes, as gaussian PSFs on a flat sky with
+gaussian noise, and saved as uint16 like a camera would. The WCS the frame was made with is known, and saved
+where the stub solve-field (see stub_solve_field/solve-field) finds it, so that a solve returns it.
+"""
+import logging
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+logger = logging.getLogger(__name__)
+
+
+def make_wcs(shape, ra=150., dec=30., pixel_scale=20., rotation=0.):
+    """
+    A TAN WCS centered on the frame.
+
+    Parameters:
+    shape (tuple of int): (height, width) of the frame in pixels.
+    ra (float): RA of the center in degrees.
+    dec (float): DEC of the center in degrees.
+    pixel_scale (float): arcsec/pixel.
+    rotation (float): position angle in degrees.
+
+    Returns:
+    astropy.wcs.WCS
+    """
+    height, width = shape
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [(width + 1) / 2, (height + 1) / 2]
+    scale = pixel_scale / 3600.
+    c, s = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+    wcs.wcs.cd = [[-scale * c, scale * s], [scale * s, scale * c]]
+    return wcs
+
+
+def make_star_field(fits_file_path, shape=(2048, 3072), n_stars=1000, noise=10., sky=1000., fwhm=3.,
+                    seed=0, wcs=None, stub_wcs_dir=None, stars=None):
+    """
+    Write a synthetic frame.
+
+    Parameters:
+    fits_file_path (Path or str): where to write the frame.
+    shape (tuple of int): (height, width) in pixels.
+    n_stars (int): number of stars in the frame.
+    noise (float): standard deviation of the sky noise, in ADU.
+    sky (float): sky level in ADU.
+    fwhm (float): full width at half maximum of the stars, in pixels.
+    seed (int): seed of the random generator, the same seed gives the same frame.
+    wcs (astropy.wcs.WCS): WCS of the frame. If None, make_wcs(shape).
+    stub_wcs_dir (Path or str): if provided, also save the WCS there for the stub solve-field.
+    stars (tuple of numpy arrays): x, y (zero-based pixels) and flux of the first stars, the others are random.
+
+    Returns:
+    dict of the true star positions and fluxes ('x', 'y' in zero-based pixels, 'flux'), and the WCS.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    if wcs is None:
+        wcs = make_wcs(shape)
+
+    x = rng.uniform(0, width - 1, n_stars)
+    y = rng.uniform(0, height - 1, n_stars)
+    # more faint stars than bright ones, over 2.5 decades of flux.
+    flux = 10 ** (2.5 + 2.5 * rng.power(0.6, n_stars))
+    if stars is not None:
+        n_given = len(stars[0])
+        x[:n_given], y[:n_given], flux[:n_given] = stars
+
+    image = rng.normal(sky, noise, shape).astype(np.float32)
+    sigma = fwhm / 2.355
+    half_size = int(np.ceil(4 * sigma))
+    offsets = np.arange(-half_size, half_size + 1)
+    for xi, yi, fi in zip(x, y, flux):
+        x0, y0 = int(round(xi)), int(round(yi))
+        xs, ys = x0 + offsets, y0 + offsets
+        xs, ys = xs[(xs >= 0) & (xs < width)], ys[(ys >= 0) & (ys < height)]
+        stamp = np.exp(-(ys[:, None] - yi) ** 2 / (2 * sigma ** 2) - (xs[None, :] - xi) ** 2 / (2 * sigma ** 2))
+        image[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1] += fi / (2 * np.pi * sigma ** 2) * stamp
+
+    data = np.clip(image, 0, 65535).astype(np.uint16)
+    fits.PrimaryHDU(data).writeto(fits_file_path, overwrite=True)
+
+    if stub_wcs_dir is not None:
+        write_stub_wcs(stub_wcs_dir, shape, wcs)
+    return {'x': x, 'y': y, 'flux': flux}, wcs
+
+
+def stub_wcs_path(stub_wcs_dir, shape):
+    """
+    Where the stub solve-field looks for the solution of a frame of this shape: <dir>/<width>x<height>.wcs
+    """
+    height, width = shape
+    return Path(stub_wcs_dir) / f"{width}x{height}.wcs"
+
+
+def write_stub_wcs(stub_wcs_dir, shape, wcs):
+    stub_wcs_dir = Path(stub_wcs_dir)
+    stub_wcs_dir.mkdir(parents=True, exist_ok=True)
+    fits.PrimaryHDU(header=wcs.to_header()).writeto(stub_wcs_path(stub_wcs_dir, shape), overwrite=True)
+
+
+def recall(sources, truth, n_brightest=50, tolerance=1.5):
+    """
+    Fraction of the n brightest true stars found among the sources, within tolerance pixels.
+    """
+    from scipy.spatial import cKDTree
+
+    brightest = np.argsort(truth['flux'])[::-1][:n_brightest]
+    if len(sources) == 0:
+        return 0.
+    tree = cKDTree(np.column_stack([np.asarray(sources['xcentroid']), np.asarray(sources['ycentroid'])]))
+    distances, _ = tree.query(np.column_stack([truth['x'][brightest], truth['y'][brightest]]))
+    return float(np.mean(distances < tolerance))
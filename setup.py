@@ -24,4 +24,8 @@ setup(
         'astroquery',
         'requests'
     ],
+    extras_require={
+        # the default engine of SolverEngine.
+        'engine': ['astrometry'],
+    },
 )
@@ -0,0 +1,42 @@
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+repo_dir = Path(__file__).resolve().parent.parent
+# the package without installing it, and the synthetic frames of the benchmarks.
+sys.path[:0] = [str(repo_dir), str(repo_dir / 'benchmarks')]
+
+# command of an engine for SolverEngine, see stub_engine.py.
+stub_engine = [sys.executable, str(Path(__file__).resolve().parent / 'stub_engine.py')]
+
+
+@pytest.fixture
+def stub_solve_field(tmp_path, monkeypatch):
+    """
+    The stub solve-field of the benchmarks first in PATH, answering with the WCS saved in the returned directory
+    (see synthetic.write_stub_wcs).
+    """
+    stub_wcs_dir = tmp_path / 'stub_wcs'
+    stub_wcs_dir.mkdir()
+    monkeypatch.setenv('PATH', f"{repo_dir / 'benchmarks' / 'stub_solve_field'}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('WPS_STUB_WCS_DIR', str(stub_wcs_dir))
+    return stub_wcs_dir
+
+
+@pytest.fixture
+def solve_field_runs(tmp_path, monkeypatch, stub_solve_field):
+    """
+    The runs of the stub solve-field so far, as a function returning a list of {'pid': ..., 'argv': [...]}.
+    """
+    log_path = tmp_path / 'solve_field_runs.jsonl'
+    monkeypatch.setenv('WPS_STUB_ARGV_LOG', str(log_path))
+
+    def runs():
+        if not log_path.exists():
+            return []
+        with open(log_path) as f:
+            return [json.loads(line) for line in f]
+    return runs
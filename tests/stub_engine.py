@@ -0,0 +1,33 @@
+"""
+A SolverEngine engine for the tests: answers every xylist with a TAN solution centered on (150, 30) at 20"/pixel,
+dies on the xylists named crash*, and never answers those named hang*.
+With WPS_STUB_ENGINE_REQUESTS set, appends each request there (a JSON line), with WPS_STUB_ENGINE_SOLVE_TIME set,
+takes that many seconds per solve.
+"""
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from astropy.io import fits
+
+print('loading the index files...', flush=True)
+print(json.dumps({'ready': True}), flush=True)
+for line in sys.stdin:
+    request = json.loads(line)
+    if 'WPS_STUB_ENGINE_REQUESTS' in os.environ:
+        with open(os.environ['WPS_STUB_ENGINE_REQUESTS'], 'a') as f:
+            f.write(line)
+    time.sleep(float(os.environ.get('WPS_STUB_ENGINE_SOLVE_TIME', 0)))
+    name = Path(request['xylist']).name
+    if name.startswith('crash'):
+        os._exit(1)
+    if name.startswith('hang'):
+        time.sleep(60)
+    header = fits.Header({'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN',
+                          'CRPIX1': (request['width'] + 1) / 2, 'CRPIX2': (request['height'] + 1) / 2,
+                          'CRVAL1': 150., 'CRVAL2': 30., 'CD1_1': -20 / 3600, 'CD1_2': 0.,
+                          'CD2_1': 0., 'CD2_2': 20 / 3600})
+    fits.PrimaryHDU(header=header).writeto(request['wcs'], overwrite=True)
+    print(json.dumps({'id': request['id'], 'solved': True, 'error': None}), flush=True)
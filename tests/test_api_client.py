@@ -0,0 +1,156 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+
+from synthetic import make_star_field, make_wcs
+from widefield_plate_solver import AstrometryNetClient, SolveMetrics
+
+shape = (256, 384)
+# status requests of a job until it succeeds.
+n_polls_to_solve = 6
+
+
+class StandIn:
+    """
+    The state of a stand-in of the nova.astrometry.net API: a job per submission, solved after a few polls.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.logins = 0
+        self.submissions = []
+        self.active = 0
+        self.max_active = 0
+        self.polls = {}
+        self.wcs = make_wcs(shape).to_header().tostring()
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, content, text=False):
+        body = (content if text else json.dumps(content)).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        state = self.server.state
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        request = json.loads(parse_qs(body)['request-json'][0])
+        with state.lock:
+            if self.path == '/api/login':
+                state.logins += 1
+                return self.reply({'status': 'success', 'session': 'session-id'})
+            assert self.path == '/api/url_upload' and request['session'] == 'session-id'
+            state.submissions.append(request)
+            state.active += 1
+            state.max_active = max(state.max_active, state.active)
+            subid = len(state.submissions)
+            state.polls[subid] = []
+        self.reply({'status': 'success', 'subid': subid})
+
+    def do_GET(self):
+        state = self.server.state
+        kind, identifier = self.path.strip('/').rsplit('/', 1)
+        identifier = int(identifier)
+        with state.lock:
+            if kind == 'api/submissions':
+                return self.reply({'jobs': [identifier]})
+            if kind == 'api/jobs':
+                state.polls[identifier].append(time.perf_counter())
+                solved = len(state.polls[identifier]) >= n_polls_to_solve
+                return self.reply({'status': 'success' if solved else 'solving'})
+            assert kind == 'wcs_file'
+            state.active -= 1
+        self.reply(state.wcs, text=True)
+
+
+@pytest.fixture
+def stand_in():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.state = StandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_frames(directory, n_frames):
+    frames = []
+    for seed in range(n_frames):
+        frame = directory / f'frame_{seed}.fits'
+        truth, _ = make_star_field(frame, shape=shape, n_stars=40, seed=seed)
+        frames.append((frame, truth))
+    return frames
+
+
+def sources_of(truth):
+    # like photutils' finders.
+    return Table({'xcentroid': truth['x'], 'ycentroid': truth['y'], 'flux': truth['flux']})
+
+
+def client_of(server, **kwargs):
+    return AstrometryNetClient(api_key='key', base_url=f"http://127.0.0.1:{server.server_port}/", **kwargs)
+
+
+def test_solve_many(tmp_path, stand_in):
+    frames = make_frames(tmp_path, 5)
+    client = client_of(stand_in, max_in_flight=2, poll_interval=0.05, max_poll_interval=0.2)
+
+    try:
+        results = asyncio.run(client.solve_many([(frame, sources_of(truth)) for frame, truth in frames],
+                                                use_n_brightest_only=20))
+    finally:
+        client.close()
+
+    state = stand_in.state
+    assert all(result.error is None for result in results)
+    assert state.logins == 1
+    assert len(state.submissions) == 5
+    assert state.max_active == 2
+    for submission in state.submissions:
+        assert len(submission['x']) == 20
+        assert (submission['image_width'], submission['image_height']) == (shape[1], shape[0])
+
+    # the status is asked less and less often, up to max_poll_interval.
+    for polls in state.polls.values():
+        gaps = np.diff(polls)
+        assert len(polls) == n_polls_to_solve
+        # 0.075 s, then 0.1125 s... up to 0.2 s.
+        assert np.all(np.diff(gaps) > -0.02)
+        assert gaps[0] < 0.075 + 0.03 and gaps[-1] > 0.2 - 0.01
+        assert gaps.max() < 0.2 + 0.05
+
+    # each WCS written back to its frame.
+    for frame, _ in frames:
+        header = fits.getheader(frame)
+        assert header['CRVAL1'] == pytest.approx(150.) and header['CRVAL2'] == pytest.approx(30.)
+
+
+def test_blocking_plate_solve_with_hints(tmp_path, stand_in):
+    ((frame, truth),) = make_frames(tmp_path, 1)
+    metrics = SolveMetrics(frame)
+
+    with client_of(stand_in, poll_interval=0.01) as client:
+        wcs = client.plate_solve(frame, sources_of(truth), ra_approx=151., dec_approx=29., search_radius=5.,
+                                 scale_min=18., scale_max=22., metrics=metrics)
+
+    (submission,) = stand_in.state.submissions
+    assert (submission['center_ra'], submission['center_dec'], submission['radius']) == (151., 29., 5.)
+    assert (submission['scale_lower'], submission['scale_upper']) == (18., 22.)
+    assert wcs['CRVAL1'] == pytest.approx(150.)
+    assert fits.getheader(frame)['CRVAL1'] == pytest.approx(150.)
+    assert metrics.counts['api_polls'] == n_polls_to_solve
+    assert {'api_login', 'api_submit', 'api_poll', 'api_wcs_download'} <= set(metrics.stages)
@@ -0,0 +1,33 @@
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+from synthetic import make_star_field
+from widefield_plate_solver import batch, plate_solve_many
+
+extract_worker = batch._extract_worker
+
+
+def dying_extract_worker(fits_file_path, *args):
+    # like a worker killed by the OOM killer.
+    if 'dies' in str(fits_file_path):
+        os._exit(1)
+    return extract_worker(fits_file_path, *args)
+
+
+def test_batch_goes_on_after_an_extraction_process_died(tmp_path, stub_solve_field, monkeypatch):
+    names = ['a', 'b', 'dies', 'c', 'd']
+    for seed, name in enumerate(names):
+        make_star_field(tmp_path / f'{name}.fits', shape=(256, 384), n_stars=60, seed=seed,
+                        stub_wcs_dir=stub_solve_field)
+    # the worker processes are forked, they see the patched function.
+    monkeypatch.setattr(batch, '_extract_worker', dying_extract_worker)
+
+    results = plate_solve_many([tmp_path / f'{name}.fits' for name in names], n_workers=1, max_in_flight=1,
+                               use_api=False)
+
+    assert [result.fits_file_path for result in results] == [str(tmp_path / f'{name}.fits') for name in names]
+    for name, result in zip(names, results):
+        if name == 'dies':
+            assert result.wcs is None and isinstance(result.error, BrokenProcessPool)
+        else:
+            assert result.error is None and result.wcs is not None
@@ -0,0 +1,113 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+from astropy.io import fits
+
+from conftest import repo_dir
+from synthetic import make_star_field
+from widefield_plate_solver import LeaseDirectory, plate_solve, solve_distributed
+from widefield_plate_solver.exceptions import LeaseLostError
+from widefield_plate_solver.fits_io import solved_wcs
+
+# a worker in its own process, writing the frames it solved to the json file given after the frames.
+worker = """
+import json, sys
+sys.path.insert(0, {repo_dir!r})
+from widefield_plate_solver import solve_distributed
+*frames, lease_dir, worker_id, lease_timeout, output = sys.argv[1:]
+results = solve_distributed(frames, lease_dir, worker_id=worker_id, lease_timeout=float(lease_timeout),
+                            heartbeat_interval=0.2, poll_interval=0.2, use_api=False)
+with open(output, 'w') as f:
+    json.dump([[result.fits_file_path, result.error is None] for result in results], f)
+""".format(repo_dir=str(repo_dir))
+
+
+def start_worker(frames, lease_dir, worker_id, lease_timeout, output):
+    # in its own session, to kill its solve-field with it.
+    return subprocess.Popen([sys.executable, '-c', worker, *map(str, frames), str(lease_dir), worker_id,
+                             str(lease_timeout), str(output)], start_new_session=True)
+
+
+def make_frames(directory, n_frames, stub_wcs_dir):
+    frames = [directory / f'frame_{index:02d}.fits' for index in range(n_frames)]
+    for seed, frame in enumerate(frames):
+        make_star_field(frame, shape=(256, 384), n_stars=60, seed=seed, stub_wcs_dir=stub_wcs_dir)
+    return frames
+
+
+def test_concurrent_workers_solve_each_frame_once(tmp_path, stub_solve_field, monkeypatch):
+    monkeypatch.setenv('WPS_STUB_SOLVE_TIME', '0.2')
+    frames = make_frames(tmp_path, 12, stub_solve_field)
+    lease_dir = tmp_path / 'leases'
+
+    workers = [start_worker(frames, lease_dir, f'worker{index}', 30, tmp_path / f'worker{index}.json')
+               for index in range(3)]
+    for process in workers:
+        assert process.wait(timeout=120) == 0
+
+    solved = []
+    for index in range(3):
+        with open(tmp_path / f'worker{index}.json') as f:
+            results = json.load(f)
+        assert all(ok for _, ok in results)
+        solved += [path for path, _ in results]
+    assert sorted(solved) == sorted(map(str, frames))
+    assert all(solved_wcs(frame) is not None for frame in frames)
+    assert not list(lease_dir.glob('*.lease'))
+    assert len(list(lease_dir.glob('*.done'))) == len(frames)
+
+
+def test_frames_of_a_killed_worker_are_taken_over(tmp_path, stub_solve_field, monkeypatch):
+    frames = make_frames(tmp_path, 3, stub_solve_field)
+    lease_dir = tmp_path / 'leases'
+    lease_timeout = 2.
+
+    # a worker stuck in its first solve, then killed.
+    monkeypatch.setenv('WPS_STUB_SOLVE_TIME', '60')
+    dead = start_worker(frames, lease_dir, 'dead', lease_timeout, tmp_path / 'dead.json')
+    deadline = time.time() + 60
+    while not list(lease_dir.glob('*.lease')):
+        assert time.time() < deadline and dead.poll() is None
+        time.sleep(0.1)
+    os.killpg(dead.pid, signal.SIGKILL)
+    dead.wait()
+    with LeaseDirectory(lease_dir, worker_id='observer', lease_timeout=lease_timeout) as observer:
+        (lease,) = observer.leases()
+    assert lease.owner == 'dead'
+
+    monkeypatch.setenv('WPS_STUB_SOLVE_TIME', '0')
+    start = time.time()
+    results = solve_distributed(frames, lease_dir, worker_id='survivor', lease_timeout=lease_timeout,
+                                heartbeat_interval=0.2, poll_interval=0.2, use_api=False)
+
+    assert sorted(result.fits_file_path for result in results) == sorted(map(str, frames))
+    assert all(result.error is None for result in results)
+    assert results[-1].fits_file_path == lease.fits_file_path
+    # taken over once the lease of the dead worker expired, not before.
+    assert time.time() - start > lease_timeout - 1
+    assert all(solved_wcs(frame) is not None for frame in frames)
+
+
+def test_no_write_once_the_lease_is_lost(tmp_path, stub_solve_field):
+    (frame,) = make_frames(tmp_path, 1, stub_solve_field)
+    lease_dir = tmp_path / 'leases'
+    with LeaseDirectory(lease_dir, worker_id='stalled', lease_timeout=1., heartbeat_interval=0.5) as stalled, \
+            LeaseDirectory(lease_dir, worker_id='other', lease_timeout=1.) as other:
+        assert stalled.acquire(frame) == 'acquired'
+        stalled.check(frame)
+        # the stalled worker misses its heartbeats: its lease looks a minute old.
+        (lease_path,) = lease_dir.glob('*.lease')
+        past = time.time() - 60
+        os.utime(lease_path, (past, past))
+        assert other.acquire(frame) == 'acquired'
+
+        header = fits.getheader(frame)
+        with pytest.raises(LeaseLostError, match='other'):
+            plate_solve(frame, use_api=False, before_write=stalled.check)
+        assert fits.getheader(frame) == header
+        assert solved_wcs(frame) is None
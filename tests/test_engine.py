@@ -0,0 +1,84 @@
+import importlib.util
+import json
+import time
+
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+
+from conftest import stub_engine
+from synthetic import make_star_field
+from widefield_plate_solver import SolverEngine, SolverProfile, plate_solve
+from widefield_plate_solver.exceptions import CouldNotSolveError
+
+
+def truth_sources(truth):
+    return Table({'xcentroid': truth['x'], 'ycentroid': truth['y'], 'flux': truth['flux']})
+
+
+def test_lifecycle(tmp_path):
+    fits_file_path = tmp_path / 'frame.fits'
+    make_star_field(fits_file_path, shape=(256, 384), n_stars=60)
+
+    engine = SolverEngine(engine_command=stub_engine)
+    assert not engine.running
+    with pytest.raises(RuntimeError):
+        engine.submit(tmp_path / 'xylist.fits', tmp_path / 'xylist.wcs', 384, 256)
+
+    with engine:
+        assert engine.running
+        process = engine.process
+        plate_solve(fits_file_path, use_api=False, engine=engine)
+
+    assert not engine.running and engine.process is None
+    assert process.returncode == 0
+    assert engine.n_restarts == 0
+    header = fits.getheader(fits_file_path)
+    assert header['CRVAL1'] == pytest.approx(150.) and header['CRPIX1'] == pytest.approx(192.5)
+
+
+@pytest.mark.parametrize('failure', ['crash', 'hang'])
+def test_restart_after_a_crash_or_a_timeout(tmp_path, failure):
+    with SolverEngine(engine_command=stub_engine, job_timeout=2) as engine:
+        process = engine.process
+        failing = engine.submit(tmp_path / f'{failure}.fits', tmp_path / f'{failure}.wcs', 384, 256)
+        following = engine.submit(tmp_path / 'xylist.fits', tmp_path / 'xylist.wcs', 384, 256)
+
+        with pytest.raises(CouldNotSolveError):
+            failing.result(timeout=30)
+        assert following.result(timeout=30)
+        assert engine.n_restarts == 1
+        assert engine.process is not process and process.poll() is not None
+    assert (tmp_path / 'xylist.wcs').exists()
+
+
+def test_hints_and_profile_forwarded_like_plate_solve_locally(tmp_path, monkeypatch):
+    fits_file_path = tmp_path / 'frame.fits'
+    truth, _ = make_star_field(fits_file_path, shape=(256, 384), n_stars=60)
+    requests_path = tmp_path / 'requests.jsonl'
+    monkeypatch.setenv('WPS_STUB_ENGINE_REQUESTS', str(requests_path))
+    monkeypatch.setenv('WPS_STUB_ENGINE_SOLVE_TIME', '3')
+    kwargs = dict(ra_approx=151., dec_approx=29., search_radius=4., scale_min=18., scale_max=22.,
+                  odds_to_solve=1e7, write_to_file=False)
+
+    with SolverEngine(engine_command=stub_engine, job_timeout=60) as engine:
+        wcs = engine.plate_solve(fits_file_path, truth_sources(truth), profile='lean', **kwargs)
+        # the timeout of the profile, not the one of the engine.
+        start = time.monotonic()
+        with pytest.raises(CouldNotSolveError):
+            engine.plate_solve(fits_file_path, truth_sources(truth), profile=SolverProfile('short', timeout=1),
+                               **kwargs)
+        assert time.monotonic() - start < 3
+        assert engine.n_restarts == 1
+
+    assert wcs['CRVAL1'] == pytest.approx(150.)
+    with open(requests_path) as f:
+        request = json.loads(f.readline())
+    assert (request['ra'], request['dec'], request['radius']) == (151., 29., 4.)
+    assert (request['scale_min'], request['scale_max'], request['odds_to_solve']) == (18., 22., 1e7)
+
+
+@pytest.mark.skipif(importlib.util.find_spec('astrometry') is not None, reason='astrometry is installed')
+def test_default_engine_needs_astrometry():
+    with pytest.raises(ImportError, match=r'widefield_plate_solver\[engine\]'):
+        SolverEngine(index_files=['index-4107.fits'])
@@ -0,0 +1,99 @@
+import logging
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+import sep
+from scipy.spatial import cKDTree
+
+from conftest import repo_dir
+from synthetic import make_star_field
+from widefield_plate_solver import SolveMetrics, extract_stars
+
+
+def test_budget_leaves_sep_limits_untouched(tmp_path):
+    fits_file_path = tmp_path / 'crowded.fits'
+    make_star_field(fits_file_path, shape=(1024, 1024), n_stars=20000, seed=0)
+    limits = sep.get_extract_pixstack(), sep.get_sub_object_limit()
+
+    sources = extract_stars(fits_file_path, n_brightest=50)
+
+    assert len(sources) == 50
+    assert (sep.get_extract_pixstack(), sep.get_sub_object_limit()) == limits
+
+
+def test_tiled_budget_is_the_brightest_of_the_whole_frame(tmp_path):
+    fits_file_path = tmp_path / 'frame.fits'
+    make_star_field(fits_file_path, shape=(1024, 1536), n_stars=600, seed=1)
+
+    everything = extract_stars(fits_file_path, tile_size=256, n_threads=4)
+    brightest = extract_stars(fits_file_path, tile_size=256, n_threads=4, n_brightest=40)
+
+    assert np.array_equal(brightest['flux'], everything['flux'][:40])
+
+
+
+def test_retries_are_logged(tmp_path, monkeypatch, caplog):
+    fits_file_path = tmp_path / 'frame.fits'
+    make_star_field(fits_file_path, shape=(256, 384), n_stars=60, seed=0)
+    extract = sep.extract
+    thresholds = []
+
+    def overflowing(image, thresh, **kwargs):
+        thresholds.append(thresh)
+        if len(thresholds) <= 2:
+            raise Exception('internal pixel buffer full')
+        return extract(image, thresh, **kwargs)
+
+    monkeypatch.setattr(sep, 'extract', overflowing)
+    metrics = SolveMetrics(fits_file_path)
+
+    with caplog.at_level(logging.WARNING, logger='widefield_plate_solver.extract_stars'):
+        sources = extract_stars(fits_file_path, metrics=metrics)
+
+    assert len(sources) > 0
+    assert np.diff(thresholds) == pytest.approx([1., 1.])
+    assert metrics.counts['extraction_retries'] == 2
+    assert caplog.text.count('Attempting again with stricter limits') == 2
+    assert caplog.records[0].name == 'widefield_plate_solver.extract_stars'
+
+
+def test_tiles_give_the_catalog_of_the_whole_frame(tmp_path):
+    fits_file_path = tmp_path / 'frame.fits'
+    rng = np.random.default_rng(3)
+    # bright stars on the boundaries of the 256 pixel tiles, within a pixel or two of them, and on their corners.
+    on_columns = np.column_stack((np.tile([256, 512, 768], 8) + rng.uniform(-2, 2, 24), rng.uniform(20, 740, 24)))
+    on_rows = np.column_stack((rng.uniform(20, 1000, 16), np.tile([256, 512], 8) + rng.uniform(-2, 2, 16)))
+    on_corners = np.array([[256, 256], [512, 256], [768, 256], [256, 512], [512, 512], [768, 512]], dtype=float)
+    boundary = np.vstack((on_columns, on_rows, on_corners))
+    make_star_field(fits_file_path, shape=(768, 1024), n_stars=300, seed=3,
+                    stars=(boundary[:, 0], boundary[:, 1], np.full(len(boundary), 1e4)))
+
+    whole = extract_stars(fits_file_path)
+    tiled = extract_stars(fits_file_path, tile_size=256, tile_overlap=64, n_threads=4)
+
+    assert len(tiled) == len(whole)
+    distances, nearest = cKDTree(np.column_stack((whole['x'], whole['y']))).query(
+        np.column_stack((tiled['x'], tiled['y'])))
+    # one to one: no source lost or found twice in the overlaps.
+    assert len(set(nearest)) == len(tiled)
+    # the background of each tile is that of the whole frame, up to the edges of its mesh.
+    assert distances.max() < 0.05
+    np.testing.assert_allclose(tiled['flux'], whole['flux'][nearest], rtol=0.01)
+    # most of the stars on the boundaries are there (the others cleaned away, like elsewhere in the frame), moved
+    # by half a pixel by the median filter.
+    distances, _ = cKDTree(np.column_stack((tiled['x'], tiled['y']))).query(boundary)
+    assert np.count_nonzero(distances < 1.5) > 0.75 * len(boundary)
+
+
+def test_the_package_keeps_the_function():
+    # in a fresh interpreter: the order in which the module and the function are first imported matters.
+    code = """
+import widefield_plate_solver
+import widefield_plate_solver.batch
+from widefield_plate_solver.extract_stars import extract_stars, ExtractionBuffers
+assert widefield_plate_solver.extract_stars is extract_stars
+assert widefield_plate_solver.ExtractionBuffers is ExtractionBuffers
+"""
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=repo_dir)
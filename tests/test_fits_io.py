@@ -0,0 +1,84 @@
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from synthetic import make_star_field, make_wcs
+from widefield_plate_solver.fits_io import solved_wcs, wcs_sidecar_path, write_wcs_to_fits, _read_primary_header_bytes
+
+shape = (64, 96)
+
+
+def make_frame(path, n_history=0):
+    make_star_field(path, shape=shape, n_stars=10, seed=0)
+    if n_history:
+        # fill the header up to its last blank cards.
+        with fits.open(path, mode='update') as hdul:
+            for i in range(n_history):
+                hdul[0].header.add_history(f'step {i}')
+    return path
+
+
+def split(path):
+    """
+    The primary header and what follows it (the data, the extensions), as bytes.
+    """
+    with open(path, 'rb') as f:
+        header = _read_primary_header_bytes(f)
+        return header, f.read()
+
+
+def check_solution(header):
+    assert header['PL-SLVED'] == 'done'
+    assert WCS(header, naxis=2).wcs.crval == pytest.approx([150., 30.])
+
+
+@pytest.mark.parametrize('mode', ['update', 'in_place', 'atomic'])
+def test_header_modes_keep_the_data(tmp_path, mode):
+    frame = make_frame(tmp_path / 'frame.fits')
+    header_before, data_before = split(frame)
+
+    write_wcs_to_fits(frame, make_wcs(shape).to_header(), mode=mode)
+
+    header_after, data_after = split(frame)
+    assert data_after == data_before
+    if mode == 'in_place':
+        assert len(header_after) == len(header_before)
+    with fits.open(frame) as hdul:
+        hdul.verify('exception')
+        check_solution(hdul[0].header)
+        assert hdul[0].data.shape == shape
+    check_solution(solved_wcs(frame))
+    assert not wcs_sidecar_path(frame).exists()
+    # no temporary file left behind.
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['frame.fits']
+
+
+def test_sidecar_leaves_the_file_untouched(tmp_path):
+    frame = make_frame(tmp_path / 'frame.fits')
+    before = frame.read_bytes()
+
+    write_wcs_to_fits(frame, make_wcs(shape).to_header(), mode='sidecar')
+
+    assert frame.read_bytes() == before
+    check_solution(fits.getheader(wcs_sidecar_path(frame)))
+    check_solution(solved_wcs(frame))
+
+
+def test_in_place_falls_back_to_the_sidecar_when_the_header_is_full(tmp_path):
+    # 8 cards + 26 HISTORY + END: a single block, with a single blank card left.
+    frame = make_frame(tmp_path / 'frame.fits', n_history=26)
+    before = frame.read_bytes()
+    assert len(split(frame)[0]) == 2880
+
+    write_wcs_to_fits(frame, make_wcs(shape).to_header(), mode='in_place')
+
+    assert frame.read_bytes() == before
+    assert 'PL-SLVED' not in fits.getheader(frame)
+    check_solution(solved_wcs(frame))
+
+
+def test_unsolved_frame(tmp_path):
+    frame = make_frame(tmp_path / 'frame.fits')
+    assert solved_wcs(frame) is None
+    with pytest.raises(ValueError):
+        write_wcs_to_fits(frame, make_wcs(shape).to_header(), mode='append')
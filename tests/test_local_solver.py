@@ -0,0 +1,96 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from synthetic import make_star_field
+from widefield_plate_solver import SolverProfile, extract_stars, plate_solve_locally, solver_profiles
+from widefield_plate_solver.exceptions import CouldNotSolveError
+from widefield_plate_solver.local_solver import _profile_work_dir
+
+shape = (256, 384)
+suppressed = ['--new-fits', 'none', '--corr', 'none', '--match', 'none', '--rdls', 'none', '--solved', 'none',
+              '--index-xyls', 'none', '--temp-axy']
+
+
+def option(argv, name):
+    return argv[argv.index(name) + 1] if name in argv else None
+
+
+def alive(pid):
+    # an orphan not reaped yet is dead too.
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+@pytest.fixture
+def frame(tmp_path, stub_solve_field):
+    fits_file_path = tmp_path / 'frame.fits'
+    make_star_field(fits_file_path, shape=shape, n_stars=60, stub_wcs_dir=stub_solve_field)
+    return fits_file_path, extract_stars(fits_file_path)
+
+
+@pytest.mark.parametrize('name', list(solver_profiles))
+def test_arguments_of_each_profile(frame, solve_field_runs, name):
+    fits_file_path, sources = frame
+    profile = solver_profiles[name]
+
+    wcs = plate_solve_locally(fits_file_path, sources, profile=name, write_to_file=False)
+
+    assert wcs['CRVAL1'] == pytest.approx(150.)
+    (run,) = solve_field_runs()
+    argv = run['argv']
+    if profile.suppress_outputs:
+        assert all(argument in argv for argument in suppressed)
+    else:
+        assert not any(argument in argv for argument in suppressed)
+    assert option(argv, '--cpulimit') == (None if profile.cpulimit is None else str(profile.cpulimit))
+    assert ('--inparallel' in argv) == profile.in_parallel
+    work_dir = _profile_work_dir(profile)
+    if work_dir is None:
+        assert '--temp-dir' not in argv
+    else:
+        # the xylist and the temporary files of solve-field in the work dir.
+        assert Path(option(argv, '--temp-dir')).parent == Path(work_dir)
+        assert Path(argv[0]).parent == Path(option(argv, '--temp-dir'))
+
+
+def test_custom_profile(frame, solve_field_runs, tmp_path):
+    fits_file_path, sources = frame
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    profile = SolverProfile('custom', work_dir=work_dir, cpulimit=10, config=tmp_path / 'backend.cfg',
+                            extra_args=('--downsample', 2))
+
+    plate_solve_locally(fits_file_path, sources, profile=profile, write_to_file=False)
+
+    (run,) = solve_field_runs()
+    argv = run['argv']
+    assert option(argv, '--config') == str(tmp_path / 'backend.cfg')
+    assert option(argv, '--downsample') == '2' and option(argv, '--cpulimit') == '10'
+    assert Path(option(argv, '--temp-dir')).parent == work_dir
+    # cleaned up.
+    assert list(work_dir.iterdir()) == []
+
+
+def test_timeout_kills_the_process_group(frame, solve_field_runs, monkeypatch):
+    fits_file_path, sources = frame
+    monkeypatch.setenv('WPS_STUB_SOLVE_TIME', '60')
+    monkeypatch.setenv('WPS_STUB_SPAWN', '1')
+    start = time.monotonic()
+
+    with pytest.raises(CouldNotSolveError, match='timed out'):
+        plate_solve_locally(fits_file_path, sources, profile=SolverProfile('short', timeout=1), write_to_file=False)
+
+    assert time.monotonic() - start < 10
+    (run,) = solve_field_runs()
+    assert not alive(run['pid'])
+    # its child too.
+    deadline = time.monotonic() + 5
+    while alive(run['child']):
+        assert time.monotonic() < deadline, 'the child of solve-field survived'
+        time.sleep(0.05)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from synthetic import make_star_field
+from widefield_plate_solver import SolveMetrics, image_planes, plate_solve_planes
+from widefield_plate_solver.planes import plane_wcs_extname, solved_planes
+
+shape = (256, 384)
+
+
+def make_images(tmp_path, stub_wcs_dir, shifts):
+    """
+    A synthetic image per shift, of the same stars moved by that many pixels.
+    """
+    rng = np.random.default_rng(0)
+    n_stars = 80
+    x, y = rng.uniform(20, shape[1] - 20, n_stars), rng.uniform(20, shape[0] - 20, n_stars)
+    flux = 10 ** rng.uniform(3, 4.5, n_stars)
+    images = []
+    for seed, (dx, dy) in enumerate(shifts):
+        path = tmp_path / f'image_{seed}.fits'
+        make_star_field(path, shape=shape, n_stars=n_stars, seed=seed, stub_wcs_dir=stub_wcs_dir,
+                        stars=(x + dx, y + dy, flux))
+        images.append(fits.getdata(path))
+    return images
+
+
+def check_solutions(solutions, planes):
+    assert [solution.plane for solution in solutions] == planes
+    for solution in solutions:
+        assert solution.error is None
+        assert solution.wcs['CRVAL1'] == pytest.approx(150.) and solution.wcs['CRVAL2'] == pytest.approx(30.)
+
+
+def test_multi_extension_file(tmp_path, stub_solve_field):
+    fits_file_path = tmp_path / 'mosaic.fits'
+    chips = make_images(tmp_path, stub_solve_field, [(0, 0), (3, -2)])
+    fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(chip, name=f'CHIP{i}') for i, chip in enumerate(chips)]
+                 ).writeto(fits_file_path)
+    metrics = SolveMetrics(fits_file_path)
+
+    solutions = plate_solve_planes(fits_file_path, use_api=False, n_threads=2, metrics=metrics)
+
+    with fits.open(fits_file_path) as hdul:
+        planes = image_planes(hdul)
+        assert [plane.name for plane in planes] == ['CHIP0', 'CHIP1']
+        check_solutions(solutions, planes)
+        assert 'PL-SLVED' not in hdul[0].header
+        assert all(hdul[plane.hdu].header['PL-SLVED'] == 'done' for plane in planes)
+        assert plane_wcs_extname not in hdul
+    assert {'read', 'extract', 'solve', 'solve_field', 'write_wcs'} <= set(metrics.stages)
+    assert metrics.stages['extract']['calls'] == 2
+    assert metrics.stages['solve']['calls'] == 2
+
+
+def test_cube(tmp_path, stub_solve_field):
+    fits_file_path = tmp_path / 'cube.fits'
+    frames = make_images(tmp_path, stub_solve_field, [(0, 0), (1.5, 0.5), (3, 1), (4.5, 1.5)])
+    fits.PrimaryHDU(np.stack(frames)).writeto(fits_file_path)
+    metrics = SolveMetrics(fits_file_path)
+
+    solutions = plate_solve_planes(fits_file_path, use_api=False, reference=0, metrics=metrics)
+
+    with fits.open(fits_file_path) as hdul:
+        planes = image_planes(hdul)
+        assert [plane.index for plane in planes] == [0, 1, 2, 3]
+        check_solutions(solutions, planes)
+        # one row per plane in the table, the header of the cube getting the first one.
+        table = hdul[plane_wcs_extname].data
+        assert list(table['HDU']) == [0, 0, 0, 0] and list(table['PLANE']) == [0, 1, 2, 3]
+        assert hdul[0].header['PL-SLVED'].startswith('done, plane 0')
+        assert set(solved_planes(hdul)) == {(0, index) for index in range(4)}
+    # the reference solved, the next planes matched to the previous one.
+    assert [solution.method for solution in solutions] == ['solved', 'tracked', 'tracked', 'tracked']
+    assert solutions[3].wcs['CRPIX1'] == pytest.approx(shape[1] / 2 + 0.5 + 4.5, abs=0.3)
+    assert metrics.stages['solve']['calls'] == 1
+    assert metrics.stages['track']['calls'] == 3
+
+    # done: not solved again.
+    again = plate_solve_planes(fits_file_path, use_api=False)
+    assert [solution.method for solution in again] == ['done'] * 4
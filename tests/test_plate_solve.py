@@ -0,0 +1,42 @@
+import pytest
+from astropy.io import fits
+
+from synthetic import make_star_field
+from conftest import stub_engine
+from widefield_plate_solver import SolveAttempt, SolveMetrics, SolverEngine, plate_solve, plate_solve_many
+
+
+def test_other_extensions_are_left_to_plate_solve_planes(tmp_path, stub_solve_field):
+    fits_file_path = tmp_path / 'frame.fits'
+    make_star_field(fits_file_path, shape=(256, 384), n_stars=60, stub_wcs_dir=stub_solve_field)
+    with fits.open(fits_file_path, mode='append') as hdul:
+        hdul.append(fits.ImageHDU(hdul[0].data, name='CHIP2'))
+
+    for extract_kwargs in [{'hdu': 1}, {'hdu': 'CHIP2'}, {'hdu': 1, 'tile_size': 128}]:
+        with pytest.raises(ValueError, match='plate_solve_planes'):
+            plate_solve(fits_file_path, use_api=False, extract_kwargs=extract_kwargs)
+        with pytest.raises(ValueError, match='plate_solve_planes'):
+            plate_solve_many([fits_file_path], use_api=False, extract_kwargs=extract_kwargs)
+    assert 'CRVAL1' not in fits.getheader(fits_file_path)
+
+    assert plate_solve(fits_file_path, use_api=False, extract_kwargs={'hdu': 0}) is not None
+
+
+@pytest.mark.parametrize('backend', ['local', 'plan', 'engine'])
+def test_metrics_of_each_backend(tmp_path, stub_solve_field, backend):
+    fits_file_path = tmp_path / 'frame.fits'
+    make_star_field(fits_file_path, shape=(256, 384), n_stars=60, stub_wcs_dir=stub_solve_field)
+    metrics = SolveMetrics(fits_file_path)
+
+    if backend == 'engine':
+        with SolverEngine(engine_command=stub_engine) as engine:
+            plate_solve(fits_file_path, use_api=False, engine=engine, metrics=metrics)
+    else:
+        plan = [SolveAttempt('tight', backend='local')] if backend == 'plan' else None
+        plate_solve(fits_file_path, use_api=False, plan=plan, metrics=metrics)
+
+    expected = {'local': {'solve_field'}, 'plan': {'solve_field'}, 'engine': {'engine_solve'}}[backend]
+    assert expected | {'write_xylist', 'write_wcs'} <= set(metrics.stages)
+    assert metrics.success
+    if backend == 'plan':
+        assert metrics.counts['attempts'] == 1
@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import widefield_plate_solver.preview as preview
+from synthetic import make_star_field
+from widefield_plate_solver import extract_stars
+from widefield_plate_solver.preview import PreviewRenderer, bin_image, render_fits_preview
+
+
+def test_bin_image_by_bands(tmp_path):
+    image = np.random.default_rng(0).normal(1000, 10, (1030, 2050)).astype(np.float32)
+    path = tmp_path / 'image.npy'
+    np.save(path, image)
+    memmapped = np.load(path, mmap_mode='r')
+
+    binned, factor = bin_image(memmapped, max_size=512)
+
+    # the incomplete blocks at the edges are left out.
+    assert factor == 5 and binned.shape == (206, 410)
+    reference = image[:1030, :2050].reshape(206, 5, 410, 5).mean(axis=(1, 3))
+    assert binned == pytest.approx(reference, rel=1e-6)
+    # small enough already: a copy.
+    small, factor = bin_image(image[:100, :100])
+    assert factor == 1 and not np.shares_memory(small, image)
+
+
+def test_fits_preview(tmp_path):
+    fits_file_path = tmp_path / 'frame.fits'
+    truth, wcs = make_star_field(fits_file_path, shape=(1024, 1536), n_stars=200)
+    sources = extract_stars(fits_file_path)
+
+    render_fits_preview(fits_file_path, tmp_path / 'frame.png', sources=sources, max_size=512, wcs=wcs.to_header())
+    render_fits_preview(fits_file_path, tmp_path / 'frame.jpeg', max_size=512)
+
+    # the binned image (512 x 341), and the margins of the labels.
+    width, height = Image.open(tmp_path / 'frame.png').size
+    assert 512 < width < 512 + 200 and 341 < height < 341 + 200
+    width, height = Image.open(tmp_path / 'frame.jpeg').size
+    assert 512 <= width < 512 + 30 and 341 <= height < 341 + 30
+
+
+@pytest.fixture
+def held_renders(monkeypatch):
+    """
+    render_preview replaced by one recording its image, and waiting for the returned event.
+    """
+    release = threading.Event()
+    images = []
+
+    def render(image, savepath, **kwargs):
+        images.append(image.copy())
+        assert release.wait(30)
+
+    monkeypatch.setattr(preview, 'render_preview', render)
+    yield release, images
+    release.set()
+
+
+def test_submit_does_not_wait_for_the_rendering(held_renders):
+    release, images = held_renders
+    buffer = np.full((2048, 3072), 7., dtype=np.float32)
+
+    with PreviewRenderer(max_size=1024) as renderer:
+        start = time.monotonic()
+        future = renderer.submit(buffer, 'frame.jpeg')
+        assert time.monotonic() - start < 5
+        # the buffer reused for the next frame: the preview is of the previous one.
+        buffer[:] = 0.
+        release.set()
+        future.result(timeout=30)
+    (image,) = images
+    assert image.shape == (682, 1024) and np.all(image == 7.)
+
+
+def test_at_most_max_pending(held_renders):
+    release, images = held_renders
+    image = np.zeros((64, 64))
+    renderer = PreviewRenderer(max_pending=2)
+    try:
+        renderer.submit(image, 'first.jpeg')
+        renderer.submit(image, 'second.jpeg')
+        third = threading.Thread(target=renderer.submit, args=(image, 'third.jpeg'))
+        third.start()
+        third.join(0.5)
+        # waits for room.
+        assert third.is_alive()
+        release.set()
+        third.join(30)
+        assert not third.is_alive()
+    finally:
+        release.set()
+        renderer.close()
+    assert len(images) == 3
+
+
+def test_failures_are_only_logged(tmp_path, caplog):
+    with caplog.at_level(logging.WARNING, logger='widefield_plate_solver.preview'):
+        with PreviewRenderer() as renderer:
+            future = renderer.submit(np.zeros((64, 64)), tmp_path / 'missing' / 'frame.jpeg')
+            assert future.result(timeout=30) is None
+            # the next ones still rendered.
+            renderer.submit(np.random.default_rng(0).normal(size=(64, 64)), tmp_path / 'frame.jpeg')
+    assert 'could not render' in caplog.text
+    assert (tmp_path / 'frame.jpeg').exists()
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from astropy.wcs import WCS
+from scipy.spatial import cKDTree
+
+from synthetic import make_star_field, make_wcs
+from widefield_plate_solver import SolveMetrics, build_quad_index, extract_stars, refine_wcs
+from widefield_plate_solver.quad_solver import plate_solve_with_index
+
+# a 17 x 11 degrees field.
+shape = (1024, 1536)
+pixel_scale = 40.
+
+
+def synthetic_sky(fits_file_path, seed, position_noise):
+    """
+    A synthetic frame, and a catalog of its stars (their positions off by position_noise pixels, like the
+    centroids and catalogs of real frames) and of the sky around at the same density.
+    """
+    rng = np.random.default_rng(seed)
+    wcs = make_wcs(shape, pixel_scale=pixel_scale, rotation=20. + 37 * seed)
+    truth, wcs = make_star_field(fits_file_path, shape=shape, n_stars=300, seed=seed, wcs=wcs)
+    ra, dec = wcs.all_pix2world(truth['x'] + rng.normal(0, position_noise, 300),
+                                truth['y'] + rng.normal(0, position_noise, 300), 0)
+    mag = -2.5 * np.log10(truth['flux'])
+
+    n_around = 2400
+    ra_around = rng.uniform(120, 180, n_around)
+    dec_around = np.degrees(np.arcsin(rng.uniform(np.sin(np.radians(5)), np.sin(np.radians(55)), n_around)))
+    x, y = wcs.all_world2pix(ra_around, dec_around, 0)
+    outside = (x < -2) | (x > shape[1] + 1) | (y < -2) | (y > shape[0] + 1)
+    mag_around = -2.5 * np.log10(10 ** (2.5 + 2.5 * rng.power(0.6, n_around)))
+    catalog = (np.r_[ra, ra_around[outside]], np.r_[dec, dec_around[outside]], np.r_[mag, mag_around[outside]])
+    return catalog, truth, wcs
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('position_noise', [0., 0.7])
+def test_blind_solve_of_a_wide_field(tmp_path, seed, position_noise):
+    fits_file_path = tmp_path / 'frame.fits'
+    catalog, truth, true_wcs = synthetic_sky(fits_file_path, seed, position_noise)
+    index = build_quad_index(catalog, tmp_path / 'index', field_radius=0.5 * np.hypot(17.07, 11.38))
+    sources = extract_stars(str(fits_file_path))
+
+    metrics = SolveMetrics(fits_file_path)
+    header = plate_solve_with_index(fits_file_path, sources, index, write_to_file=False, metrics=metrics)
+    assert 'quad_search' in metrics.stages
+
+    # fitted to all the stars of the field, not only to the few index stars.
+    assert header['PL-NREF'] > 50
+    # extract_stars' 2x2 median filter moves all the centroids by the same fraction of a pixel.
+    distances, nearest = cKDTree(np.column_stack((truth['x'], truth['y']))).query(
+        np.column_stack((sources['x'], sources['y'])))
+    close = distances < 1
+    shift = np.median(np.column_stack((sources['x'][close] - truth['x'][nearest[close]],
+                                       sources['y'][close] - truth['y'][nearest[close]])), axis=0)
+    x, y = (grid.ravel() for grid in np.meshgrid(np.linspace(0, shape[1] - 1, 20), np.linspace(0, shape[0] - 1, 20)))
+    solved_x, solved_y = WCS(header).all_world2pix(*true_wcs.all_pix2world(x, y, 0), 0)
+    errors = np.hypot(solved_x - x - shift[0], solved_y - y - shift[1])
+    assert np.median(errors) < 0.1 + 0.3 * position_noise
+    assert errors.max() < 0.1 + 0.8 * position_noise
+
+
+def test_refinement_with_the_index_uses_its_whole_catalog(tmp_path):
+    fits_file_path = tmp_path / 'frame.fits'
+    catalog, truth, true_wcs = synthetic_sky(fits_file_path, 0, 0.)
+    index = build_quad_index(catalog, tmp_path / 'index', field_radius=0.5 * np.hypot(17.07, 11.38))
+    sources = extract_stars(str(fits_file_path))
+
+    _, with_catalog = refine_wcs(true_wcs.to_header(), sources, catalog, shape[1], shape[0], sip_order=1)
+    _, with_index = refine_wcs(true_wcs.to_header(), sources, index, shape[1], shape[0], sip_order=1)
+
+    assert with_index.n_matched == with_catalog.n_matched
+    assert with_index.n_matched > 2 * len(index.stars_around(150., 30., 10.)[0])
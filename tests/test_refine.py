@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from synthetic import make_wcs
+from widefield_plate_solver import refine_wcs
+
+shape = (1024, 1536)
+
+
+def field(n_stars=300, n_outliers=0, seed=0):
+    """
+    A catalog, and the sources seen through the true WCS with 0.05 pixel of noise, the first n_outliers shifted
+    by 2 pixels (e.g. blended).
+    """
+    rng = np.random.default_rng(seed)
+    wcs = make_wcs(shape, pixel_scale=20., rotation=5.)
+    x, y = rng.uniform(0, shape[1] - 1, n_stars), rng.uniform(0, shape[0] - 1, n_stars)
+    ra, dec = wcs.all_pix2world(x, y, 0)
+    x, y = x + rng.normal(0, 0.05, n_stars), y + rng.normal(0, 0.05, n_stars)
+    x[:n_outliers] += 2.
+    sources = Table({'xcentroid': x, 'ycentroid': y, 'flux': 10 ** rng.uniform(2.5, 5, n_stars)})
+    return wcs, sources, (ra, dec, rng.uniform(8, 12, n_stars))
+
+
+def error(wcs_header, true_wcs):
+    """
+    Largest distance in pixels, over the frame, between the true positions and those through the solution.
+    """
+    grid = np.column_stack([g.ravel() for g in np.meshgrid(np.linspace(0, shape[1] - 1, 10),
+                                                           np.linspace(0, shape[0] - 1, 10))])
+    x, y = WCS(wcs_header).all_world2pix(*true_wcs.all_pix2world(grid[:, 0], grid[:, 1], 0), 0)
+    return np.hypot(x - grid[:, 0], y - grid[:, 1]).max()
+
+
+def test_refine_a_rough_solution():
+    true_wcs, sources, catalog = field()
+    rough = make_wcs(shape, ra=150.002, dec=30.001, pixel_scale=20.02, rotation=5.05)
+
+    header, residuals = refine_wcs(rough.to_header(), sources, catalog, shape[1], shape[0], sip_order=2)
+
+    assert error(header, true_wcs) < 0.05
+    assert residuals.n_matched == 300 and residuals.n_rejected == 0
+    # 0.05 pixel of 20 arcsec.
+    assert residuals.rms == pytest.approx(np.sqrt(2) * 0.05 * 20, rel=0.2)
+    assert residuals.rms_before > 10 * residuals.rms
+    assert header['PL-NREF'] == 300
+
+
+@pytest.mark.parametrize('max_iterations', [1, 5])
+def test_solution_fitted_without_the_rejected_matches(max_iterations):
+    true_wcs, sources, catalog = field(n_outliers=30)
+
+    header, residuals = refine_wcs(true_wcs.to_header(), sources, catalog, shape[1], shape[0], sip_order=1,
+                                   max_iterations=max_iterations)
+
+    assert residuals.n_rejected == 30
+    # fitted with the outliers, it would be off by 0.2 pixel.
+    assert error(header, true_wcs) < 0.03
+    assert residuals.rms == pytest.approx(np.sqrt(2) * 0.05 * 20, rel=0.2)
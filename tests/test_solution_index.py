@@ -0,0 +1,83 @@
+import os
+
+import pytest
+from astropy.io import fits
+
+from synthetic import make_star_field, make_wcs
+from widefield_plate_solver import SolutionIndex, plate_solve
+
+shape = (256, 384)
+
+
+def make_frame(path, seed=0, stub_wcs_dir=None, **keywords):
+    make_star_field(path, shape=shape, n_stars=60, seed=seed, stub_wcs_dir=stub_wcs_dir)
+    for keyword, value in keywords.items():
+        fits.setval(path, keyword, value=value)
+    return path
+
+
+def argument(argv, name):
+    return float(argv[argv.index(name) + 1]) if name in argv else None
+
+
+def test_modified_frames_are_unsolved(tmp_path):
+    index = SolutionIndex(tmp_path / 'index.sqlite')
+    frames = [make_frame(tmp_path / f'frame_{seed}.fits', seed) for seed in range(3)]
+    for frame in frames[:2]:
+        index.record(frame, make_wcs(shape).to_header())
+
+    assert index.get(frames[0])['CRVAL1'] == pytest.approx(150.)
+    assert index.get(frames[2]) is None
+    assert index.unsolved(frames) == [frames[2]]
+
+    # touched (e.g. reduced again): solved again.
+    stat = frames[1].stat()
+    os.utime(frames[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert index.get(frames[1]) is None
+    assert index.unsolved(frames) == frames[1:]
+    # or gone.
+    frames[0].unlink()
+    assert index.get(frames[0]) is None
+
+
+def test_hint_from_the_target_or_else_the_instrument(tmp_path):
+    index = SolutionIndex(tmp_path / 'index.sqlite')
+    solves = [('M31', 'cam1', 10.7, 41.3, 20.), ('M42', 'cam1', 83.8, -5.4, 20.), ('M31', 'cam2', 10.6, 41.2, 5.),
+              ('M42', 'cam2', 83.9, -5.3, 5.)]
+    for i, (target, instrument, ra, dec, scale) in enumerate(solves):
+        frame = make_frame(tmp_path / f'frame_{i}.fits', i, OBJECT=target, INSTRUME=instrument)
+        index.record(frame, make_wcs(shape, ra=ra, dec=dec, pixel_scale=scale).to_header())
+
+    # the latest solve of the target, whatever the instrument.
+    ra, dec, scale = index.hint(target='M31', instrument='cam1')
+    assert (ra, dec, scale) == pytest.approx((10.6, 41.2, 5.))
+    # a new target: only the scale of the latest solve with this instrument.
+    ra, dec, scale = index.hint(target='M45', instrument='cam1')
+    assert ra is None and dec is None and scale == pytest.approx(20.)
+    assert index.hint(instrument='cam2')[2] == pytest.approx(5.)
+    assert index.hint(target='M45', instrument='cam3') is None
+    assert index.hint() is None
+
+
+def test_plate_solve_skips_and_hints(tmp_path, stub_solve_field, solve_field_runs):
+    index = SolutionIndex(tmp_path / 'index.sqlite')
+    first = make_frame(tmp_path / 'first.fits', 0, stub_solve_field, OBJECT='M31', INSTRUME='cam1')
+    plate_solve(first, use_api=False, solution_index=index)
+    (run,) = solve_field_runs()
+    assert argument(run['argv'], '--ra') is None and argument(run['argv'], '--scale-low') is None
+    assert index.unsolved([first]) == []
+
+    # in the index: not solved again.
+    assert plate_solve(first, use_api=False, solution_index=index)['CRVAL1'] == pytest.approx(150.)
+    assert len(solve_field_runs()) == 1
+
+    # same target: its pointing and scale. Same instrument only: its scale.
+    make_frame(tmp_path / 'same_target.fits', 1, OBJECT='M31', INSTRUME='cam1')
+    make_frame(tmp_path / 'same_instrument.fits', 2, OBJECT='M42', INSTRUME='cam1')
+    plate_solve(tmp_path / 'same_target.fits', use_api=False, solution_index=index)
+    plate_solve(tmp_path / 'same_instrument.fits', use_api=False, solution_index=index)
+    same_target, same_instrument = (run['argv'] for run in solve_field_runs()[1:])
+    assert (argument(same_target, '--ra'), argument(same_target, '--dec')) == pytest.approx((150., 30.))
+    assert argument(same_target, '--scale-low') == pytest.approx(0.8 * 20.)
+    assert argument(same_instrument, '--ra') is None
+    assert argument(same_instrument, '--scale-high') == pytest.approx(1.2 * 20.)
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import widefield_plate_solver.source_cache as source_cache_module
+from synthetic import make_star_field, make_wcs
+from widefield_plate_solver import SourceCache
+from widefield_plate_solver.fits_io import write_wcs_to_fits
+
+shape = (256, 384)
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    """
+    The frames (and HDUs) whose sources the cache extracted.
+    """
+    calls = []
+    extract_stars = source_cache_module.extract_stars
+
+    def counting(fits_file_path, **kwargs):
+        calls.append((fits_file_path, kwargs.get('hdu', 0)))
+        return extract_stars(fits_file_path, **kwargs)
+
+    monkeypatch.setattr(source_cache_module, 'extract_stars', counting)
+    return calls
+
+
+def touch_later(path, seconds=10):
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10**9))
+
+
+def test_hit_unless_the_pixels_change(tmp_path, extractions):
+    frame = tmp_path / 'frame.fits'
+    make_star_field(frame, shape=shape, n_stars=60, seed=0)
+    cache = SourceCache(tmp_path / 'cache')
+
+    sources = cache.get_or_extract(frame)
+    assert cache.get_or_extract(frame).as_array().tolist() == sources.as_array().tolist()
+    # the WCS written to the header, or arguments that do not change the sources: still the same entry.
+    write_wcs_to_fits(frame, make_wcs(shape).to_header())
+    cache.get_or_extract(frame, extract_kwargs=dict(n_threads=2))
+    assert len(extractions) == 1
+    # other arguments: another entry.
+    assert len(cache.get_or_extract(frame, extract_kwargs=dict(n_brightest=20))) == 20
+    assert len(extractions) == 2
+
+    # other pixels, same size.
+    with fits.open(frame, mode='update') as hdul:
+        hdul[0].data[:] = np.flipud(hdul[0].data)
+    touch_later(frame)
+    flipped = cache.get_or_extract(frame)
+    assert len(extractions) == 3
+    assert np.median(flipped['y']) != pytest.approx(np.median(sources['y']))
+
+
+def test_each_hdu_has_its_entry(tmp_path, extractions):
+    chips = []
+    for seed in range(2):
+        make_star_field(tmp_path / f'chip_{seed}.fits', shape=shape, n_stars=60, seed=seed)
+        chips.append(fits.getdata(tmp_path / f'chip_{seed}.fits'))
+    frame = tmp_path / 'mosaic.fits'
+    fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(chip) for chip in chips]).writeto(frame)
+    cache = SourceCache(tmp_path / 'cache')
+
+    first, second = (cache.get_or_extract(frame, extract_kwargs=dict(hdu=hdu)) for hdu in (1, 2))
+    assert not np.array_equal(first['x'], second['x'])
+    for hdu, sources in ((1, first), (2, second)):
+        assert np.array_equal(cache.get_or_extract(frame, extract_kwargs=dict(hdu=hdu))['x'], sources['x'])
+    assert extractions == [(frame, 1), (frame, 2)]
+
+
+def test_least_recently_used_entries_evicted(tmp_path, extractions):
+    frames = []
+    for seed in range(3):
+        frame = tmp_path / f'frame_{seed}.fits'
+        make_star_field(frame, shape=shape, n_stars=60, seed=seed)
+        frames.append(frame)
+    cache = SourceCache(tmp_path / 'cache')
+    for frame in frames:
+        cache.get_or_extract(frame)
+    assert len(list((tmp_path / 'cache' / 'sources').glob('*.npy'))) == 3
+    sizes = [cache._entry_path(frame, None).stat().st_size for frame in frames]
+
+    def use(*order):
+        # the last one the most recently used.
+        for age, frame in enumerate(reversed(order)):
+            entry_path = cache._entry_path(frame, None)
+            os.utime(entry_path, (entry_path.stat().st_atime, 1e9 - 10 * age))
+
+    use(frames[1], frames[2], frames[0])
+    cache.max_bytes = sizes[0] + sizes[2]
+    cache.evict()
+    assert cache.get(frames[1]) is None
+    assert cache.get(frames[0]) is not None and cache.get(frames[2]) is not None
+    # a get marks the entry as used.
+    use(frames[2], frames[0])
+    assert cache.get(frames[2]) is not None
+
+    # put evicts too.
+    cache.max_bytes = sizes[1] + sizes[2]
+    cache.get_or_extract(frames[1])
+    assert len(extractions) == 4
+    assert cache.get(frames[0]) is None
+    assert cache.get(frames[1]) is not None and cache.get(frames[2]) is not None
@@ -0,0 +1,101 @@
+import pickle
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from widefield_plate_solver.sources import SourceList, as_source_list, brightest_indices
+
+
+def sep_like(n=50, seed=0):
+    rng = np.random.default_rng(seed)
+    data = np.zeros(n, dtype=[('x', 'f8'), ('y', 'f8'), ('flux', 'f8'), ('a', 'f4'), ('b', 'f4'), ('npix', 'i4')])
+    data['x'], data['y'] = rng.uniform(0, 1000, n), rng.uniform(0, 800, n)
+    data['flux'] = 10 ** rng.uniform(2, 5, n)
+    data['a'], data['b'] = rng.uniform(1.5, 3, n), rng.uniform(1, 1.5, n)
+    data['npix'] = rng.integers(5, 50, n)
+    return data
+
+
+def test_aliases_are_views():
+    data = sep_like()
+    sources = SourceList(data)
+
+    assert sources.colnames[-2:] == ['xcentroid', 'ycentroid']
+    assert np.shares_memory(sources['xcentroid'], sources['x'])
+    assert np.shares_memory(sources['x'], data)
+    sources['x'][3] = -1.
+    assert sources['xcentroid'][3] == -1.
+    assert sources['elongation'] == pytest.approx(data['a'] / data['b'])
+
+    # slices keep the aliases, as views too.
+    rows = sources[sources['flux'] > 1000]
+    assert isinstance(rows, SourceList) and 'ycentroid' in rows.colnames
+    assert np.all(rows['ycentroid'] == data['y'][data['flux'] > 1000])
+    first = sources[:5]
+    assert np.shares_memory(first['ycentroid'], data)
+    assert sources[2]['xcentroid'] == data['x'][2]
+
+    # saved, pickled and converted without them.
+    assert sources.as_array().dtype.names == data.dtype.names
+    assert np.shares_memory(sources.as_array(), data)
+    unpickled = pickle.loads(pickle.dumps(sources))
+    assert unpickled.colnames == sources.colnames and np.array_equal(unpickled['xcentroid'], sources['x'])
+    table = sources.to_table()
+    assert table.colnames == list(data.dtype.names) + ['xcentroid', 'ycentroid']
+    assert np.array_equal(table['xcentroid'], data['x'])
+
+
+def test_from_a_photutils_table():
+    data = sep_like()
+    table = Table({'xcentroid': data['x'], 'ycentroid': data['y'], 'flux': data['flux']})
+    sources = as_source_list(table)
+
+    assert sources.colnames == ['xcentroid', 'ycentroid', 'flux', 'x', 'y']
+    assert np.array_equal(sources['x'], data['x'])
+    assert np.shares_memory(sources['x'], sources['xcentroid'])
+    assert as_source_list(sources) is sources
+    # masked columns filled.
+    masked = Table(table, masked=True)
+    masked['flux'].mask[0] = True
+    assert len(as_source_list(masked)) == len(data)
+
+
+@pytest.mark.parametrize('n', [None, -1, 0, 1, 7, 49, 50, 51, 1000])
+def test_brightest_indices_as_argsort(n):
+    rng = np.random.default_rng(1)
+    flux = rng.uniform(0, 1e4, 50)
+    # the reference: all sorted, largest first.
+    reference = np.argsort(-flux, kind='stable')
+    expected = reference if n is None else reference[:max(n, 0)]
+
+    assert np.array_equal(brightest_indices(flux, n), expected)
+
+
+@pytest.mark.parametrize('n', [1, 5, 10, 30])
+def test_brightest_indices_with_ties(n):
+    flux = np.repeat([3., 1., 2., 5., 4.], 6)
+    np.random.default_rng(2).shuffle(flux)
+
+    indices = brightest_indices(flux, n)
+
+    assert len(indices) == len(set(indices)) == n
+    assert np.array_equal(flux[indices], np.sort(flux)[::-1][:n])
+
+
+def test_brightest_and_positions():
+    data = sep_like()
+    sources = SourceList(data)
+    order = np.argsort(-data['flux'], kind='stable')
+
+    brightest = sources.brightest(10)
+    assert np.array_equal(brightest['flux'], data['flux'][order[:10]])
+    assert np.array_equal(brightest['xcentroid'], data['x'][order[:10]])
+    assert np.array_equal(sources.brightest()['flux'], data['flux'][order])
+    x, y = sources.positions(5)
+    assert np.array_equal(x, data['x'][order[:5]]) and np.array_equal(y, data['y'][order[:5]])
+
+    # no flux: in the order given.
+    positions_only = SourceList(np.array(list(zip(data['x'], data['y'])), dtype=[('x', 'f8'), ('y', 'f8')]))
+    x, y = positions_only.positions(5)
+    assert np.array_equal(x, data['x'][:5])
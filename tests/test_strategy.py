@@ -0,0 +1,80 @@
+import os
+import time
+
+import pytest
+from astropy.io import fits
+
+from synthetic import make_star_field
+from widefield_plate_solver import SolveMetrics, extract_stars, plate_solve
+from widefield_plate_solver.exceptions import CouldNotSolveError
+from widefield_plate_solver.strategy import default_plan, solve_with_strategy
+
+shape = (256, 384)
+# a wrong pointing: only the blind attempt can solve.
+hints = dict(ra_approx=120., dec_approx=10., scale_min=19., scale_max=21.)
+
+
+def option(argv, name):
+    return float(argv[argv.index(name) + 1]) if name in argv else None
+
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+@pytest.fixture
+def frame(tmp_path, stub_solve_field, monkeypatch):
+    fits_file_path = tmp_path / 'frame.fits'
+    make_star_field(fits_file_path, shape=shape, n_stars=60, stub_wcs_dir=stub_solve_field)
+    monkeypatch.setenv('WPS_STUB_UNSOLVABLE', '--ra')
+    return fits_file_path
+
+
+def test_escalation(frame, solve_field_runs):
+    metrics = SolveMetrics(frame)
+
+    wcs = plate_solve(frame, use_api=False, plan=default_plan, metrics=metrics, **hints)
+
+    # tight, then wide, then blind; the API is not needed.
+    tight, wide, blind = (run['argv'] for run in solve_field_runs())
+    assert (option(tight, '--radius'), option(tight, '--scale-low'), option(tight, '--scale-high')) == (1., 19., 21.)
+    assert option(wide, '--radius') == 5. and option(wide, '--scale-low') == pytest.approx(19. / 1.5)
+    assert option(blind, '--ra') is None and option(blind, '--scale-low') is None
+    assert metrics.counts['attempts'] == 3
+    assert wcs['CRVAL1'] == pytest.approx(150.)
+    assert fits.getheader(frame)['CRVAL1'] == pytest.approx(150.)
+
+
+def test_attempts_made_the_same_by_missing_hints_run_once(frame, solve_field_runs, monkeypatch):
+    monkeypatch.setenv('WPS_STUB_UNSOLVABLE', '--no-plots')
+    sources = extract_stars(frame)
+
+    # without hints, wide is blind with as many sources as blind.
+    with pytest.raises(CouldNotSolveError):
+        solve_with_strategy(frame, sources, plan=default_plan[:3])
+
+    assert len(solve_field_runs()) == 2
+    assert 'PL-SLVED' not in fits.getheader(frame)
+
+
+def test_race_cancels_the_losers(frame, solve_field_runs, monkeypatch):
+    monkeypatch.setenv('WPS_STUB_UNSOLVABLE_TIME', '60')
+    start = time.monotonic()
+
+    wcs = plate_solve(frame, use_api=False, plan=default_plan[:3], parallel_plan=True, **hints)
+
+    assert time.monotonic() - start < 20
+    assert wcs['CRVAL1'] == pytest.approx(150.)
+    runs = solve_field_runs()
+    assert len(runs) == 3
+    losers = [run['pid'] for run in runs if '--ra' in run['argv']]
+    assert len(losers) == 2
+    # killed, not left searching.
+    deadline = time.monotonic() + 5
+    while any(running(pid) for pid in losers):
+        assert time.monotonic() < deadline, 'the losing solve-field runs were not killed'
+        time.sleep(0.05)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from synthetic import make_star_field, make_wcs
+from widefield_plate_solver import SequenceTracker, SolveMetrics, plate_solve
+from widefield_plate_solver.exceptions import CouldNotSolveError
+
+shape = (1024, 1536)
+
+
+def source_table(x, y, flux):
+    return Table({'xcentroid': x, 'ycentroid': y, 'flux': flux})
+
+
+def test_tracked_wcs_follows_a_shift_and_a_rotation():
+    rng = np.random.default_rng(0)
+    reference_wcs = make_wcs(shape, pixel_scale=20., rotation=10.)
+    n_stars = 200
+    xy = rng.uniform([0, 0], [shape[1] - 1, shape[0] - 1], (n_stars, 2))
+    flux = 10 ** rng.uniform(2.5, 5, n_stars)
+
+    # the next frame: drifted, rotated by 0.3 degree and slightly rescaled (refraction), a few stars lost or new.
+    angle, scale, shift = np.radians(0.3), 1.0002, np.array([17.5, -8.2])
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    moved = scale * xy @ rotation.T + shift + rng.normal(0, 0.05, xy.shape)
+    kept = rng.random(n_stars) > 0.1
+    new = rng.uniform([0, 0], [shape[1] - 1, shape[0] - 1], (15, 2))
+    moved = np.vstack((moved[kept], new))
+    moved_flux = np.r_[flux[kept], 10 ** rng.uniform(2.5, 5, 15)]
+
+    tracker = SequenceTracker()
+    tracker.update(reference_wcs.to_header(), source_table(xy[:, 0], xy[:, 1], flux))
+    tracked = WCS(tracker.track(source_table(moved[:, 0], moved[:, 1], moved_flux)))
+
+    # the truth: a pixel of the new frame sees what its antecedent saw in the reference frame.
+    grid = np.column_stack([g.ravel() for g in np.meshgrid(np.linspace(0, shape[1] - 1, 10),
+                                                           np.linspace(0, shape[0] - 1, 10))])
+    antecedents = ((grid - shift) @ rotation) / scale
+    true_x, true_y = tracked.all_world2pix(*reference_wcs.all_pix2world(antecedents[:, 0], antecedents[:, 1], 0), 0)
+    assert np.hypot(true_x - grid[:, 0], true_y - grid[:, 1]).max() < 0.05
+
+
+def test_unmatched_frame_falls_back_to_a_full_solve(tmp_path, stub_solve_field):
+    fits_file_path = tmp_path / 'frame.fits'
+    truth, wcs = make_star_field(fits_file_path, shape=(512, 768), n_stars=150, seed=1,
+                                 stub_wcs_dir=stub_solve_field)
+    # the previous frame was elsewhere in the sky, with other stars.
+    rng = np.random.default_rng(2)
+    tracker = SequenceTracker()
+    tracker.update(make_wcs((512, 768), ra=30., dec=-20.).to_header(),
+                   source_table(*rng.uniform(0, 500, (2, 150)), 10 ** rng.uniform(2.5, 5, 150)))
+    with pytest.raises(CouldNotSolveError):
+        tracker.track(source_table(truth['x'], truth['y'], truth['flux']))
+    metrics = SolveMetrics(fits_file_path)
+
+    solved = plate_solve(fits_file_path, use_api=False, tracker=tracker, metrics=metrics)
+
+    assert {'track', 'solve', 'solve_field'} <= set(metrics.stages)
+    assert solved['CRVAL1'] == pytest.approx(150.) and solved['CRVAL2'] == pytest.approx(30.)
+    # the solved frame is the reference of the next one.
+    assert tracker.wcs.wcs.crval == pytest.approx([150., 30.])
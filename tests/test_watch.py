@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from synthetic import make_star_field
+from widefield_plate_solver import FolderWatcher, watch_and_solve
+from widefield_plate_solver.fits_io import solved_wcs
+from widefield_plate_solver.watch import ProgressJournal, _load_inotify
+
+settle_time = 0.5
+use_inotify = pytest.mark.parametrize('use_inotify', [
+    pytest.param(True, marks=pytest.mark.skipif(_load_inotify() is None, reason='no inotify here')),
+    False,
+])
+
+
+def frame_bytes(tmp_path, seed, stub_wcs_dir=None):
+    source = tmp_path / f'source_{seed}.fits'
+    make_star_field(source, shape=(256, 384), n_stars=60, seed=seed, stub_wcs_dir=stub_wcs_dir)
+    return source.read_bytes()
+
+
+def wait_for(condition, timeout=30.):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+@use_inotify
+def test_frames_are_reported_once_settled(tmp_path, use_inotify):
+    directory = tmp_path / 'night'
+    directory.mkdir()
+    content = frame_bytes(tmp_path, 0)
+    frame = directory / 'frame.fits'
+
+    with FolderWatcher([directory], settle_time=settle_time, poll_interval=0.1, use_inotify=use_inotify) as watcher:
+        assert watcher.uses_inotify == use_inotify
+        # the camera writes the first half, pauses, then the rest.
+        with open(frame, 'wb') as f:
+            f.write(content[:len(content) // 2 + 100])
+        start = time.monotonic()
+        while time.monotonic() - start < 3 * settle_time:
+            assert watcher.poll(timeout=0.1) == []
+        with open(frame, 'ab') as f:
+            f.write(content[len(content) // 2 + 100:])
+        written = time.monotonic()
+
+        reported = []
+        while not reported:
+            reported = watcher.poll(timeout=0.1)
+            assert time.monotonic() - written < 10
+        assert reported == [frame]
+        assert time.monotonic() - written >= settle_time
+
+        # and only once.
+        start = time.monotonic()
+        while time.monotonic() - start < 3 * settle_time:
+            assert watcher.poll(timeout=0.1) == []
+
+
+def run_watcher(directory, stop_event, use_inotify, results):
+    results.append(watch_and_solve([directory], n_workers=1, settle_time=settle_time, poll_interval=0.1,
+                                   use_inotify=use_inotify, stop_event=stop_event, use_api=False))
+
+
+@use_inotify
+def test_restarted_watcher_skips_the_frames_solved(tmp_path, stub_solve_field, use_inotify):
+    directory = tmp_path / 'night'
+    directory.mkdir()
+    journal_path = directory / '.plate_solve_progress.jsonl'
+    first, second = directory / 'first.fits', directory / 'second.fits'
+
+    def solved_in_journal(path):
+        entry = ProgressJournal(journal_path).get(path)
+        return entry is not None and entry['status'] == 'solved'
+
+    # a frame written while each watcher runs, the second watcher started after the first one stopped.
+    for seed, frame in enumerate((first, second)):
+        stop_event, results = threading.Event(), []
+        thread = threading.Thread(target=run_watcher, args=(directory, stop_event, use_inotify, results))
+        thread.start()
+        try:
+            time.sleep(0.2)
+            frame.write_bytes(frame_bytes(tmp_path, seed, stub_solve_field))
+            wait_for(lambda: solved_in_journal(frame))
+            # the write of the WCS is not taken for a new frame.
+            time.sleep(3 * settle_time)
+        finally:
+            stop_event.set()
+            thread.join()
+        assert results == [{'solved': 1, 'failed': 0}]
+
+    assert solved_wcs(first) is not None and solved_wcs(second) is not None
+    with open(journal_path) as f:
+        assert len(f.readlines()) == 2
@@ -1,23 +1,82 @@
-from astropy.io import fits
-from astropy.wcs import WCS
+import importlib
 import logging
+import time
 from pathlib import Path
 
-from .local_solver import plate_solve_locally
-from .api_solver import plate_solve_with_API
-from .extract_stars import extract_stars
+from .metrics import SolveMetrics, MetricsRecorder, stage, outcome, count
+from .exceptions import CouldNotSolveError
+
+
+# the rest of the public names, imported from their module on first access: `import widefield_plate_solver` stays
+# fast, and e.g. a local solve never imports astroquery (API backend) nor matplotlib (plots).
+# The extract_stars module shares its name with its function: loading it binds the module on the package, so
+# __getattr__ binds the function after it, and our own modules take the function from the package.
+_lazy_imports = {
+    'plate_solve_locally': 'local_solver',
+    'SolverProfile': 'local_solver',
+    'solver_profiles': 'local_solver',
+    'plate_solve_with_API': 'api_solver',
+    'AstrometryNetClient': 'api_client',
+    'extract_stars': 'extract_stars',
+    'ExtractionBuffers': 'extract_stars',
+    'SourceList': 'sources',
+    'as_source_list': 'sources',
+    'plate_solve_many': 'batch',
+    'SourceCache': 'source_cache',
+    'SolutionIndex': 'solution_index',
+    'SolverEngine': 'engine',
+    'SequenceTracker': 'tracking',
+    'plate_solve_with_index': 'quad_solver',
+    'build_quad_index': 'quad_solver',
+    'QuadIndex': 'quad_solver',
+    'solve_with_strategy': 'strategy',
+    'SolveAttempt': 'strategy',
+    'default_plan': 'strategy',
+    'write_wcs_to_fits': 'fits_io',
+    'FitsFrame': 'fits_io',
+    'solved_wcs': 'fits_io',
+    'watch_and_solve': 'watch',
+    'FolderWatcher': 'watch',
+    'plate_solve_planes': 'planes',
+    'PlaneSolution': 'planes',
+    'image_planes': 'planes',
+    'solve_distributed': 'distributed',
+    'LeaseDirectory': 'distributed',
+    'refine_wcs': 'refine',
+    'AstrometricResiduals': 'refine',
+    'render_fits_preview': 'preview',
+    'PreviewRenderer': 'preview',
+}
+
+
+def __getattr__(name):
+    if name not in _lazy_imports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_lazy_imports[name]}", __name__), name)
+    # after the import, which may have bound a submodule of the same name.
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_imports))
 
 
 def plate_solve(fits_file_path, sources=None, use_existing_wcs_as_guess=True,
                 use_n_brightest_only=None, redo_if_done=False, use_api=True,
                 ra_approx=None, dec_approx=None, scale_min=None, scale_max=None,
-                logger=None, do_debug_plot=False, odds_to_solve=None):
+                logger=None, do_debug_plot=False, odds_to_solve=None, engine=None,
+                tracker=None, quad_index=None, extract_kwargs=None,
+                source_cache=None, solution_index=None, api_client=None, plan=None, parallel_plan=False,
+                wcs_write_mode='update', metrics=None, solver_profile=None, refine_catalog=None, refine_kwargs=None,
+                before_write=None):
     """
     Super function to decide between local and API plate solving.
 
     Parameters:
     fits_file_path (Path or str): Path to the FITS file.
-    sources (astropy.table.Table): Table of detected sources. If None, runs the source extractor in extract_stars.py
+    sources (SourceList or astropy.table.Table): detected sources. If None, runs the source extractor
+                                                 extract_stars.
     use_existing_wcs_as_guess (bool): If True, use existing WCS info as a guess.
     use_n_brightest_only (int): Number of sources to consider. If None, use all.
     redo_if_done (bool): Redo even if our solved keyword is already in the header?
@@ -29,10 +88,51 @@ def plate_solve(fits_file_path, sources=None, use_existing_wcs_as_guess=True,
     logger (logging.logger): if you feel fancy, provide a logger.
     do_debug_plot (bool): will dump an image of the extracted sources.
     odds_to_solve: odds to declare solved. we can lower it for small fields when we specify a search radius.
+    engine (SolverEngine): a running solver engine keeping the index files loaded, used instead of
+                           starting solve-field when solving locally.
+    tracker (SequenceTracker): for time series. If it has a previous frame, first try to get the WCS by matching
+                               the stars to those of the previous frame, and only solve if that fails.
+                               Updated with the new solution.
+    quad_index (QuadIndex, or Path or str): solve in-process with this triangle hash index (see build_quad_index)
+                                            instead of using the API or solve-field.
+    extract_kwargs (dict): more arguments for extract_stars, e.g. dict(tile_size=2048) for very large sensors,
+                           or dict(low_memory=True, buffers=ExtractionBuffers()) for a stream of frames.
+                           Only the primary HDU is solved: for the other extensions, use plate_solve_planes.
+    source_cache (SourceCache): look for the sources of this frame in this cache before extracting them,
+                                and store them there after.
+    solution_index (SolutionIndex): database of solved frames. A frame found there (and not modified since) is
+                                    not opened at all, new solutions are recorded, and frames without any
+                                    pointing information get that of the latest solve of the same target as a
+                                    guess (only its pixel scale if just the instrument matches).
+    api_client (AstrometryNetClient): a started client, used instead of logging in again when using the API.
+                                      Share it between threads to solve many frames concurrently.
+    plan (list of SolveAttempt): solve with this plan of attempts (see solve_with_strategy and default_plan),
+                                 e.g. tight hints first, then wider, then blind, then the API. Each attempt names
+                                 its backend, so use_api, odds_to_solve and use_n_brightest_only are not used.
+    parallel_plan (bool): race the attempts of the plan, cancelling the others once one succeeds.
+    wcs_write_mode (str): 'update', 'in_place', 'sidecar' or 'atomic', see write_wcs_to_fits. 'in_place' and
+                          'sidecar' never rewrite the pixels, for large files or network filesystems, 'atomic'
+                          (and 'sidecar') are safe for concurrent readers.
+    metrics (SolveMetrics): if provided, records the time spent in each stage (extraction steps, solve-field or
+                            API calls, WCS write), the number of sources and retries, and the outcome.
+    solver_profile (SolverProfile or str): how to run solve-field (outputs, work dir, CPU and time limits),
+                                           or the name of one of solver_profiles. If None, 'lean'.
+                                           With an engine, only its timeout applies.
+    refine_catalog: a reference catalog covering the field ((ra, dec, mag) arrays, path, or QuadIndex, see
+                    refine_wcs). If provided, the solution is refined with all the sources matched to it
+                    (a higher order SIP fit), and the rms of the matches written to the header (PL-RMS).
+    refine_kwargs (dict): more arguments for refine_wcs, e.g. dict(sip_order=4, max_residual=3.). With
+                          max_residual, a solution whose refinement fails or is over it is rejected
+                          (CouldNotSolveError), otherwise the unrefined solution is kept.
+    before_write (callable): called with fits_file_path just before writing the solution. If it raises, nothing is
+                             written, e.g. LeaseDirectory.check when another worker took the frame over.
 
     Returns:
     WCS header if successful, None otherwise.
     """
+    if (extract_kwargs or {}).get('hdu', 0) != 0:
+        # the solution is written to the primary header, and the size of the image taken from there.
+        raise ValueError("plate_solve: only solves the primary HDU, use plate_solve_planes for the other extensions.")
 
     # default logger if none provided
     if logger is None:
@@ -45,40 +145,171 @@ def plate_solve(fits_file_path, sources=None, use_existing_wcs_as_guess=True,
             logger.addHandler(handler)
             logger.setLevel(logging.INFO)
 
-    # check, maybe we already solved it
-    header = fits.getheader(fits_file_path)
-    if not redo_if_done and 'PL-SLVED' in header:
-        logger.info(f"{fits_file_path} was already plate solved, no redoing.")
-        # we already treated it.
-        # the header contains the WCS info.
-        return header
-
-    if sources is None:
-        if do_debug_plot:
-            sourceplotpath = Path(fits_file_path).parent / f"{Path(fits_file_path).stem}_sources.jpeg"
-        else:
-            sourceplotpath = None
-
-        sources = extract_stars(fits_file_path, debug_plot_path=sourceplotpath)
-
-    if use_existing_wcs_as_guess:
-        with fits.open(fits_file_path) as hdul:
-            header = hdul[0].header
-            wcs_info = WCS(header)
-            if wcs_info.is_celestial:
-                ra_approx, dec_approx = wcs_info.wcs.crval
-                # in arcsec/pixel:
-                scale = 3600*(wcs_info.pixel_scale_matrix[0, 0]**2 + wcs_info.pixel_scale_matrix[0, 1]**2)**0.5
-                scale_min, scale_max = 0.8 * scale, 1.2 * scale
+    with outcome(metrics):
+        # check, maybe we already solved it
+        if solution_index is not None and not redo_if_done:
+            wcs = solution_index.get(fits_file_path)
+            if wcs is not None:
+                logger.info(f"{fits_file_path} is in the solution index, no redoing.")
+                return wcs
+
+        from .fits_io import FitsFrame, solved_wcs, write_wcs_to_fits
+
+        # the file is opened once, the WCS written once it is closed.
+        with FitsFrame(fits_file_path) as frame:
+            header = frame.header
+            done_wcs = None if redo_if_done else solved_wcs(fits_file_path, header)
+            if done_wcs is not None:
+                logger.info(f"{fits_file_path} was already plate solved, no redoing.")
+                if solution_index is not None:
+                    # solved before we had the index (or by another index), remember it.
+                    solution_index.record(fits_file_path, done_wcs, header=header)
+                # we already treated it.
+                # the header (or its sidecar) contains the WCS info.
+                return done_wcs
+
+            if sources is None:
+                with stage(metrics, 'extract'):
+                    sources = _extract(frame, do_debug_plot, extract_kwargs, source_cache, metrics)
 
+            if use_existing_wcs_as_guess:
+                from astropy.wcs import WCS
+                wcs_info = WCS(header)
+                if wcs_info.is_celestial:
+                    ra_approx, dec_approx, scale_min, scale_max = _guess_from_wcs(wcs_info)
+
+            if solution_index is not None and ra_approx is None and scale_min is None and scale_max is None:
+                hint = solution_index.hint(target=header.get('OBJECT'), instrument=header.get('INSTRUME'))
+                if hint is not None:
+                    ra_approx, dec_approx, scale = hint
+                    scale_min, scale_max = 0.8 * scale, 1.2 * scale
+                    if ra_approx is not None:
+                        logger.info(f"Using the latest solve of the same target as a guess for {fits_file_path}")
+                    else:
+                        logger.info(f"Using the pixel scale of the latest solve of the same instrument "
+                                    f"for {fits_file_path}")
+
+            start_time = time.time()
+            wcs = None
+            if tracker is not None and tracker.has_reference:
+                try:
+                    with stage(metrics, 'track'):
+                        wcs = tracker.track(sources)
+                    logger.info(f"{fits_file_path} solved by tracking the previous frame")
+                except CouldNotSolveError as e:
+                    logger.info(f"Tracking lost on {fits_file_path} ({e}), solving it.")
+                    # the previous frame still gives a good guess.
+                    ra_approx, dec_approx, scale_min, scale_max = _guess_from_wcs(tracker.wcs)
+
+            if wcs is None:
+                hints = dict(ra_approx=ra_approx, dec_approx=dec_approx, scale_min=scale_min, scale_max=scale_max)
+                with stage(metrics, 'solve'):
+                    wcs = _solve_with_backend(fits_file_path, sources, header, hints, use_n_brightest_only, use_api,
+                                              odds_to_solve, engine, quad_index, plan, parallel_plan, api_client,
+                                              logger, metrics, solver_profile)
+
+            if refine_catalog is not None:
+                with stage(metrics, 'refine'):
+                    wcs = _refine(fits_file_path, wcs, sources, header, refine_catalog, refine_kwargs, logger,
+                                  metrics)
+
+        if before_write is not None:
+            before_write(fits_file_path)
+        logger.info(f"{fits_file_path} solved, writing the WCS")
+        with stage(metrics, 'write_wcs'):
+            write_wcs_to_fits(fits_file_path, wcs, mode=wcs_write_mode)
+        if solution_index is not None:
+            solution_index.record(fits_file_path, wcs, header=header, solve_time=time.time() - start_time)
+        if tracker is not None:
+            tracker.update(wcs, sources)
+        return wcs
+
+
+def _solve_with_backend(fits_file_path, sources, header, hints, use_n_brightest_only, use_api, odds_to_solve,
+                        engine, quad_index, plan, parallel_plan, api_client, logger, metrics, solver_profile):
+    """
+    WCS of the frame from the backend selected by plate_solve's arguments, without writing it.
+    """
+    if quad_index is not None:
+        from .quad_solver import plate_solve_with_index
+        return plate_solve_with_index(fits_file_path, sources, quad_index, use_n_brightest_only=use_n_brightest_only,
+                                      write_to_file=False, header=header, metrics=metrics, **hints)
+    if plan is not None:
+        from .strategy import solve_with_strategy
+        return solve_with_strategy(fits_file_path, sources, plan=plan, parallel=parallel_plan,
+                                   api_client=api_client, write_to_file=False, header=header,
+                                   solver_profile=solver_profile, metrics=metrics, **hints)
     if use_api:
         if odds_to_solve is not None:
             logger.info('Parameter ignored: odds_to_solve not available with API solving')
-        return plate_solve_with_API(fits_file_path, sources, ra_approx=ra_approx, dec_approx=dec_approx,
-                                    scale_min=scale_min, scale_max=scale_max, use_n_brightest_only=use_n_brightest_only)
+        if api_client is not None:
+            return api_client.plate_solve(fits_file_path, sources, use_n_brightest_only=use_n_brightest_only,
+                                          write_to_file=False, header=header, metrics=metrics, **hints)
+        from .api_solver import plate_solve_with_API
+        return plate_solve_with_API(fits_file_path, sources, use_n_brightest_only=use_n_brightest_only,
+                                    write_to_file=False, header=header, metrics=metrics, **hints)
+    if odds_to_solve is None:
+        odds_to_solve = 1e6
+    if engine is not None:
+        return engine.plate_solve(fits_file_path, sources, use_n_brightest_only=use_n_brightest_only,
+                                  odds_to_solve=odds_to_solve, write_to_file=False, header=header, metrics=metrics,
+                                  profile=solver_profile, **hints)
+    from .local_solver import plate_solve_locally
+    return plate_solve_locally(fits_file_path, sources, use_n_brightest_only=use_n_brightest_only,
+                               odds_to_solve=odds_to_solve, write_to_file=False, header=header, metrics=metrics,
+                               profile=solver_profile, **hints)
+
+
+def _refine(fits_file_path, wcs, sources, header, refine_catalog, refine_kwargs, logger, metrics):
+    """
+    refine_wcs on a new solution, the unrefined one kept if that fails (unless rejecting, with max_residual).
+    """
+    from .refine import refine_wcs
+
+    refine_kwargs = refine_kwargs or {}
+    try:
+        refined, residuals = refine_wcs(wcs, sources, refine_catalog, header['NAXIS1'], header['NAXIS2'],
+                                        **refine_kwargs)
+    except CouldNotSolveError as e:
+        if refine_kwargs.get('max_residual') is not None:
+            raise
+        logger.warning(f"Could not refine the solution of {fits_file_path} ({e}), keeping it as is.")
+        return wcs
+    count(metrics, 'refine_matches', residuals.n_matched)
+    logger.info(f"{fits_file_path}: solution refined with {residuals.n_matched} stars, "
+                f"rms {residuals.rms_before:.2f} -> {residuals.rms:.2f} arcsec")
+    return refined
+
+
+def _extract(frame, do_debug_plot, extract_kwargs, source_cache, metrics):
+    """
+    Sources of the frame, from the cache if any, else extracted from the pixels already read.
+    """
+    from . import extract_stars
+
+    fits_file_path = frame.path
+    if do_debug_plot:
+        sourceplotpath = Path(fits_file_path).parent / f"{Path(fits_file_path).stem}_sources.jpeg"
     else:
-        if odds_to_solve is None:
-            odds_to_solve = 1e6
-        return plate_solve_locally(fits_file_path, sources, ra_approx=ra_approx, dec_approx=dec_approx,
-                                   scale_min=scale_min, scale_max=scale_max, use_n_brightest_only=use_n_brightest_only,
-                                   odds_to_solve=odds_to_solve)
+        sourceplotpath = None
+
+    if source_cache is not None:
+        return source_cache.get_or_extract(fits_file_path, debug_plot_path=sourceplotpath,
+                                           extract_kwargs=extract_kwargs)
+    extract_kwargs = extract_kwargs or {}
+    if extract_kwargs.get('tile_size') is not None or extract_kwargs.get('low_memory'):
+        # those read the file memory-mapped, piece by piece, rather than the whole image.
+        return extract_stars(fits_file_path, debug_plot_path=sourceplotpath, metrics=metrics, **extract_kwargs)
+    with stage(metrics, 'read'):
+        image = frame.data
+    return extract_stars(image, debug_plot_path=sourceplotpath, metrics=metrics, **extract_kwargs)
+
+
+def _guess_from_wcs(wcs_info):
+    """
+    Approximate pointing and a ±20% pixel scale range from an existing astropy WCS.
+    """
+    ra_approx, dec_approx = wcs_info.wcs.crval
+    # in arcsec/pixel:
+    scale = 3600*(wcs_info.pixel_scale_matrix[0, 0]**2 + wcs_info.pixel_scale_matrix[0, 1]**2)**0.5
+    return ra_approx, dec_approx, 0.8 * scale, 1.2 * scale
@@ -0,0 +1,297 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from astropy.io import fits
+from requests.adapters import HTTPAdapter
+
+from .exceptions import CouldNotSolveError, APIKeyNotFound
+from .fits_io import write_wcs_to_fits
+from .metrics import stage, count
+from .sources import as_source_list
+
+logger = logging.getLogger(__name__)
+
+
+class AstrometryNetClient:
+    """
+    asyncio client of the nova.astrometry.net API, for solving many frames at once.
+
+    plate_solve_with_API logs in for every frame and then waits for that one job to finish. Here, we log in once
+    and keep the HTTP session (and its pool of connections) for all frames; up to max_in_flight source lists are
+    submitted and polled concurrently, polling each job less and less often while it runs, and each WCS is written
+    to its frame as soon as its job succeeds.
+
+    From asyncio code:
+
+        client = AstrometryNetClient()
+        results = await client.solve_many([(f, extract_stars(f)) for f in files], scale_min=10, scale_max=15)
+
+    From regular (possibly multi-threaded) code, the client runs its own event loop in a thread:
+
+        with AstrometryNetClient() as client:
+            plate_solve(f, use_api=True, api_client=client)
+
+    The HTTP calls themselves are made with requests in a pool of threads, so that no other dependency is needed.
+    base_url can point to any server implementing the same API, e.g. a local stand-in for testing.
+    """
+
+    def __init__(self, api_key=None, base_url='http://nova.astrometry.net', max_in_flight=8,
+                 poll_interval=1., max_poll_interval=30., solve_timeout=600, request_timeout=60):
+        """
+        Parameters:
+        api_key (str): the astrometry.net API key. If None, read from the `astrometry_net_api_key` environment
+                       variable.
+        base_url (str): root of the server, the API being at base_url/api.
+        max_in_flight (int): maximum number of jobs submitted and not finished at any time.
+        poll_interval (float): seconds between the first status requests of a job.
+        max_poll_interval (float): the interval grows by half each poll, up to this.
+        solve_timeout (float): seconds after which a job is given up.
+        request_timeout (float): seconds to wait for each HTTP response.
+        """
+        if api_key is None:
+            if 'astrometry_net_api_key' not in os.environ:
+                raise APIKeyNotFound
+            api_key = os.environ['astrometry_net_api_key']
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.solve_timeout = solve_timeout
+        self.request_timeout = request_timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session_id = None
+        # blocking HTTP calls run there, one per job in flight plus one for logging in.
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight + 1)
+        self._in_flight = None
+        self._in_flight_loop = None
+        self._login_lock = None
+        self._loop = None
+        self._loop_thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def running(self):
+        return self._loop_thread is not None and self._loop_thread.is_alive()
+
+    def start(self):
+        """
+        Start the event loop thread, needed by the blocking methods (plate_solve, submit).
+        """
+        if self.running:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+
+    def close(self):
+        """
+        Stop the event loop thread if any, and close the HTTP session.
+        """
+        if self.running:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join()
+            self._loop.close()
+        self._loop = None
+        self._loop_thread = None
+        self._executor.shutdown()
+        self.session.close()
+
+    async def _call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: function(*args, **kwargs))
+
+    async def _request(self, method, path, **kwargs):
+        response = await self._call(self.session.request, method, f"{self.base_url}/{path}",
+                                    timeout=self.request_timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def _bind_to_running_loop(self):
+        # asyncio primitives belong to one loop: (re)create them for the loop we are running in.
+        loop = asyncio.get_running_loop()
+        if self._in_flight_loop is not loop:
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+            self._login_lock = asyncio.Lock()
+            self._in_flight_loop = loop
+
+    async def login(self):
+        """
+        Get a session from the API, once for all jobs.
+        """
+        self._bind_to_running_loop()
+        async with self._login_lock:
+            if self.session_id is not None:
+                return self.session_id
+            response = await self._request('POST', 'api/login',
+                                           data={'request-json': json.dumps({'apikey': self.api_key})})
+            result = response.json()
+            if result.get('status') != 'success':
+                raise CouldNotSolveError(f"AstrometryNetClient: could not log in ({result.get('errormessage')})")
+            self.session_id = result['session']
+            logger.info('AstrometryNetClient: logged in')
+        return self.session_id
+
+    async def solve(self, fits_file_path, sources, ra_approx=None, dec_approx=None,
+                    scale_min=None, scale_max=None, use_n_brightest_only=None, solution_index=None,
+                    search_radius=2., write_to_file=True, header=None, metrics=None):
+        """
+        Same as plate_solve_with_API, as a coroutine sharing this client's session.
+
+        Parameters:
+        fits_file_path (Path or str): Path to the FITS file.
+        sources (SourceList or astropy.table.Table): detected sources.
+        ra_approx (float): Approximate RA in degrees.
+        dec_approx (float): Approximate DEC in degrees.
+        scale_min (float): lowest pixel scale to consider in arcsec/pixel
+        scale_max (float): largest pixel scale to consider in arcsec/pixel
+        use_n_brightest_only (int): number of sources to consider. If None using all.
+        solution_index (SolutionIndex): if provided, record the solution there.
+        search_radius (float): radius around (ra_approx, dec_approx) to search, in degrees.
+        write_to_file (bool): write the WCS to the FITS file (and solution_index). If False, only return it.
+        header (astropy.io.fits.Header): primary header of the file, if already read (e.g. FitsFrame.header).
+        metrics (SolveMetrics): if provided, records the time spent logging in, submitting, polling and
+                                downloading the WCS (wall time only), and the number of status requests.
+
+        Returns:
+        WCS header if successful.
+        Also, updates the given fits file with the same WCS if successful.
+        """
+        self._bind_to_running_loop()
+        fits_file_path = Path(fits_file_path)
+        logger.info(f"AstrometryNetClient.solve on {fits_file_path}")
+        start_time = time.time()
+
+        if use_n_brightest_only is None:
+            use_n_brightest_only = len(sources)
+        if header is None:
+            header = await self._call(fits.getheader, fits_file_path)
+
+        x, y = as_source_list(sources).positions(use_n_brightest_only)
+        settings = {'x': x.tolist(), 'y': y.tolist(),
+                    'image_width': header['NAXIS1'], 'image_height': header['NAXIS2'],
+                    'publicly_visible': 'n'}
+        if ra_approx is not None and dec_approx is not None:
+            settings.update({'center_ra': ra_approx, 'center_dec': dec_approx, 'radius': search_radius})
+        if scale_min is not None and scale_max is not None:
+            settings.update({'scale_units': 'arcsecperpix', 'scale_type': 'ul',
+                             'scale_lower': scale_min, 'scale_upper': scale_max})
+
+        async with self._in_flight:
+            with stage(metrics, 'api_login', cpu=False):
+                settings['session'] = await self.login()
+            with stage(metrics, 'api_submit', cpu=False):
+                response = await self._request('POST', 'api/url_upload',
+                                               data={'request-json': json.dumps(settings)})
+            result = response.json()
+            if result.get('status') != 'success':
+                raise CouldNotSolveError(f"AstrometryNetClient: submission of {fits_file_path} refused "
+                                         f"({result.get('errormessage')})")
+            with stage(metrics, 'api_poll', cpu=False):
+                job_id = await self._wait_for_job(result['subid'], fits_file_path, metrics)
+            with stage(metrics, 'api_wcs_download', cpu=False):
+                response = await self._request('GET', f"wcs_file/{job_id}")
+
+        wcs = fits.Header.fromstring(response.text)
+        if len(wcs) == 0:
+            raise CouldNotSolveError('Astrometry.net failed! WCS empty. Try with different stars or a different image?')
+
+        if write_to_file:
+            logger.info(f"AstrometryNetClient: {fits_file_path} solved, writing the WCS")
+            await self._call(write_wcs_to_fits, fits_file_path, wcs)
+            if solution_index is not None:
+                await self._call(solution_index.record, fits_file_path, wcs, header=header,
+                                 solve_time=time.time() - start_time)
+        return wcs
+
+    async def _wait_for_job(self, submission_id, fits_file_path, metrics=None):
+        """
+        Poll a submission until its job succeeds, with a growing interval. Returns the job id.
+        """
+        start_time = time.time()
+        interval = self.poll_interval
+        job_id = None
+        while True:
+            await asyncio.sleep(interval)
+            count(metrics, 'api_polls')
+            if job_id is None:
+                response = await self._request('GET', f"api/submissions/{submission_id}")
+                jobs = [job for job in response.json().get('jobs', []) if job is not None]
+                if jobs:
+                    job_id = jobs[0]
+            if job_id is not None:
+                response = await self._request('GET', f"api/jobs/{job_id}")
+                status = response.json().get('status')
+                if status == 'success':
+                    return job_id
+                if status == 'failure':
+                    logger.info(f"AstrometryNetClient: could not plate solve {fits_file_path}")
+                    raise CouldNotSolveError('Astrometry.net failed! Try with different stars or a different image?')
+            if time.time() - start_time > self.solve_timeout:
+                raise CouldNotSolveError(f"AstrometryNetClient: timed out on {fits_file_path} "
+                                         f"(submission {submission_id})")
+            interval = min(1.5 * interval, self.max_poll_interval)
+
+    async def solve_many(self, frames, **solve_kwargs):
+        """
+        Solve many frames concurrently, at most max_in_flight jobs at a time.
+
+        Parameters:
+        frames (iterable): (fits_file_path, sources) pairs.
+        solve_kwargs: passed to `solve` for each frame (scale_min, ra_approx, ...)
+
+        Returns:
+        list of BatchResult, in the same order as the frames.
+        """
+        from .batch import BatchResult
+
+        frames = list(frames)
+
+        async def solve_one(fits_file_path, sources):
+            try:
+                return BatchResult(fits_file_path, await self.solve(fits_file_path, sources, **solve_kwargs), None)
+            except Exception as e:
+                logger.info(f"AstrometryNetClient: failed on {fits_file_path} ({e})")
+                return BatchResult(fits_file_path, None, e)
+
+        return await asyncio.gather(*[solve_one(fits_file_path, sources) for fits_file_path, sources in frames])
+
+    def submit(self, fits_file_path, sources, **solve_kwargs):
+        """
+        Queue a frame for solving from regular code.
+
+        Returns:
+        concurrent.futures.Future, resolving to the WCS header.
+        """
+        if not self.running:
+            raise RuntimeError('AstrometryNetClient: not started, use it as a context manager or call start().')
+        return asyncio.run_coroutine_threadsafe(self.solve(fits_file_path, sources, **solve_kwargs), self._loop)
+
+    def plate_solve(self, fits_file_path, sources, ra_approx=None, dec_approx=None,
+                    scale_min=None, scale_max=None, use_n_brightest_only=None, solution_index=None,
+                    search_radius=2., write_to_file=True, header=None, metrics=None):
+        """
+        Same as plate_solve_with_API, blocking, but sharing this client's session with the other threads.
+        See solve for the parameters.
+        """
+        return self.submit(fits_file_path, sources, ra_approx=ra_approx, dec_approx=dec_approx,
+                           scale_min=scale_min, scale_max=scale_max, use_n_brightest_only=use_n_brightest_only,
+                           solution_index=solution_index, search_radius=search_radius, write_to_file=write_to_file,
+                           header=header, metrics=metrics).result()
@@ -10,17 +10,22 @@ from astropy.io import fits
 import requests
 import json
 import os
+import time
 from astroquery.astrometry_net import AstrometryNet
 import logging
 
 from .exceptions import CouldNotSolveError, APIKeyNotFound
+from .fits_io import write_wcs_to_fits
+from .metrics import stage
+from .sources import as_source_list
 
 logger = logging.getLogger(__name__)
 
 
 def plate_solve_with_API(fits_file_path, sources,
                          ra_approx=None, dec_approx=None,
-                         scale_min=None, scale_max=None, use_n_brightest_only=None):
+                         scale_min=None, scale_max=None, use_n_brightest_only=None, solution_index=None,
+                         search_radius=2., timeout=None, write_to_file=True, header=None, metrics=None):
     """
     Calculate the WCS using the nova.astrometry.net API.
     In this case, we first extract the sources and only send those over
@@ -29,13 +34,19 @@ def plate_solve_with_API(fits_file_path, sources,
 
     Parameters:
     fits_file_path (str): Path to the FITS file.
-    sources (astropy.table.Table): Table of detected sources.
+    sources (SourceList or astropy.table.Table): detected sources.
     ra_approx: float in degrees, approximate center of the field coord
     dec_approx: float in degrees, approximate center of the field coord
     scale_min (float): lowest pixel scale to consider in arcsec/pixel
     scale_max (float): largest pixel scale to consider in arcsec/pixel
     use_n_brightest_only (int): number of sources to consider. If None using all.
     redo_if_done (bool): redo even if our solved keyword is already in the header?
+    solution_index (SolutionIndex): if provided, record the solution there.
+    search_radius (float): radius around (ra_approx, dec_approx) to search, in degrees.
+    timeout (float): seconds to wait for the job. If None, astroquery's default.
+    write_to_file (bool): write the WCS to the FITS file (and solution_index). If False, only return it.
+    header (astropy.io.fits.Header): primary header of the file, if already read (e.g. FitsFrame.header).
+    metrics (SolveMetrics): if provided, records the time spent logging in and solving (submission and polling).
 
     Returns:
     WCS header if successful, None otherwise.
@@ -49,20 +60,22 @@ def plate_solve_with_API(fits_file_path, sources,
         use_n_brightest_only = len(sources)
 
     logger.info(f"plate_solve_with_API on {fits_file_path}")
+    start_time = time.time()
 
-    # unpack the positions
-    tupledetections = [(star['xcentroid'], star['ycentroid']) for star in sources[:use_n_brightest_only]]
-    x, y = list(zip(*tupledetections))
+    # the positions of the brightest
+    x, y = as_source_list(sources).positions(use_n_brightest_only)
 
     # create a session
-    R = requests.post('http://nova.astrometry.net/api/login',
-                      data={'request-json': json.dumps({"apikey": os.environ['astrometry_net_api_key']})})
+    with stage(metrics, 'api_login'):
+        R = requests.post('http://nova.astrometry.net/api/login',
+                          data={'request-json': json.dumps({"apikey": os.environ['astrometry_net_api_key']})})
 
     ast = AstrometryNet()
     ast._session_id = R.json()['session']
 
     # the dimensions of the image...
-    header = fits.getheader(fits_file_path)
+    if header is None:
+        header = fits.getheader(fits_file_path)
     nx, ny = header['NAXIS1'], header['NAXIS2']
 
     # can we make the solver find the solution faster?
@@ -71,16 +84,19 @@ def plate_solve_with_API(fits_file_path, sources,
     if ra_approx is not None and dec_approx is not None:
         morekwargs['center_ra'] = ra_approx
         morekwargs['center_dec'] = dec_approx
-        morekwargs['radius'] = 2.
-    try:
+        morekwargs['radius'] = search_radius
+    if scale_min is not None and scale_max is not None:
         scale_est = 0.5 * (scale_max + scale_min)
-        scale_err = 100 * abs(scale_max - scale_min) / scale_est  # in %
-        wcs = ast.solve_from_source_list(x, y, nx, ny,
-                                         scale_est=scale_est,
-                                         scale_err=scale_err,
-                                         scale_units='arcsecperpix',
-                                         publicly_visible='n',
-                                         **morekwargs)
+        morekwargs['scale_est'] = scale_est
+        morekwargs['scale_err'] = 100 * abs(scale_max - scale_min) / scale_est  # in %
+        morekwargs['scale_units'] = 'arcsecperpix'
+    if timeout is not None:
+        morekwargs['solve_timeout'] = timeout
+    try:
+        with stage(metrics, 'api_solve'):
+            wcs = ast.solve_from_source_list(x.tolist(), y.tolist(), nx, ny,
+                                             publicly_visible='n',
+                                             **morekwargs)
     except Exception as e:
         # anything ...
         logger.info(f"plate_solve_with_API: something went wrong ({e}) with API when trying to solve {fits_file_path}")
@@ -98,13 +114,11 @@ def plate_solve_with_API(fits_file_path, sources,
 
     # else, we're probably fine. Like, 99.9% confidence from my
     # experience with astrometry.net's plate solver.
-    logger.info(f"plate_solve_with_API: {fits_file_path} solved, writing the WCS")
-    with fits.open(fits_file_path, mode="update") as hdul:
-        # little flag to indicate that we plate solved this file:
-        wcs['PL-SLVED'] = 'done'
-        # add all this info to the file:
-        hdul[0].header.update(wcs)
-        hdul.flush()
+    if write_to_file:
+        logger.info(f"plate_solve_with_API: {fits_file_path} solved, writing the WCS")
+        write_wcs_to_fits(fits_file_path, wcs)
+        if solution_index is not None:
+            solution_index.record(fits_file_path, wcs, header=header, solve_time=time.time() - start_time)
     return wcs
 
 
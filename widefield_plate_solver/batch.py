@@ -0,0 +1,205 @@
+import glob
+import logging
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+# through the package: the extract_stars module must not be the first to bind its name there.
+from . import extract_stars, ExtractionBuffers
+from .fits_io import solved_wcs
+from .metrics import SolveMetrics, stage
+
+logger = logging.getLogger(__name__)
+
+
+BatchResult = namedtuple('BatchResult', ['fits_file_path', 'wcs', 'error'])
+BatchResult.__doc__ = """
+Outcome of one frame of a batch: `wcs` is the WCS header if solved (None otherwise),
+`error` the exception that stopped this frame (None if it went fine).
+"""
+
+
+def expand_fits_file_paths(fits_file_paths):
+    """
+    Turn a glob pattern, a path, or a list of those into a flat list of paths.
+
+    Parameters:
+    fits_file_paths (str, Path or list): e.g. "night/*.fits" or ["a.fits", "night2/*.fits"]
+
+    Returns:
+    list of str, in the order given (each glob sorted).
+    """
+    if isinstance(fits_file_paths, (str, Path)):
+        fits_file_paths = [fits_file_paths]
+
+    expanded = []
+    for path in fits_file_paths:
+        path = str(path)
+        if glob.has_magic(path):
+            expanded += sorted(glob.glob(path))
+        else:
+            expanded.append(path)
+    return expanded
+
+
+# in each extraction process, low memory buffers reused from frame to frame.
+_worker_buffers = None
+
+
+def _extract_worker(fits_file_path, redo_if_done, do_debug_plot, extract_kwargs, source_cache, with_metrics=False):
+    """
+    Runs in a worker process: source extraction only, the CPU-bound part of the pipeline.
+    Returns ('done', header, None) if the frame was already solved, ('sources', sources, metrics) otherwise,
+    metrics being the SolveMetrics of the extraction if with_metrics.
+    """
+    global _worker_buffers
+    extract_kwargs = dict(extract_kwargs or {})
+    if extract_kwargs.get('low_memory') and extract_kwargs.get('buffers') is None:
+        if _worker_buffers is None:
+            _worker_buffers = ExtractionBuffers()
+        extract_kwargs['buffers'] = _worker_buffers
+
+    if not redo_if_done:
+        wcs = solved_wcs(fits_file_path)
+        if wcs is not None:
+            return 'done', wcs, None
+
+    if do_debug_plot:
+        sourceplotpath = Path(fits_file_path).parent / f"{Path(fits_file_path).stem}_sources.jpeg"
+    else:
+        sourceplotpath = None
+    metrics = SolveMetrics(fits_file_path) if with_metrics else None
+    with stage(metrics, 'extract'):
+        if source_cache is not None:
+            sources = source_cache.get_or_extract(fits_file_path, debug_plot_path=sourceplotpath,
+                                                  extract_kwargs=extract_kwargs)
+        else:
+            sources = extract_stars(fits_file_path, debug_plot_path=sourceplotpath, metrics=metrics, **extract_kwargs)
+    return 'sources', sources, metrics
+
+
+def plate_solve_many(fits_file_paths, n_workers=None, n_solvers=None, max_in_flight=None,
+                     redo_if_done=False, do_debug_plot=False, extract_kwargs=None, source_cache=None,
+                     solution_index=None, metrics_callback=None, **plate_solve_kwargs):
+    """
+    Plate solve a batch of FITS files (e.g., a whole night of frames).
+
+    Source extraction (CPU-bound) runs in a pool of processes, while the solving step
+    (a solve-field subprocess or a request to the API) runs in a pool of threads, so
+    that extracting the next frames overlaps with solving the previous ones.
+    A frame that fails does not stop the batch, its error is reported in its result. If an extraction process
+    dies (e.g. killed for using too much memory), the frames it was extracting fail with a BrokenProcessPool error
+    and the next ones are extracted by a new pool.
+
+    Parameters:
+    fits_file_paths (str, Path or list): paths or glob patterns of the FITS files.
+    n_workers (int): number of extraction processes. If None, number of CPUs.
+    n_solvers (int): number of concurrent solves. If None, same as n_workers.
+    max_in_flight (int): maximum number of frames extracted or being solved at any time,
+                         bounds the memory used by sources waiting to be solved. If None, 2 * n_workers.
+    redo_if_done (bool): Redo even if our solved keyword is already in the header?
+    do_debug_plot (bool): will dump an image of the extracted sources next to each frame.
+    extract_kwargs (dict): more arguments for extract_stars, e.g. dict(tile_size=2048).
+                           With low_memory=True, each process reuses its buffers from frame to frame.
+                           Only the primary HDU is solved: for the other extensions, use plate_solve_planes.
+    source_cache (SourceCache): look for the sources of each frame in this cache before extracting them.
+    solution_index (SolutionIndex): frames found there are not even opened, new solutions are recorded there.
+    metrics_callback (callable): if provided, each frame's solve is measured (see SolveMetrics, its extraction
+                                 included) and passed to this callback, e.g. a MetricsRecorder.
+    plate_solve_kwargs: passed to `plate_solve` for each frame (use_api, scale_min, ...)
+
+    Returns:
+    list of BatchResult, in the same order as the input files.
+    """
+    # imported here as the package's __init__ imports us.
+    from . import plate_solve
+
+    if (extract_kwargs or {}).get('hdu', 0) != 0:
+        raise ValueError("plate_solve_many: only solves the primary HDU, use plate_solve_planes for the other "
+                         "extensions.")
+    fits_file_paths = expand_fits_file_paths(fits_file_paths)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_solvers is None:
+        n_solvers = n_workers
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+
+    logger.info(f"plate_solve_many: {len(fits_file_paths)} files, {n_workers} extraction workers, "
+                f"{n_solvers} solvers, at most {max_in_flight} frames in flight")
+
+    results = [None] * len(fits_file_paths)
+    to_solve = list(range(len(fits_file_paths)))
+    if solution_index is not None and not redo_if_done:
+        unsolved = set(solution_index.unsolved(fits_file_paths))
+        to_solve = [index for index in to_solve if fits_file_paths[index] in unsolved]
+        for index in set(range(len(fits_file_paths))) - set(to_solve):
+            results[index] = BatchResult(fits_file_paths[index], solution_index.get(fits_file_paths[index]), None)
+        logger.info(f"plate_solve_many: {len(fits_file_paths) - len(to_solve)} files already in the solution index")
+
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    extractors = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=n_solvers) as solvers:
+
+            def solve(index, extraction_future):
+                fits_file_path = fits_file_paths[index]
+                try:
+                    kind, content, extraction_metrics = extraction_future.result()
+                    if kind == 'done':
+                        logger.info(f"{fits_file_path} was already plate solved, no redoing.")
+                        wcs = content
+                        if solution_index is not None:
+                            solution_index.record(fits_file_path, wcs, header=wcs)
+                    else:
+                        metrics = None
+                        if metrics_callback is not None:
+                            metrics = SolveMetrics(fits_file_path, callback=metrics_callback)
+                            metrics.merge(extraction_metrics)
+                        wcs = plate_solve(fits_file_path, sources=content, redo_if_done=True,
+                                          solution_index=solution_index, metrics=metrics, **plate_solve_kwargs)
+                    results[index] = BatchResult(fits_file_path, wcs, None)
+                except Exception as e:
+                    logger.info(f"plate_solve_many: failed on {fits_file_path} ({e})")
+                    results[index] = BatchResult(fits_file_path, None, e)
+                finally:
+                    in_flight.release()
+
+            def on_extracted(index, extraction_future):
+                # don't block the callback thread of the process pool with the solve itself.
+                solvers.submit(solve, index, extraction_future)
+
+            def submit_extraction(fits_file_path):
+                return extractors.submit(_extract_worker, fits_file_path, redo_if_done, do_debug_plot,
+                                         extract_kwargs, source_cache, metrics_callback is not None)
+
+            for index in to_solve:
+                fits_file_path = fits_file_paths[index]
+                in_flight.acquire()
+                try:
+                    try:
+                        future = submit_extraction(fits_file_path)
+                    except BrokenProcessPool as e:
+                        # the frames of the dead process already have this error, go on with a new pool.
+                        logger.warning(f"plate_solve_many: an extraction process died ({e}), starting new ones")
+                        extractors.shutdown(wait=False)
+                        extractors = ProcessPoolExecutor(max_workers=n_workers)
+                        future = submit_extraction(fits_file_path)
+                except Exception as e:
+                    logger.info(f"plate_solve_many: could not extract {fits_file_path} ({e})")
+                    results[index] = BatchResult(fits_file_path, None, e)
+                    in_flight.release()
+                    continue
+                future.add_done_callback(lambda f, i=index: on_extracted(i, f))
+
+            # wait for the last frames to go through both stages.
+            for _ in range(max_in_flight):
+                in_flight.acquire()
+    finally:
+        extractors.shutdown()
+
+    return results
@@ -0,0 +1,412 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .batch import BatchResult, expand_fits_file_paths
+from .exceptions import LeaseLostError
+from .fits_io import solved_wcs
+
+logger = logging.getLogger(__name__)
+
+
+Lease = namedtuple('Lease', ['fits_file_path', 'owner', 'attempt', 'acquired', 'age'])
+Lease.__doc__ = """
+A frame being solved by a worker: `owner` is the worker id, `attempt` counts the workers that took it
+(more than 1 if taken over from dead ones), `acquired` is when (unix time), and `age` the seconds since
+its last heartbeat.
+"""
+
+
+def _read_json(path):
+    with open(path) as f:
+        content = f.read()
+    # a lease just created, its content not written yet.
+    return json.loads(content) if content else {}
+
+
+class LeaseDirectory:
+    """
+    Frames shared between workers, on one or several nodes, through a directory on the shared storage (e.g. NFS):
+    each frame is solved by a single worker, and the frames of a worker that died are taken over by the others.
+
+    For each frame, the directory holds <frame name>.<hash of its path>.lease while a worker solves it, then .done
+    or .failed once it is over:
+
+    - a lease is taken by creating its file with O_EXCL, which only one worker can do (NFS v3 and later too),
+    - its owner renews it (its modification time) every heartbeat_interval seconds from a background thread,
+    - a lease not renewed for lease_timeout seconds belongs to a dead worker: it is renamed away (only one of the
+      workers trying to gets it) and taken again. A frame taken from dead workers max_attempts times (e.g. one that
+      crashes them) is marked failed instead.
+
+    The ages are measured with the clock of the storage (the modification time of a file touched for that), so the
+    clocks of the nodes do not need to agree. The same frame must have the same path on all the nodes.
+
+        with LeaseDirectory('/archive/night/.leases') as leases:
+            if leases.acquire(path) == 'acquired':
+                wcs = plate_solve(path, before_write=leases.check)
+                leases.finish(path)
+    """
+
+    def __init__(self, directory, worker_id=None, lease_timeout=300., heartbeat_interval=None, max_attempts=3):
+        """
+        Parameters:
+        directory (Path or str): the lease directory, created if needed. Give the same one to all the workers.
+        worker_id (str): name of this worker in the leases. Default: host name, process id and a random suffix.
+        lease_timeout (float): seconds without heartbeat after which a lease is considered abandoned.
+        heartbeat_interval (float): seconds between two renewals of our leases. Default: lease_timeout / 5.
+        max_attempts (int): number of workers that may take a frame before it is marked failed.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._token = uuid.uuid4().hex[:8]
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{self._token}"
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = lease_timeout / 5 if heartbeat_interval is None else heartbeat_interval
+        if self.heartbeat_interval >= lease_timeout:
+            raise ValueError("LeaseDirectory: heartbeat_interval must be shorter than lease_timeout")
+        self.max_attempts = max_attempts
+        self._clock_path = self.directory / f".clock.{self._token}"
+        # our leases: key -> path of the lease file.
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat_thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Stop the heartbeats, and release the leases still held (frames not finished), for the others to take.
+        """
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+        for key in list(self._held):
+            self._drop(key)
+        self._clock_path.unlink(missing_ok=True)
+
+    def _key(self, fits_file_path):
+        digest = hashlib.sha1(os.path.abspath(fits_file_path).encode()).hexdigest()[:12]
+        return f"{Path(fits_file_path).name}.{digest}"
+
+    def _path(self, key, kind):
+        return self.directory / f"{key}.{kind}"
+
+    def _now(self):
+        """
+        Current time according to the storage: the modification time of a file we touch.
+        """
+        try:
+            os.utime(self._clock_path)
+        except FileNotFoundError:
+            self._clock_path.touch()
+        return self._clock_path.stat().st_mtime
+
+    def _finished(self, key, retry_failed):
+        if self._path(key, 'done').exists():
+            return 'done'
+        if not retry_failed and self._path(key, 'failed').exists():
+            return 'failed'
+        return None
+
+    def acquire(self, fits_file_path, retry_failed=False):
+        """
+        Try to take a frame.
+
+        Parameters:
+        fits_file_path (Path or str): the frame.
+        retry_failed (bool): take it even if a worker failed on it.
+
+        Returns:
+        'acquired' if it is ours to solve now (renewed until finish or release), 'leased' if another worker is
+        solving it, 'done' or 'failed' if it is over.
+        """
+        key = self._key(fits_file_path)
+        finished = self._finished(key, retry_failed)
+        if finished is not None:
+            return finished
+        lease_path = self._path(key, 'lease')
+        attempt = 1
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            expired = self._take_expired(lease_path)
+            if expired is None:
+                return 'leased'
+            attempt = expired.get('attempt', 0) + 1
+            if attempt > self.max_attempts:
+                logger.warning(f"LeaseDirectory: {fits_file_path} abandoned by {attempt - 1} workers, giving up")
+                self._write_marker(key, 'failed', fits_file_path, f"abandoned by {attempt - 1} workers")
+                return 'failed'
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                return 'leased'
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'fits_file_path': str(fits_file_path), 'owner': self.worker_id, 'attempt': attempt,
+                       'acquired': time.time()}, f)
+
+        # finished by another worker between our look and our lease (it marks it finished before releasing it).
+        finished = self._finished(key, retry_failed)
+        if finished is not None:
+            lease_path.unlink(missing_ok=True)
+            return finished
+        with self._lock:
+            self._held[key] = lease_path
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='lease-heartbeat',
+                                                          daemon=True)
+                self._heartbeat_thread.start()
+        return 'acquired'
+
+    def _take_expired(self, lease_path):
+        """
+        Remove a lease if it expired.
+
+        Returns:
+        the content of the expired lease (dict, empty if it was released meanwhile), None if it is still alive.
+        """
+        try:
+            mtime = lease_path.stat().st_mtime
+        except FileNotFoundError:
+            # released meanwhile.
+            return {}
+        if self._now() - mtime < self.lease_timeout:
+            return None
+        # of the workers seeing it expired, only one renames it.
+        expired_path = lease_path.with_name(f"{lease_path.name}.{self._token}.expired")
+        try:
+            os.rename(lease_path, expired_path)
+        except FileNotFoundError:
+            return {}
+        if self._now() - expired_path.stat().st_mtime < self.lease_timeout:
+            # renewed, or taken again by another worker, since we looked: put it back.
+            try:
+                os.link(expired_path, lease_path)
+            except OSError:
+                pass
+            expired_path.unlink()
+            return None
+        try:
+            expired = _read_json(expired_path)
+        except (OSError, ValueError):
+            expired = {}
+        expired_path.unlink()
+        logger.warning(f"LeaseDirectory: lease of {expired.get('owner')} on {expired.get('fits_file_path')} "
+                       f"expired, taking the frame over")
+        return expired
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            self.renew()
+
+    def renew(self):
+        """
+        Renew all our leases (done by the heartbeat thread).
+        """
+        with self._lock:
+            lease_paths = list(self._held.values())
+        for lease_path in lease_paths:
+            try:
+                os.utime(lease_path)
+            except FileNotFoundError:
+                # check() tells whether it was taken over.
+                logger.info(f"LeaseDirectory: could not renew {lease_path.name}, it is gone")
+
+    def check(self, fits_file_path):
+        """
+        Raise LeaseLostError if our lease on the frame was taken over, e.g. before writing its solution.
+        """
+        try:
+            owner = _read_json(self._path(self._key(fits_file_path), 'lease')).get('owner')
+        except (FileNotFoundError, ValueError):
+            owner = None
+        if owner != self.worker_id:
+            raise LeaseLostError(f"LeaseDirectory: our lease on {fits_file_path} expired and was taken over"
+                                 + (f" by {owner}" if owner else ''))
+
+    def finish(self, fits_file_path, error=None):
+        """
+        Mark the frame done (or failed, with the error), and release it.
+        """
+        key = self._key(fits_file_path)
+        if error is None:
+            self._write_marker(key, 'done', fits_file_path)
+            self._path(key, 'failed').unlink(missing_ok=True)
+        else:
+            self._write_marker(key, 'failed', fits_file_path, str(error))
+        self._drop(key)
+
+    def release(self, fits_file_path):
+        """
+        Release the frame unfinished, for another worker to take it right away.
+        """
+        self._drop(self._key(fits_file_path))
+
+    def _drop(self, key):
+        with self._lock:
+            lease_path = self._held.pop(key, None)
+        if lease_path is None:
+            return
+        try:
+            if _read_json(lease_path).get('owner') == self.worker_id:
+                lease_path.unlink()
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def _write_marker(self, key, kind, fits_file_path, error=None):
+        entry = {'fits_file_path': str(fits_file_path), 'owner': self.worker_id, 'finished': time.time(),
+                 'error': error}
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, prefix='.', suffix='.tmp', delete=False) as f:
+            json.dump(entry, f)
+        os.replace(f.name, self._path(key, kind))
+
+    def leases(self):
+        """
+        The frames being solved, by any worker.
+
+        Returns:
+        list of Lease.
+        """
+        now = self._now()
+        leases = []
+        for lease_path in self.directory.glob('*.lease'):
+            try:
+                age = now - lease_path.stat().st_mtime
+                content = _read_json(lease_path)
+            except (FileNotFoundError, ValueError):
+                continue
+            leases.append(Lease(content.get('fits_file_path'), content.get('owner'), content.get('attempt'),
+                                content.get('acquired'), age))
+        return leases
+
+
+def solve_distributed(fits_file_paths, lease_dir, worker_id=None, n_solvers=1, lease_timeout=300.,
+                      heartbeat_interval=None, poll_interval=None, max_attempts=3, retry_failed=False,
+                      redo_if_done=False, wait_for_others=True, stop_event=None, metrics_callback=None,
+                      wcs_write_mode='atomic', **plate_solve_kwargs):
+    """
+    Plate solve a list of frames together with the other workers given the same list and lease_dir, in other
+    processes or on other nodes sharing the storage: each frame is solved by only one of them (see LeaseDirectory),
+    and those of a worker that died are solved by the others once its leases expired.
+
+    Run the same call (or command line, with --lease_dir) on every node. Each worker goes through the list, taking
+    the frames no one took yet. Once there are none left, it waits for the frames of the other workers, until they
+    are done or their lease expires (then it takes them over), unless wait_for_others is False.
+    The solutions are written with wcs_write_mode='atomic' by default: the other nodes reading a frame (e.g. to
+    see whether it is solved) never see a header being written. A frame taken over meanwhile is not written.
+
+        # on each node:
+        solve_distributed('/archive/night/*.fits', '/archive/night/.leases', n_solvers=4, use_api=False)
+
+    Parameters:
+    fits_file_paths (str, Path or list): paths or glob patterns of the FITS files, the same on all the nodes.
+    lease_dir (Path or str): directory of the leases, on the shared storage. A frame marked done there is not solved
+                             again, even with redo_if_done: use a new directory to solve the frames again.
+    worker_id (str): name of this worker in the leases, default host name and process id.
+    n_solvers (int): number of frames solved at the same time by this worker.
+    lease_timeout (float): seconds without heartbeat after which the frame of a worker is taken over.
+                           Longer than the pauses of a busy node, shorter than the delay you accept for a dead one.
+    heartbeat_interval (float): seconds between two renewals of the leases, default lease_timeout / 5.
+    poll_interval (float): seconds between two looks at the frames of the other workers, default lease_timeout / 4.
+    max_attempts (int): number of workers that may take a frame (after the previous one died) before it is
+                        marked failed.
+    retry_failed (bool): try again the frames marked failed in lease_dir.
+    redo_if_done (bool): Redo even if our solved keyword is already in the header?
+    wait_for_others (bool): once no frame is left to take, wait for those of the other workers (and take them over
+                            if they die). If False, return right away.
+    stop_event (threading.Event): set it to stop: the frames being solved are finished, no new ones are taken.
+    metrics_callback (callable): if provided, each frame's solve is measured (see SolveMetrics) and passed to
+                                 this callback, e.g. a MetricsRecorder.
+    wcs_write_mode (str): how to write the solutions, see write_wcs_to_fits.
+    plate_solve_kwargs: passed to plate_solve for each frame (use_api, scale_min, ...). A solution_index should
+                        be local to the worker: SQLite locking is not reliable over NFS.
+
+    Returns:
+    list of BatchResult, of the frames this worker solved or failed on, in the order it took them.
+    """
+    # imported here as the package's __init__ imports us.
+    from . import plate_solve
+    from .metrics import SolveMetrics
+
+    fits_file_paths = expand_fits_file_paths(fits_file_paths)
+    if poll_interval is None:
+        poll_interval = lease_timeout / 4
+    if stop_event is None:
+        stop_event = threading.Event()
+
+    # frames to look at, and frames other workers are solving (looked at again every poll_interval).
+    pending = deque(fits_file_paths)
+    leased = []
+    # with retry_failed, only the frames that failed before: not those another worker just failed on.
+    seen_leased = set()
+    lock = threading.Lock()
+    results = []
+
+    with LeaseDirectory(lease_dir, worker_id=worker_id, lease_timeout=lease_timeout,
+                        heartbeat_interval=heartbeat_interval, max_attempts=max_attempts) as leases:
+        logger.info(f"solve_distributed: {len(fits_file_paths)} files, worker {leases.worker_id}, "
+                    f"{n_solvers} solvers, leases in {lease_dir}")
+
+        def take():
+            while not stop_event.is_set():
+                with lock:
+                    while pending and not stop_event.is_set():
+                        path = pending.popleft()
+                        status = leases.acquire(path, retry_failed=retry_failed and path not in seen_leased)
+                        if status == 'acquired':
+                            return path
+                        if status == 'leased':
+                            leased.append(path)
+                            seen_leased.add(path)
+                    if not leased or not wait_for_others:
+                        return None
+                    pending.extend(leased)
+                    leased.clear()
+                stop_event.wait(poll_interval)
+            return None
+
+        def solve(path):
+            try:
+                wcs = None if redo_if_done else solved_wcs(path)
+                if wcs is not None:
+                    logger.info(f"{path} was already plate solved, no redoing.")
+                else:
+                    metrics = None if metrics_callback is None else SolveMetrics(path, callback=metrics_callback)
+                    wcs = plate_solve(path, redo_if_done=True, metrics=metrics, before_write=leases.check,
+                                      wcs_write_mode=wcs_write_mode, **plate_solve_kwargs)
+            except LeaseLostError as e:
+                logger.warning(f"solve_distributed: {e}, not writing its solution")
+                leases.release(path)
+                return BatchResult(path, None, e)
+            except Exception as e:
+                logger.info(f"solve_distributed: failed on {path} ({e})")
+                leases.finish(path, error=e)
+                return BatchResult(path, None, e)
+            leases.finish(path)
+            return BatchResult(path, wcs, None)
+
+        def solver():
+            while (path := take()) is not None:
+                result = solve(path)
+                with lock:
+                    results.append(result)
+
+        with ThreadPoolExecutor(max_workers=n_solvers, thread_name_prefix='solve_distributed') as solvers:
+            for future in [solvers.submit(solver) for _ in range(n_solvers)]:
+                future.result()
+
+    return results
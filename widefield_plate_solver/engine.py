@@ -0,0 +1,299 @@
+import importlib.util
+import json
+import logging
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from .exceptions import CouldNotSolveError
+from .fits_io import write_wcs_to_fits
+from .local_solver import default_profile, solver_profiles, write_xylist
+from .metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+class SolverEngine:
+    """
+    A long-lived solver process that keeps the astrometry.net index files loaded between frames.
+
+    Starting solve-field for every frame means loading the index files for every frame, which for
+    a wide-field mixture of the 4100 and 5200 series costs more than the solve itself.
+    Here, one engine process is started once, and xylists are sent to it over a pipe.
+
+    The engine speaks JSON lines over its stdin/stdout:
+    - once its indexes are loaded, it prints {"ready": true},
+    - then for each request {"id": ..., "xylist": ..., "wcs": ..., "width": ..., "height": ...,
+      "ra": ..., "dec": ..., "radius": ..., "scale_min": ..., "scale_max": ..., "odds_to_solve": ...}
+      it writes the solution as a FITS header at the "wcs" path (if any) and replies
+      {"id": ..., "solved": true/false, "error": null or "message"}.
+    By default this is `python -m widefield_plate_solver.engine_worker` with the given index files,
+    any other executable following the protocol can be given as engine_command.
+
+    Jobs are queued and sent to the engine one at a time. If the engine crashes or a job times out,
+    the engine is restarted and the job is failed with CouldNotSolveError, the next jobs go through the new engine.
+
+    Use as a context manager:
+
+        with SolverEngine(index_files=sorted(Path('/data/astrometry').glob('index-*.fits'))) as engine:
+            for f in files:
+                plate_solve(f, engine=engine, use_api=False)
+    """
+
+    def __init__(self, engine_command=None, index_files=None, job_timeout=300, startup_timeout=600):
+        """
+        Parameters:
+        engine_command (list of str): command starting the engine. If None, uses our engine_worker
+                                      with the index_files, which needs the `astrometry` package
+                                      (the `engine` extra of this package).
+        index_files (list of Path or str): index files to load, if using the default engine.
+        job_timeout (float): seconds after which a job is considered hopeless and the engine restarted.
+        startup_timeout (float): seconds to wait for the engine to load its indexes.
+        """
+        if engine_command is None:
+            if not index_files:
+                raise ValueError('SolverEngine: need either an engine_command or index_files.')
+            if importlib.util.find_spec('astrometry') is None:
+                raise ImportError("SolverEngine: the default engine needs the astrometry python bindings, "
+                                  "pip install 'widefield_plate_solver[engine]' (or give an engine_command).")
+            engine_command = [sys.executable, '-m', 'widefield_plate_solver.engine_worker']
+            engine_command += [str(index_file) for index_file in index_files]
+        self.engine_command = [str(c) for c in engine_command]
+        self.job_timeout = job_timeout
+        self.startup_timeout = startup_timeout
+
+        self.process = None
+        self.n_restarts = 0
+        self._jobs = queue.Queue()
+        self._replies = None
+        self._dispatcher = None
+        self._job_counter = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def running(self):
+        return self._dispatcher is not None and self._dispatcher.is_alive()
+
+    def start(self):
+        """
+        Start the engine process and wait until it has loaded its indexes.
+        """
+        if self.running:
+            return
+        self._start_process()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def close(self):
+        """
+        Finish the queued jobs, then stop the engine.
+        """
+        if self.running:
+            self._jobs.put(None)
+            self._dispatcher.join()
+        self._dispatcher = None
+        self._stop_process()
+
+    def _start_process(self):
+        logger.info(f"SolverEngine: starting {' '.join(self.engine_command)}")
+        self.process = subprocess.Popen(self.engine_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        text=True, bufsize=1)
+        # stdout is read in a thread so that we can time out on it.
+        self._replies = queue.Queue()
+        threading.Thread(target=self._read_replies, args=(self.process, self._replies), daemon=True).start()
+
+        reply = self._next_reply(self.startup_timeout)
+        if reply is None or not reply.get('ready'):
+            self._stop_process()
+            raise CouldNotSolveError('SolverEngine: the engine did not start properly.')
+        logger.info('SolverEngine: engine ready')
+
+    def _stop_process(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def _restart_process(self):
+        logger.warning('SolverEngine: restarting the engine')
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+        self.n_restarts += 1
+        self._start_process()
+
+    @staticmethod
+    def _read_replies(process, replies):
+        for line in process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                replies.put(json.loads(line))
+            except json.JSONDecodeError:
+                # the engine's own logging, not for us.
+                logger.debug(f"SolverEngine: {line}")
+        # EOF: the engine is gone.
+        replies.put(None)
+
+    def _next_reply(self, timeout):
+        try:
+            return self._replies.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _dispatch(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                return
+            request, timeout, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._run_job(request, timeout))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _run_job(self, request, timeout):
+        if self.process is None or self.process.poll() is not None:
+            self._restart_process()
+        try:
+            self.process.stdin.write(json.dumps(request) + '\n')
+            self.process.stdin.flush()
+        except OSError:
+            self._restart_process()
+            raise CouldNotSolveError('SolverEngine: the engine crashed before receiving the job.')
+
+        # skip replies to older jobs, e.g. one that timed out just before the engine answered.
+        while True:
+            reply = self._next_reply(timeout)
+            if reply is None:
+                # timed out, or the engine died on this job.
+                self._restart_process()
+                raise CouldNotSolveError(f"SolverEngine: the engine crashed or timed out on {request['xylist']}.")
+            if reply.get('id') == request['id']:
+                break
+
+        if reply.get('error'):
+            raise CouldNotSolveError(f"SolverEngine: {reply['error']}")
+        return bool(reply.get('solved'))
+
+    def submit(self, xylist_path, wcs_path, width, height, ra_approx=None, dec_approx=None, search_radius=1.,
+               scale_min=None, scale_max=None, odds_to_solve=1e6, timeout=None):
+        """
+        Queue an xylist for solving.
+
+        Parameters:
+        timeout (float): seconds after which this job is considered hopeless and the engine restarted.
+                         If None, job_timeout.
+
+        Returns:
+        concurrent.futures.Future, resolving to True if the engine wrote a solution at wcs_path.
+        """
+        if not self.running:
+            raise RuntimeError('SolverEngine: not started, use it as a context manager or call start().')
+        with self._lock:
+            self._job_counter += 1
+            job_id = self._job_counter
+        request = {'id': job_id, 'xylist': str(xylist_path), 'wcs': str(wcs_path),
+                   'width': int(width), 'height': int(height),
+                   'ra': ra_approx, 'dec': dec_approx, 'radius': search_radius,
+                   'scale_min': scale_min, 'scale_max': scale_max,
+                   'odds_to_solve': odds_to_solve}
+        future = Future()
+        self._jobs.put((request, self.job_timeout if timeout is None else timeout, future))
+        return future
+
+    def plate_solve(self, fits_file_path, sources, ra_approx=None, dec_approx=None,
+                    scale_min=None, scale_max=None, use_n_brightest_only=None, odds_to_solve=1e6,
+                    solution_index=None, search_radius=1., timeout=None, write_to_file=True, header=None,
+                    metrics=None, profile=None):
+        """
+        Same as plate_solve_locally, but through this engine.
+
+        Parameters:
+        fits_file_path (Path or str): Path to the FITS file.
+        sources (SourceList or astropy.table.Table): detected sources.
+        ra_approx (float): Approximate RA in degrees.
+        dec_approx (float): Approximate DEC in degrees.
+        scale_min (float): lowest pixel scale to consider in arcsec/pixel
+        scale_max (float): largest pixel scale to consider in arcsec/pixel
+        use_n_brightest_only (int): number of sources to consider. If None using all.
+        odds_to_solve (float): declare solved beyond those odds
+        solution_index (SolutionIndex): if provided, record the solution there.
+        search_radius (float): radius around (ra_approx, dec_approx) to search, in degrees.
+        timeout (float): seconds after which the job is failed with CouldNotSolveError (and the engine restarted).
+                         If None, the timeout of the profile, or job_timeout if it has none.
+        write_to_file (bool): write the WCS to the FITS file (and solution_index). If False, only return it.
+        header (astropy.io.fits.Header): primary header of the file, if already read (e.g. FitsFrame.header).
+        metrics (SolveMetrics): if provided, records the time spent writing the xylist and waiting for the engine
+                                (queued behind the other jobs, then solving).
+        profile (SolverProfile or str): a profile of plate_solve_locally, or the name of one of solver_profiles.
+                                        Only its timeout applies: the engine is not a solve-field run, its index
+                                        files and options are set when it starts.
+
+        Returns:
+        WCS header if successful.
+        Also, updates the given fits file with the same WCS if successful.
+        """
+        fits_file_path = Path(fits_file_path)
+        logger.info(f"SolverEngine.plate_solve on {fits_file_path}")
+        start_time = time.time()
+
+        if use_n_brightest_only is None:
+            use_n_brightest_only = len(sources)
+        if profile is None:
+            profile = default_profile
+        elif isinstance(profile, str):
+            profile = solver_profiles[profile]
+        if timeout is None:
+            timeout = profile.timeout
+
+        if header is None:
+            header = fits.getheader(fits_file_path)
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            xylist_path = Path(tmpdirname) / 'xylist.fits'
+            wcs_path = Path(tmpdirname) / 'xylist.wcs'
+            with stage(metrics, 'write_xylist'):
+                write_xylist(sources, xylist_path, use_n_brightest_only)
+
+            future = self.submit(xylist_path, wcs_path, header['NAXIS1'], header['NAXIS2'],
+                                 ra_approx=ra_approx, dec_approx=dec_approx, search_radius=search_radius,
+                                 scale_min=scale_min, scale_max=scale_max, odds_to_solve=odds_to_solve,
+                                 timeout=timeout)
+            # the engine is not our child until it exits: only the wall time.
+            with stage(metrics, 'engine_solve', cpu=False):
+                solved = future.result()
+            if not solved or not wcs_path.exists():
+                logger.error("Astrometry failed: No solution found.")
+                raise CouldNotSolveError('failed to solve astrometry')
+            wcs = WCS(fits.getheader(wcs_path)).to_header()
+
+        if write_to_file:
+            logger.info(f"SolverEngine.plate_solve: {fits_file_path} solved, writing the WCS")
+            write_wcs_to_fits(fits_file_path, wcs)
+            if solution_index is not None:
+                solution_index.record(fits_file_path, wcs, header=header, solve_time=time.time() - start_time)
+        return wcs
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Default engine for SolverEngine: loads the astrometry.net index files once with the `astrometry`
+python bindings (pip install 'widefield_plate_solver[engine]'), then solves the xylists it receives on stdin.
+See SolverEngine for the protocol.
+
+Usage: python -m widefield_plate_solver.engine_worker index-4107.fits index-5206-*.fits ...
+"""
+import json
+import math
+import sys
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+
+def solve_request(solver, request):
+    import astrometry
+
+    xylist = fits.getdata(request['xylist'])
+    stars = np.column_stack((xylist['X'], xylist['Y']))
+
+    size_hint = None
+    if request.get('scale_min') is not None and request.get('scale_max') is not None:
+        size_hint = astrometry.SizeHint(lower_arcsec_per_pixel=request['scale_min'],
+                                        upper_arcsec_per_pixel=request['scale_max'])
+    position_hint = None
+    if request.get('ra') is not None and request.get('dec') is not None:
+        position_hint = astrometry.PositionHint(ra_deg=request['ra'], dec_deg=request['dec'],
+                                                radius_deg=request.get('radius') or 1.)
+    solution_parameters = astrometry.SolutionParameters(
+        output_logodds_threshold=math.log(request.get('odds_to_solve') or 1e9)
+    )
+
+    solution = solver.solve(stars=stars, size_hint=size_hint, position_hint=position_hint,
+                            solution_parameters=solution_parameters)
+    if not solution.has_match():
+        return False
+
+    header = fits.Header()
+    for key, value in solution.best_match().wcs_fields.items():
+        header[key] = value
+    header['IMAGEW'] = request['width']
+    header['IMAGEH'] = request['height']
+    fits.PrimaryHDU(header=header).writeto(request['wcs'], overwrite=True)
+    return True
+
+
+def main():
+    try:
+        import astrometry
+    except ImportError:
+        sys.exit("engine_worker: needs the astrometry python bindings, "
+                 "pip install 'widefield_plate_solver[engine]'")
+
+    index_files = [Path(p) for p in sys.argv[1:]]
+    with astrometry.Solver(index_files) as solver:
+        print(json.dumps({'ready': True, 'n_index_files': len(index_files)}), flush=True)
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            reply = {'id': request.get('id'), 'solved': False, 'error': None}
+            try:
+                reply['solved'] = solve_request(solver, request)
+            except Exception as e:
+                reply['error'] = str(e)
+            print(json.dumps(reply), flush=True)
+
+
+if __name__ == "__main__":
+    main()
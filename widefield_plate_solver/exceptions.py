@@ -9,6 +9,11 @@ class CouldNotSolveError(CustomException):
         super().__init__(message)
 
 
+class SourceExtractionError(CustomException):
+    def __init__(self, message="Raised if the source extraction failed, e.g. too many objects for sep"):
+        super().__init__(message)
+
+
 class APIKeyNotFound(CustomException):
     def __init__(self, message="""
 Please set your astrometry.net key under the `astrometry_net_aòpi_key` environment variable.
@@ -16,3 +21,8 @@ Either with `os.environ['astrometry_net_aòpi_key'] = '(your astrometry.net api
 in your shell with `export astrometry_net_api_key='(your astrometry.net api key)'`.
     """):
         super().__init__(message)
+
+
+class LeaseLostError(CustomException):
+    def __init__(self, message="Raised if another worker took over a frame we were solving (see LeaseDirectory)"):
+        super().__init__(message)
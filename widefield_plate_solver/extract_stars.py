@@ -1,79 +1,334 @@
-import sys
+import logging
 import numpy as np
-from scipy.ndimage import median_filter
+from scipy.ndimage import median_filter, maximum_filter
 from astropy.io import fits
-from astropy.table import Table
 import sep
 import pathlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from .plotter import plot_stars
+from .exceptions import SourceExtractionError
+from .metrics import stage, count
+from .sources import SourceList, brightest_indices
 
+logger = logging.getLogger(__name__)
 
-def extract_stars(fits_file_path_or_2darray, debug_plot_path=None):
+
+class ExtractionBuffers:
+    """
+    Preallocated float32 work buffers for extract_stars(low_memory=True), to reuse across a stream of
+    same-shaped frames instead of allocating full-size images for each of them.
+    Not thread-safe: one per thread or process.
+    """
+
+    def __init__(self):
+        self.image = None
+        self.work = None
+
+    def get(self, shape):
+        """
+        The (image, work) buffers for this shape, reallocated only if the shape changed.
+        """
+        if self.image is None or self.image.shape != tuple(shape):
+            self.image = np.empty(shape, dtype=np.float32)
+            self.work = np.empty(shape, dtype=np.float32)
+        return self.image, self.work
+
+
+def extract_stars(fits_file_path_or_2darray, debug_plot_path=None, tile_size=None, tile_overlap=64, n_threads=None,
+                  low_memory=False, buffers=None, n_brightest=None, metrics=None, debug_plot_size=1024,
+                  hdu=0):
     """
     Extract star positions from an image using SEP (Source Extractor as a Python library).
 
     Parameters:
     fits_file_path (str): Path to the FITS file.
     debug_plot (str): if provided, dumps a jpeg showing the extracted sources at the given path.
+                      It is a binned quick look, rendered in the background (see preview.PreviewRenderer).
+    tile_size (int): if provided, process the image in square tiles of about this many pixels on a side
+                     (rounded to the 64 pixel background mesh), in a pool of threads. For very large sensors:
+                     the memory used is then bounded by the tile size, and when given a path, the image is never
+                     loaded in full.
+    tile_overlap (int): pixels shared between neighbouring tiles, should exceed the size of the largest stars.
+                        Each source is kept only by the tile its centroid falls in.
+    n_threads (int): number of tiles processed concurrently. If None, number of CPUs.
+    low_memory (bool): work in float32, reading the file memory-mapped straight into a work buffer and
+                       subtracting the background in place: two float32 copies of the image instead of about
+                       four float64 ones.
+    buffers (ExtractionBuffers): with low_memory, reuse these buffers (e.g. across the frames of a night).
+    n_brightest (int): if provided, only return the n_brightest best sources. The detection threshold is then set
+                       in a single pass from the brightness of the local peaks of the image, so that crowded
+                       fields do not overflow sep, instead of retrying with stricter limits. With tile_size,
+                       the tiles are extracted whole and the brightest sources taken once they are merged.
+    metrics (SolveMetrics): if provided, records the time spent reading, estimating the background, filtering
+                            and extracting, the number of retries and of sources.
+    debug_plot_size (int): longest side of the image in the debug plot, in pixels.
+    hdu (int or str): when given a path, the HDU of the image (index or EXTNAME), e.g. a chip of a
+                      multi-extension file. See plate_solve_planes to solve all the chips or the planes of a cube.
+
+    Raises SourceExtractionError if sep fails on the image.
 
     Returns:
-    astropy.table.Table: Table of detected sources.
+    SourceList: detected sources, brightest first (x, y, flux... and xcentroid, ycentroid like photutils).
     numpy 2D array: background subtracted image
     """
+    dtype = np.float32 if low_memory else float
+    work = None
+    if low_memory and buffers is None:
+        buffers = ExtractionBuffers()
+
     if type(fits_file_path_or_2darray) is str or type(fits_file_path_or_2darray) is pathlib.PosixPath:
-        image = fits.getdata(fits_file_path_or_2darray).astype(float)
+        if tile_size is not None or low_memory:
+            # memory-mapped: the pixels are read from disk only where needed, straight into our own arrays.
+            with fits.open(fits_file_path_or_2darray, memmap=True, do_not_scale_image_data=True) as hdul:
+                header = hdul[hdu].header
+                scaled = _ScaledImage(hdul[hdu].data, header.get('BSCALE', 1.), header.get('BZERO', 0.), dtype)
+                if tile_size is not None:
+                    return _extract_tiled(scaled, scaled.shape, tile_size, tile_overlap, n_threads, debug_plot_path,
+                                          dtype, n_brightest, metrics, debug_plot_size)
+                image, work = buffers.get(scaled.shape)
+                with stage(metrics, 'read'):
+                    scaled.read_into(image)
+        else:
+            with stage(metrics, 'read'):
+                image = fits.getdata(fits_file_path_or_2darray, hdu).astype(float)
     else:
         image = fits_file_path_or_2darray
+        if tile_size is not None:
+            return _extract_tiled(image, image.shape, tile_size, tile_overlap, n_threads, debug_plot_path, dtype,
+                                  n_brightest, metrics, debug_plot_size)
+        if low_memory:
+            image_buffer, work = buffers.get(image.shape)
+            if not (image.dtype == np.float32 and image.dtype.isnative and image.flags.c_contiguous):
+                np.copyto(image_buffer, image, casting='unsafe')
+                image = image_buffer
+
+    objects, image_sub = _extract_objects(image, work, n_brightest, metrics)
+    with stage(metrics, 'build_sources'):
+        sources = _objects_to_sources(objects, n_brightest)
+    count(metrics, 'n_sources', len(sources))
 
-    bkg = sep.Background(image, bw=64, bh=64, fw=3, fh=3)
-    image_filtered = median_filter(image, size=2)
+    if debug_plot_path is not None:
+        from .preview import default_renderer
+        default_renderer().submit(image_sub, debug_plot_path, sources=sources, max_size=debug_plot_size)
 
-    image_sub = image_filtered - bkg
+    return sources
+
+
+def _extract_objects(image, work=None, n_brightest=None, metrics=None):
+    """
+    Background subtraction and sep extraction on one image (or tile).
+
+    Parameters:
+    image (numpy 2D array): the image, left untouched.
+    work (numpy 2D array): if provided, same shape and dtype as image, receives the background subtracted image
+                           instead of allocating new arrays.
+    n_brightest (int): if provided, single pass with a threshold adapted to extract about this many sources
+                       (and a few more, for the cleaning to come).
+    metrics (SolveMetrics): if provided, records the time of each step and the number of retries.
+
+    Returns:
+    numpy structured array of sep objects, numpy 2D array of the background subtracted image.
+    """
+    with stage(metrics, 'background'):
+        bkg = sep.Background(image, bw=64, bh=64, fw=3, fh=3)
+    if work is None:
+        with stage(metrics, 'median_filter'):
+            image_filtered = median_filter(image, size=2)
+        with stage(metrics, 'background'):
+            image_sub = image_filtered - bkg
+    else:
+        with stage(metrics, 'median_filter'):
+            median_filter(image, size=2, output=work)
+        with stage(metrics, 'background'):
+            bkg.subfrom(work)
+        image_sub = work
     objects = None
     thresh = 5
     minarea = 10
+    if n_brightest is not None:
+        with stage(metrics, 'budget_threshold'):
+            thresh, pixstack, sub_object_limit = _budget_threshold(image_sub, bkg.globalrms, n_brightest, thresh)
+        try:
+            with stage(metrics, 'sep_extract'), _sep_limits(pixstack, sub_object_limit):
+                objects = sep.extract(image_sub, thresh=thresh, err=bkg.globalrms, minarea=minarea)
+        except Exception as e:
+            raise SourceExtractionError(f'Problem with source extraction: {e}')
+        return objects, image_sub
+
     extract_counter = 0
     while objects is None and extract_counter < 5:
         try:
-            objects = sep.extract(image_sub, thresh=thresh, err=bkg.globalrms,
-                                  minarea=minarea)
+            with stage(metrics, 'sep_extract'):
+                objects = sep.extract(image_sub, thresh=thresh, err=bkg.globalrms,
+                                      minarea=minarea)
         except Exception as e:
             # most likely sep exception of overflow due to too many objects.
             extract_counter += 1
-            print(f'Extract trial {extract_counter} failed with error: {e}. Attempting again with stricter limits.')
+            count(metrics, 'extraction_retries')
+            logger.warning(f'Extract trial {extract_counter} failed with error: {e}. '
+                           f'Attempting again with stricter limits.')
             thresh += 1
             minarea += 3
     if objects is None:
-        print('Problem with source extraction: stopping')
-        sys.exit()
+        raise SourceExtractionError('Problem with source extraction: still failing with the strictest limits.')
+    return objects, image_sub
 
-    sources = Table()
-    for col in objects.dtype.names:
-        sources[col] = objects[col]
 
-    # just to stick to the daostarfinder way
-    sources['xcentroid'] = sources['x']
-    sources['ycentroid'] = sources['y']
+def _budget_threshold(image_sub, rms, n_brightest, min_thresh):
+    """
+    Detection threshold (in units of rms) such that one sep pass yields a few times n_brightest sources,
+    from the values of the local peaks of the background subtracted image.
+
+    Returns:
+    the threshold, and the sep pixel stack and sub-object limit needed to extract everything above it.
+    """
+    peaks = (image_sub > min_thresh * rms) & (image_sub == maximum_filter(image_sub, size=5))
+    peak_values = image_sub[peaks]
+    # some sources will be cleaned away, others are too faint to cover minarea pixels: aim for 3 times more.
+    target = 3 * n_brightest
+    thresh = min_thresh
+    if len(peak_values) > target:
+        kth_brightest = np.partition(peak_values, len(peak_values) - target)[len(peak_values) - target]
+        # a star peaking at twice the threshold still has enough pixels above it.
+        thresh = max(min_thresh, 0.5 * kth_brightest / rms)
+
+    n_pixels = np.count_nonzero(image_sub > thresh * rms)
+    n_peaks = np.count_nonzero(peak_values > thresh * rms)
+    return thresh, int(1.2 * n_pixels), min(n_peaks, 65535)
 
+
+# sep's limits are process-wide: the limits needed by the extractions running in any thread, and sep's own ones.
+_sep_limits_lock = threading.Lock()
+_sep_limits_needed = []
+_sep_limits_default = None
+
+
+@contextmanager
+def _sep_limits(pixstack, sub_object_limit):
+    """
+    Raise sep's pixel stack and sub-object limit for the time of an extraction. While several extractions run,
+    the limits are the largest they need, and they are back to what they were once none is left.
+    """
+    global _sep_limits_default
+    needed = (pixstack, sub_object_limit)
+    with _sep_limits_lock:
+        if not _sep_limits_needed:
+            _sep_limits_default = (sep.get_extract_pixstack(), sep.get_sub_object_limit())
+        _sep_limits_needed.append(needed)
+        _apply_sep_limits()
+    try:
+        yield
+    finally:
+        with _sep_limits_lock:
+            _sep_limits_needed.remove(needed)
+            _apply_sep_limits()
+
+
+def _apply_sep_limits():
+    limits = [_sep_limits_default] + _sep_limits_needed
+    sep.set_extract_pixstack(max(pixstack for pixstack, _ in limits))
+    sep.set_sub_object_limit(max(sub_object_limit for _, sub_object_limit in limits))
+
+
+def _objects_to_sources(objects, n_brightest=None):
+    """
+    From the sep objects to our list of sources: cleaned, brightest first, only the n_brightest if given.
+    The cuts are combined into one mask, the rows kept are copied once.
+    """
     # remove flagged
-    sources = sources[sources['flag'] == 0]
+    keep = objects['flag'] == 0
+    if not keep.any():
+        return SourceList(objects[:0])
 
     # remove the weirdly elongated ones
-    elongation = sources['a'] / sources['b']
-    med_el = np.median(elongation)
-    std_el = np.std(elongation)
-    sources['elongation'] = elongation
-    sources = sources[sources['elongation'] < med_el + std_el]
+    elongation = objects['a'] / objects['b']
+    keep &= elongation < np.median(elongation[keep]) + np.std(elongation[keep])
 
     # remove those occupying a weirdly small amount of space (likely hot pixels or cosmics)
-    medpix = np.median(sources['npix'])
-    sources = sources[(sources['npix'] > 0.5 * medpix)]
+    keep &= objects['npix'] > 0.5 * np.median(objects['npix'][keep])
 
     # brightest first
-    sources.sort('flux', reverse=True)
+    rows = np.flatnonzero(keep)
+    rows = rows[brightest_indices(objects['flux'][rows], n_brightest)]
+    return SourceList(objects[rows])
+
+
+class _ScaledImage:
+    """
+    Raw (memory-mapped) FITS pixels, scaled with BSCALE and BZERO only for the slices that are read.
+    """
+
+    def __init__(self, raw, bscale, bzero, dtype=float):
+        self.raw = raw
+        self.shape = raw.shape
+        self.bscale = bscale
+        self.bzero = bzero
+        self.dtype = dtype
+
+    def __getitem__(self, key):
+        return self._scale(np.asarray(self.raw[key], dtype=self.dtype))
+
+    def read_into(self, out):
+        """
+        Read and scale the whole image into the preallocated array out, without temporary copies.
+        """
+        np.copyto(out, self.raw, casting='unsafe')
+        return self._scale(out)
+
+    def _scale(self, pixels):
+        if self.bscale != 1:
+            pixels *= self.bscale
+        if self.bzero != 0:
+            pixels += self.bzero
+        return pixels
+
+
+# sep object columns that are positions along each axis, to move from tile to image coordinates.
+_x_columns = ['x', 'xmin', 'xmax', 'xpeak', 'xcpeak']
+_y_columns = ['y', 'ymin', 'ymax', 'ypeak', 'ycpeak']
+
+
+def _extract_tiled(image, shape, tile_size, tile_overlap, n_threads, debug_plot_path, dtype=float, n_brightest=None,
+                   metrics=None, debug_plot_size=1024):
+    """
+    extract_stars on overlapping tiles. image can be anything that can be sliced into a 2D array,
+    e.g. a _ScaledImage to read each tile from disk.
+    """
+    ny, nx = shape
+    # align the tiles on the background mesh, so that it is the same as for the full image.
+    mesh = 64
+    tile_size = max(mesh, int(round(tile_size / mesh)) * mesh)
+    tile_overlap = int(np.ceil(tile_overlap / mesh)) * mesh
+
+    def process(y0, x0):
+        # the tile "owns" [y0, y0 + tile_size) x [x0, x0 + tile_size), and sees the overlap around it.
+        ys, xs = max(y0 - tile_overlap, 0), max(x0 - tile_overlap, 0)
+        ye, xe = min(y0 + tile_size + tile_overlap, ny), min(x0 + tile_size + tile_overlap, nx)
+        with stage(metrics, 'read'):
+            tile = np.ascontiguousarray(image[ys:ye, xs:xe], dtype=dtype)
+        # no budget per tile: the brightest sources are taken once the tiles are merged.
+        objects, _ = _extract_objects(tile, metrics=metrics)
+        for col in _x_columns:
+            objects[col] += xs
+        for col in _y_columns:
+            objects[col] += ys
+        owned = ((objects['x'] >= x0) & (objects['x'] < x0 + tile_size) &
+                 (objects['y'] >= y0) & (objects['y'] < y0 + tile_size))
+        return objects[owned]
+
+    origins = [(y0, x0) for y0 in range(0, ny, tile_size) for x0 in range(0, nx, tile_size)]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        objects = np.concatenate(list(pool.map(lambda origin: process(*origin), origins)))
+
+    with stage(metrics, 'build_sources'):
+        sources = _objects_to_sources(objects, n_brightest)
+    count(metrics, 'n_sources', len(sources))
 
     if debug_plot_path is not None:
-        plot_stars(sources, image_sub, debug_plot_path)
+        # no full background subtracted image in this mode, show the original one.
+        from .preview import default_renderer
+        default_renderer().submit(image, debug_plot_path, sources=sources, max_size=debug_plot_size)
 
     return sources
@@ -0,0 +1,196 @@
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+logger = logging.getLogger(__name__)
+
+
+_block_size = 2880
+_card_size = 80
+
+
+class FitsFrame:
+    """
+    A FITS file opened once for the whole solve: its primary header is read on opening, and its pixels
+    (memory-mapped) on first access, instead of each step opening the file again.
+
+        with FitsFrame('frame.fits') as frame:
+            sources = extract_stars(frame.data)
+            wcs = plate_solve_locally(frame.path, sources, header=frame.header, write_to_file=False)
+        write_wcs_to_fits(frame.path, wcs, mode='in_place')
+
+    The file is only read, write the WCS once the frame is closed.
+    """
+
+    def __init__(self, fits_file_path):
+        """
+        Parameters:
+        fits_file_path (Path or str): Path to the FITS file.
+        """
+        self.path = Path(fits_file_path)
+        # astropy cannot memory-map scaled (BZERO/BSCALE) data, we scale it ourselves.
+        self._hdul = fits.open(self.path, memmap=True, do_not_scale_image_data=True)
+        self.header = self._hdul[0].header
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def data(self):
+        """
+        The primary image as float, read at the first access.
+        """
+        if self._data is None:
+            self._data = np.asarray(self._hdul[0].data, dtype=float)
+            bscale, bzero = self.header.get('BSCALE', 1.), self.header.get('BZERO', 0.)
+            if bscale != 1.:
+                self._data *= bscale
+            if bzero != 0.:
+                self._data += bzero
+        return self._data
+
+    def close(self):
+        self._data = None
+        self._hdul.close()
+
+
+def wcs_sidecar_path(fits_file_path):
+    """
+    Where write_wcs_to_fits(mode='sidecar') puts the solution of this file: same name, .wcs extension.
+    """
+    return Path(fits_file_path).with_suffix('.wcs')
+
+
+def solved_wcs(fits_file_path, header=None):
+    """
+    The solution previously written by write_wcs_to_fits, in the header of the file or in its sidecar.
+
+    Parameters:
+    fits_file_path (Path or str): Path to the FITS file.
+    header (astropy.io.fits.Header): primary header of the file, if already read.
+
+    Returns:
+    the header containing the WCS, None if the file was not solved yet.
+    """
+    if header is None:
+        header = fits.getheader(fits_file_path)
+    if 'PL-SLVED' in header:
+        return header
+    sidecar_path = wcs_sidecar_path(fits_file_path)
+    if sidecar_path.exists():
+        sidecar = fits.getheader(sidecar_path)
+        if 'PL-SLVED' in sidecar:
+            return sidecar
+    return None
+
+
+def write_wcs_to_fits(fits_file_path, wcs, mode='update'):
+    """
+    Add a WCS solution to the primary header of a FITS file, flagging it as plate solved.
+
+    Parameters:
+    fits_file_path (Path or str): Path to the FITS file.
+    wcs (astropy.io.fits.Header): the WCS header, modified in place to also contain the flag.
+    mode (str): how to write it,
+                'update': let astropy update the file. If the header outgrows its 2880 bytes blocks, the whole
+                          file (data included) is rewritten.
+                'in_place': only rewrite the header blocks, using the padding after the END card and the blank
+                            cards at the end of the header. If the WCS does not fit there, falls back to 'sidecar'.
+                'sidecar': leave the FITS file untouched, write the WCS to a .wcs file next to it
+                           (see wcs_sidecar_path).
+                'atomic': write a copy of the file with the new header next to it, and rename it over the file.
+                          Whoever opens the file meanwhile (e.g. on another node) reads either the old file or the
+                          new one, never a header being written. Costs a copy of the file.
+    """
+    # little flag to indicate that we plate solved this file:
+    wcs['PL-SLVED'] = 'done'
+    if mode == 'update':
+        with fits.open(fits_file_path, mode="update") as hdul:
+            # add all this info to the file:
+            hdul[0].header.update(wcs)
+            hdul.flush()
+    elif mode == 'in_place':
+        if not _update_header_in_place(fits_file_path, wcs):
+            logger.warning(f"write_wcs_to_fits: no room for the WCS in the header of {fits_file_path}, "
+                           f"writing it to {wcs_sidecar_path(fits_file_path)} instead")
+            _write_sidecar(fits_file_path, wcs)
+    elif mode == 'sidecar':
+        _write_sidecar(fits_file_path, wcs)
+    elif mode == 'atomic':
+        _replace_with_header(fits_file_path, wcs)
+    else:
+        raise ValueError(f"write_wcs_to_fits: unknown mode '{mode}'")
+
+
+def _read_primary_header_bytes(f):
+    """
+    The raw primary header, up to and including the block containing the END card.
+    """
+    header_bytes = b''
+    while True:
+        block = f.read(_block_size)
+        if len(block) < _block_size:
+            raise OSError('truncated FITS header')
+        header_bytes += block
+        for i in range(0, _block_size, _card_size):
+            if block[i:i + 8] == b'END     ':
+                return header_bytes
+
+
+def _update_header_in_place(fits_file_path, wcs):
+    """
+    Rewrite the primary header with the WCS only if it still takes the same number of blocks.
+
+    Returns:
+    True if written, False if the header would need to grow.
+    """
+    with open(fits_file_path, 'r+b') as f:
+        header_bytes = _read_primary_header_bytes(f)
+        header = fits.Header.fromstring(header_bytes.decode('ascii'))
+        # new keywords take the place of trailing blank cards.
+        header.update(wcs)
+        new_header_bytes = header.tostring().encode('ascii')
+        if len(new_header_bytes) != len(header_bytes):
+            return False
+        f.seek(0)
+        f.write(new_header_bytes)
+    return True
+
+
+def _replace_with_header(fits_file_path, wcs):
+    """
+    Copy of the file with the WCS in its primary header (the rest copied as is), renamed over the file.
+    """
+    fits_file_path = Path(fits_file_path)
+    with open(fits_file_path, 'rb') as f:
+        header = fits.Header.fromstring(_read_primary_header_bytes(f).decode('ascii'))
+        header.update(wcs)
+        # hidden, in the same directory: on the same filesystem for the rename, and not picked up as a frame.
+        with tempfile.NamedTemporaryFile(dir=fits_file_path.parent, prefix=f".{fits_file_path.name}.",
+                                         suffix='.tmp', delete=False) as new:
+            try:
+                new.write(header.tostring().encode('ascii'))
+                shutil.copyfileobj(f, new, 16 * 1024**2)
+                new.flush()
+                os.fsync(new.fileno())
+                shutil.copymode(fits_file_path, new.name)
+            except BaseException:
+                os.unlink(new.name)
+                raise
+    os.replace(new.name, fits_file_path)
+
+
+def _write_sidecar(fits_file_path, wcs):
+    sidecar_path = wcs_sidecar_path(fits_file_path)
+    with tempfile.NamedTemporaryFile(dir=sidecar_path.parent, suffix='.tmp', delete=False) as f:
+        fits.PrimaryHDU(header=wcs).writeto(f)
+    os.replace(f.name, sidecar_path)
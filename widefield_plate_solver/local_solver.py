@@ -1,14 +1,19 @@
 import subprocess
 import os
+import signal
+from collections import namedtuple
 from pathlib import Path
 import shutil
 from astropy.io import fits
 from astropy.wcs import WCS
 import logging
 import tempfile
-from astropy.table import Table
+import time
 
 from .exceptions import CouldNotSolveError
+from .fits_io import write_wcs_to_fits
+from .metrics import stage
+from .sources import as_source_list, brightest_indices
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +25,39 @@ typical_locations = [
     '/opt/solve-field/bin/solve-field'
 ]
 
+SolverProfile = namedtuple('SolverProfile',
+                           ['name', 'suppress_outputs', 'work_dir', 'cpulimit', 'timeout', 'in_parallel', 'config',
+                            'extra_args'],
+                           defaults=[True, 'auto', None, None, False, None, ()])
+SolverProfile.__doc__ = """
+How plate_solve_locally runs solve-field:
+`suppress_outputs` tells it not to write the by-products we do not read (new image, corr, match, rdls, axy...),
+only the .wcs,
+`work_dir` the directory of its temporary files: 'auto' for /dev/shm (memory) when available, None for the system
+default, or a path,
+`cpulimit` the CPU seconds after which solve-field gives up (its --cpulimit), `timeout` the wall clock seconds after
+which it is killed (None: no limit), both ending in CouldNotSolveError,
+`in_parallel` searches all the index files at once (--inparallel; needs the memory to load them all),
+`config` the astrometry.net backend config file (which index files, ...), None for the default one,
+`extra_args` more arguments for solve-field.
+"""
+
+solver_profiles = {
+    # only the .wcs, in memory, no limits: the default.
+    'lean': SolverProfile('lean'),
+    # same, but hopeless frames are given up after a minute of CPU.
+    'bounded': SolverProfile('bounded', cpulimit=60, timeout=120),
+    # for machines with the memory to hold all the index files.
+    'parallel': SolverProfile('parallel', cpulimit=60, timeout=120, in_parallel=True),
+    # everything solve-field writes by default, on disk.
+    'full': SolverProfile('full', suppress_outputs=False, work_dir=None),
+}
+default_profile = solver_profiles['lean']
+
+_suppressed_outputs = ['--new-fits', 'none', '--corr', 'none', '--match', 'none', '--rdls', 'none',
+                       '--solved', 'none', '--index-xyls', 'none', '--temp-axy']
+
+
 def find_solve_field():
     # first, check if solve-field is in the PATH
     solve_field_path = shutil.which('solve-field')
@@ -38,10 +76,66 @@ def find_solve_field():
     return None
 
 
+_solve_field_path = None
+
+
+def _cached_solve_field():
+    """
+    find_solve_field, looked up once per process (until found).
+    """
+    global _solve_field_path
+    if _solve_field_path is None:
+        _solve_field_path = find_solve_field()
+    return _solve_field_path
+
+
+def _profile_work_dir(profile):
+    if profile.work_dir != 'auto':
+        return profile.work_dir
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+
+def solve_field_profile_arguments(profile):
+    """
+    The solve-field arguments of a profile.
+    """
+    arguments = []
+    if profile.suppress_outputs:
+        arguments += _suppressed_outputs
+    if profile.cpulimit is not None:
+        arguments += ['--cpulimit', str(profile.cpulimit)]
+    if profile.in_parallel:
+        arguments += ['--inparallel']
+    if profile.config is not None:
+        arguments += ['--config', str(profile.config)]
+    return arguments + [str(argument) for argument in profile.extra_args]
+
+
+def write_xylist(sources, xylist_path, use_n_brightest_only):
+    """
+    Write the brightest sources to an xylist fits file, as understood by astrometry.net.
+
+    Parameters:
+    sources (SourceList or astropy.table.Table): detected sources.
+    xylist_path (Path or str): where to write the xylist.
+    use_n_brightest_only (int): number of sources to keep, brightest first.
+    """
+    sources = as_source_list(sources)
+    rows = brightest_indices(sources['flux'], use_n_brightest_only)
+    # straight from the columns to the FITS table, only the rows kept.
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name='X', format='D', array=sources['x'][rows]),
+                                         fits.Column(name='Y', format='D', array=sources['y'][rows]),
+                                         fits.Column(name='FLUX', format='D', array=sources['flux'][rows])])
+    hdu.writeto(xylist_path, overwrite=True)
+
+
 def plate_solve_locally(fits_file_path, sources,
                         ra_approx=None, dec_approx=None,
                         scale_min=None, scale_max=None, use_n_brightest_only=None,
-                        odds_to_solve=1e6):
+                        odds_to_solve=1e6, solution_index=None, search_radius=1., timeout=None,
+                        cancel_event=None, write_to_file=True, header=None, metrics=None, profile=None):
     """
     Calculate the WCS using a local installation of astrometry.net.
     The solve-field binary must be in the path, preferably in /usr/bin.
@@ -50,7 +144,7 @@ def plate_solve_locally(fits_file_path, sources,
 
     Parameters:
     fits_file_path (Path or str): Path to the FITS file.
-    sources (astropy.table.Table): Table of detected sources.
+    sources (SourceList or astropy.table.Table): detected sources.
     use_existing_wcs_as_guess (bool): if a wcs information is already present in the fits file, use it to complete
                                       the rest of the arguments of the function. (ra_approx, dec_approx, etc.)
     ra_approx (float): Approximate RA in degrees.
@@ -60,6 +154,18 @@ def plate_solve_locally(fits_file_path, sources,
     use_n_brightest_only (int): number of sources to consider. If None using all.
     redo_if_done (bool): redo even if our solved keyword is already in the header?
     odds_to_solve (float): declare solved beyond those odds
+    solution_index (SolutionIndex): if provided, record the solution there.
+    search_radius (float): radius around (ra_approx, dec_approx) to search, in degrees.
+    timeout (float): seconds after which solve-field is killed and CouldNotSolveError raised.
+                     If None, the timeout of the profile.
+    cancel_event (threading.Event): when set (e.g. another attempt solved the frame), solve-field is killed
+                                    and CouldNotSolveError raised.
+    write_to_file (bool): write the WCS to the FITS file (and solution_index). If False, only return it.
+    header (astropy.io.fits.Header): primary header of the file, if already read (e.g. FitsFrame.header).
+    metrics (SolveMetrics): if provided, records the time spent finding solve-field, writing the xylist and
+                            in solve-field (including the CPU time of its processes).
+    profile (SolverProfile or str): how to run solve-field, or the name of one of solver_profiles.
+                                    If None, default_profile.
 
     Returns:
     WCS header if successful, None otherwise.
@@ -67,47 +173,59 @@ def plate_solve_locally(fits_file_path, sources,
     """
     fits_file_path = Path(fits_file_path)
     logger.info(f"plate_solve_locally on {fits_file_path}")
+    start_time = time.time()
 
     if use_n_brightest_only is None:
         use_n_brightest_only = len(sources)
+    if profile is None:
+        profile = default_profile
+    elif isinstance(profile, str):
+        profile = solver_profiles[profile]
+    if timeout is None:
+        timeout = profile.timeout
 
     # a work dir for the plate solving arguments
-    with tempfile.TemporaryDirectory() as tmpdirname:
+    work_dir = _profile_work_dir(profile)
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmpdirname:
         # xylist.fits from sources
         xylist_path = Path(tmpdirname) / 'xylist.fits'
-        t = Table([sources['xcentroid'], sources['ycentroid'], sources['flux']],
-                  names=('X', 'Y', 'FLUX'))
-        t.sort('FLUX', reverse=True)
-        t = t[:use_n_brightest_only]
-        hdu = fits.BinTableHDU(data=t)
-        hdu.writeto(xylist_path, overwrite=True)
+        with stage(metrics, 'write_xylist'):
+            write_xylist(sources, xylist_path, use_n_brightest_only)
 
         # build solve-field command
-        solve_field_path = find_solve_field()
+        with stage(metrics, 'find_solve_field'):
+            solve_field_path = _cached_solve_field()
         if solve_field_path is None:
             raise CouldNotSolveError('solve-field command not in path and not found at typical locations.')
         command = [str(solve_field_path), str(xylist_path), '--no-plots', '--x-column', 'X', '--y-column', 'Y',
                    '--sort-column', 'FLUX']  # by default solve-field sort by largest first, so ok to give flux this way
         # we also need the dimensions of the image:
-        header = fits.getheader(fits_file_path)
+        if header is None:
+            header = fits.getheader(fits_file_path)
         command += ['--width', str(header['NAXIS1']), '--height', str(header['NAXIS2'])]
         if ra_approx is not None and dec_approx is not None:
-            command += ['--ra', str(ra_approx), '--dec', str(dec_approx), '--radius', '1']
+            command += ['--ra', str(ra_approx), '--dec', str(dec_approx), '--radius', str(search_radius)]
         # add the scale estimate as well
-        command += ['--scale-low', str(scale_min), '--scale-high', str(scale_max), '--scale-units', 'arcsecperpix']
+        if scale_min is not None and scale_max is not None:
+            command += ['--scale-low', str(scale_min), '--scale-high', str(scale_max), '--scale-units', 'arcsecperpix']
         # add the odds
         command += ['--odds-to-solve', str(odds_to_solve)]
+        command += solve_field_profile_arguments(profile)
+        if work_dir is not None:
+            # its intermediate files too.
+            command += ['--temp-dir', tmpdirname]
 
         # we'll need this command to use the system python interpreter, not the one running this script.
         # (unless solve-field was installed within this environment ...but likely not the case)
         new_env = os.environ.copy()
         new_env["PATH"] = "/usr/bin:" + new_env["PATH"]  # assuming python is in /usr/bin
 
-        # run command
-        try:
-            subprocess.run(command, check=True, cwd=tmpdirname, env=new_env)
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error running solve-field: {e}")
+        # run command, in its own process group so that we can kill it along with its children.
+        with stage(metrics, 'solve_field'):
+            process = subprocess.Popen(command, cwd=tmpdirname, env=new_env, start_new_session=True)
+            _wait_for_solve_field(process, timeout, cancel_event)
+        if process.returncode != 0:
+            logger.error(f"Error running solve-field: exit status {process.returncode}")
             raise CouldNotSolveError('Error running solve-field.')
 
         # check for solution and update FITS file
@@ -119,11 +237,35 @@ def plate_solve_locally(fits_file_path, sources,
             wcs = WCS(fits.getheader(solved_path)).to_header()
             # else, we're probably fine. Like, 99.9% confidence from my
             # experience with astrometry.net's plate solver.
-            logger.info(f"plate_solve_with_API: {fits_file_path} solved, writing the WCS")
-            with fits.open(fits_file_path, mode="update") as hdul:
-                # little flag to indicate that we plate solved this file:
-                wcs['PL-SLVED'] = 'done'
-                # add all this info to the file:
-                hdul[0].header.update(wcs)
-                hdul.flush()
+            if write_to_file:
+                logger.info(f"plate_solve_locally: {fits_file_path} solved, writing the WCS")
+                write_wcs_to_fits(fits_file_path, wcs)
+                if solution_index is not None:
+                    solution_index.record(fits_file_path, wcs, header=header, solve_time=time.time() - start_time)
     return wcs
+
+
+def _wait_for_solve_field(process, timeout, cancel_event):
+    """
+    Wait for solve-field to exit, killing it if it runs past the timeout or if cancel_event gets set.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        try:
+            process.wait(timeout=0.1)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+        if cancel_event is not None and cancel_event.is_set():
+            reason = 'cancelled'
+        elif deadline is not None and time.time() > deadline:
+            reason = f"timed out after {timeout} s"
+        else:
+            continue
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+        logger.info(f"solve-field {reason}")
+        raise CouldNotSolveError(f"solve-field {reason}")
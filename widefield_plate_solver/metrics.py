@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # windows: no CPU time of the subprocesses there.
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def _children_cpu_time():
+    if resource is None:
+        return 0.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class SolveMetrics:
+    """
+    Timings and counters of one solve, filled in by plate_solve and the functions it calls when given
+    as their `metrics` argument:
+
+        metrics = SolveMetrics()
+        plate_solve('frame.fits', use_api=False, metrics=metrics)
+        print(metrics.as_dict())
+
+    Each stage records its wall time, the CPU time of the thread running it, and the CPU time of the
+    subprocesses that finished meanwhile (e.g. solve-field; with concurrent solves those get mixed up).
+    A stage run several times (e.g. for each tile) is summed.
+    Stages: read, background, median_filter, budget_threshold, sep_extract, build_sources, extract,
+    track, find_solve_field, write_xylist, solve_field, api_login, api_solve, api_submit, api_poll, api_wcs_download,
+    solve, write_wcs.
+    Counts: n_sources, extraction_retries, api_polls.
+
+    At the end of plate_solve, `success` and `error` are set and the callback (e.g. a MetricsRecorder)
+    is called with this object.
+    """
+
+    def __init__(self, fits_file_path=None, callback=None):
+        """
+        Parameters:
+        fits_file_path (Path or str): the frame, for the records.
+        callback (callable): called with this object once the solve is over.
+        """
+        self.fits_file_path = None if fits_file_path is None else str(fits_file_path)
+        self.callback = callback
+        self.stages = {}
+        self.counts = {}
+        self.success = None
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # sent back from the extraction processes of plate_solve_many.
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['callback'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, cpu=True):
+        """
+        Time the enclosed block as the given stage.
+        With cpu=False, only the wall time is recorded: for coroutines, whose thread also runs other ones.
+        """
+        wall, thread_cpu, children_cpu = time.perf_counter(), time.thread_time(), _children_cpu_time()
+        try:
+            yield
+        finally:
+            if cpu:
+                self.add_time(name, time.perf_counter() - wall, time.thread_time() - thread_cpu,
+                              _children_cpu_time() - children_cpu)
+            else:
+                self.add_time(name, time.perf_counter() - wall)
+
+    def add_time(self, name, wall, cpu=0., children_cpu=0.):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'wall': 0., 'cpu': 0., 'children_cpu': 0., 'calls': 0})
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+            stage['children_cpu'] += children_cpu
+            stage['calls'] += 1
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def merge(self, other):
+        """
+        Add the stages and counts of another SolveMetrics (e.g. of the extraction, measured in another process).
+        The solve is then considered started when the earliest of both was.
+        """
+        self.started_at = min(self.started_at, other.started_at)
+        for name, stage in other.stages.items():
+            with self._lock:
+                mine = self.stages.setdefault(name, {'wall': 0., 'cpu': 0., 'children_cpu': 0., 'calls': 0})
+                for key in mine:
+                    mine[key] += stage[key]
+        for name, value in other.counts.items():
+            self.count(name, value)
+
+    def finish(self, success, error=None):
+        """
+        Record the outcome and call the callback.
+        """
+        self.finished_at = time.time()
+        self.success = success
+        self.error = None if error is None else f"{type(error).__name__}: {error}"
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception as e:
+                # monitoring must not break the solve.
+                logger.warning(f"SolveMetrics: callback failed ({e})")
+
+    @property
+    def wall_time(self):
+        """
+        Seconds from the creation of this object to the end of the solve (or to now if not finished).
+        """
+        return (time.time() if self.finished_at is None else self.finished_at) - self.started_at
+
+    def as_dict(self):
+        with self._lock:
+            return {'fits_file_path': self.fits_file_path, 'started_at': self.started_at,
+                    'wall_time': self.wall_time, 'success': self.success, 'error': self.error,
+                    'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                    'counts': dict(self.counts)}
+
+
+def stage(metrics, name, cpu=True):
+    """
+    metrics.stage(name, cpu), or a no-op context if metrics is None.
+    """
+    return nullcontext() if metrics is None else metrics.stage(name, cpu)
+
+
+def count(metrics, name, n=1):
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+@contextmanager
+def outcome(metrics):
+    """
+    Finish the metrics (if any) when leaving the block: failed if it raised, successful otherwise.
+    """
+    try:
+        yield
+    except BaseException as e:
+        if metrics is not None:
+            metrics.finish(success=False, error=e)
+        raise
+    if metrics is not None:
+        metrics.finish(success=True)
+
+
+class MetricsRecorder:
+    """
+    Aggregates the SolveMetrics of many solves (use it as their callback), for monitoring a night:
+
+    - optionally appends each solve as a line of a JSON lines file,
+    - keeps a histogram of the wall time of each stage, and counts of solves, failures, sources and retries,
+      which write_prometheus exports as a Prometheus textfile (for node_exporter's textfile collector).
+
+        recorder = MetricsRecorder(jsonl_path='solves.jsonl', prometheus_path='/var/lib/node_exporter/wps.prom')
+        plate_solve_many('night/*.fits', metrics_callback=recorder)
+
+    Thread-safe.
+    """
+
+    default_buckets = (0.01, 0.03, 0.1, 0.3, 1., 3., 10., 30., 100., 300.)
+
+    def __init__(self, jsonl_path=None, prometheus_path=None, buckets=default_buckets, prefix='widefield_plate_solver'):
+        """
+        Parameters:
+        jsonl_path (Path or str): if provided, each solve is appended there as a JSON line.
+        prometheus_path (Path or str): if provided, the textfile is rewritten there after each solve.
+        buckets (tuple of float): upper bounds of the histogram buckets, in seconds.
+        prefix (str): prefix of the Prometheus metric names.
+        """
+        self.jsonl_path = None if jsonl_path is None else Path(jsonl_path)
+        self.prometheus_path = None if prometheus_path is None else Path(prometheus_path)
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.histograms = {}
+        self.totals = {'solves': 0, 'failures': 0}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, metrics):
+        record = metrics.as_dict()
+        with self._lock:
+            self.totals['solves'] += 1
+            if not record['success']:
+                self.totals['failures'] += 1
+            for name, stage in record['stages'].items():
+                self._observe(name, stage['wall'])
+            self._observe('total', record['wall_time'])
+            for name, value in record['counts'].items():
+                self.counts[name] = self.counts.get(name, 0) + value
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+        if self.prometheus_path is not None:
+            self.write_prometheus(self.prometheus_path)
+
+    def _observe(self, name, value):
+        histogram = self.histograms.setdefault(name, {'buckets': [0] * (len(self.buckets) + 1),
+                                                      'sum': 0., 'count': 0})
+        histogram['buckets'][bisect_left(self.buckets, value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def prometheus_text(self):
+        """
+        The aggregated metrics in the Prometheus text exposition format.
+        """
+        p = self.prefix
+        lines = [f"# HELP {p}_stage_seconds Wall time of each stage of the solves.",
+                 f"# TYPE {p}_stage_seconds histogram"]
+        with self._lock:
+            for name, histogram in sorted(self.histograms.items()):
+                cumulated = 0
+                for bound, n in zip(self.buckets + (float('inf'),), histogram['buckets']):
+                    cumulated += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{p}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulated}')
+                lines.append(f'{p}_stage_seconds_sum{{stage="{name}"}} {histogram["sum"]}')
+                lines.append(f'{p}_stage_seconds_count{{stage="{name}"}} {histogram["count"]}')
+            lines += [f"# HELP {p}_solves_total Solves attempted, by result.",
+                      f"# TYPE {p}_solves_total counter",
+                      f'{p}_solves_total{{result="success"}} {self.totals["solves"] - self.totals["failures"]}',
+                      f'{p}_solves_total{{result="failure"}} {self.totals["failures"]}']
+            for name, value in sorted(self.counts.items()):
+                lines += [f"# TYPE {p}_{name}_total counter", f"{p}_{name}_total {value}"]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Write the textfile atomically, so that the collector never reads half of it.
+        """
+        path = Path(path)
+        text = self.prometheus_text()
+        with tempfile.NamedTemporaryFile('w', dir=path.parent, suffix='.tmp', delete=False) as f:
+            f.write(text)
+        os.replace(f.name, path)
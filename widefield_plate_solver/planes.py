@@ -0,0 +1,389 @@
+import logging
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+
+from .exceptions import CouldNotSolveError
+from .metrics import stage
+from .tracking import SequenceTracker
+
+logger = logging.getLogger(__name__)
+
+
+Plane = namedtuple('Plane', ['hdu', 'index', 'name'])
+Plane.__doc__ = """
+One image to solve in a FITS file: `hdu` the index of its HDU, `index` its index along the third axis of a cube
+(None for a 2D image), `name` for the logs and plot files (EXTNAME of the HDU, or its index, and the plane index).
+"""
+
+PlaneSolution = namedtuple('PlaneSolution', ['plane', 'wcs', 'n_sources', 'method', 'error'])
+PlaneSolution.__doc__ = """
+Outcome of one plane: `wcs` the WCS header if solved (None otherwise), `n_sources` the number of sources extracted,
+`method` how the WCS was obtained: 'solved' (blind, or with the hints given), 'seeded' (solved with the pointing
+predicted from the reference plane), 'tracked' (plane of a cube matched to the previous one, see SequenceTracker),
+'offset' (predicted from the chip offsets, not solved), or 'done' (solved before), and `error` the exception that
+stopped this plane (None if it went fine).
+"""
+
+# binary table extension holding the solutions of the planes of the cubes, one row per plane.
+plane_wcs_extname = 'PLANEWCS'
+
+
+def image_planes(hdul):
+    """
+    The images of a FITS file: each 2D image HDU, and each plane of the 3D ones (cubes). Empty HDUs (such as the
+    primary HDU of a mosaic file) and tables are skipped. Only the headers are looked at.
+
+    Parameters:
+    hdul (astropy.io.fits.HDUList): the opened file.
+
+    Returns:
+    list of Plane.
+    """
+    planes = []
+    for hdu_index, hdu in enumerate(hdul):
+        if not hdu.is_image or hdu.name == plane_wcs_extname:
+            continue
+        naxis = hdu.header.get('NAXIS', 0)
+        name = hdu.name if hdu.name not in ('', 'PRIMARY') or hdu_index == 0 else str(hdu_index)
+        if naxis == 2:
+            planes.append(Plane(hdu_index, None, name))
+        elif naxis == 3:
+            planes += [Plane(hdu_index, index, f"{name}_{index}") for index in range(hdu.header['NAXIS3'])]
+    return planes
+
+
+def _detsec_origin(header):
+    """
+    Position of the first pixel of the chip in the mosaic, from the DETSEC keyword ('[x1:x2,y1:y2]', 1-based).
+    None if absent, or if the chip is flipped or binned compared with the detector coordinates.
+    """
+    match = re.fullmatch(r'\s*\[\s*(\d+):(\d+)\s*,\s*(\d+):(\d+)\s*\]\s*', str(header.get('DETSEC', '')))
+    if match is None:
+        return None
+    x1, x2, y1, y2 = (int(value) for value in match.groups())
+    if x2 - x1 + 1 != header.get('NAXIS1') or y2 - y1 + 1 != header.get('NAXIS2'):
+        return None
+    return np.array([x1 - 1., y1 - 1.])
+
+
+def chip_origins(hdul, chip_offsets=None):
+    """
+    Position of the first pixel of each chip in a common (mosaic) pixel frame.
+
+    Parameters:
+    hdul (astropy.io.fits.HDUList): the opened file.
+    chip_offsets (dict): {HDU index or EXTNAME: (x, y)}, known positions. If None, from the DETSEC keywords.
+
+    Returns:
+    dict {HDU index: numpy array (2,)}, only for the chips whose position is known.
+    """
+    origins = {}
+    for hdu_index, hdu in enumerate(hdul):
+        if chip_offsets is None:
+            origin = _detsec_origin(hdu.header)
+        else:
+            origin = chip_offsets.get(hdu_index, chip_offsets.get(hdu.name))
+        if origin is not None:
+            origins[hdu_index] = np.asarray(origin, dtype=float)
+    return origins
+
+
+def predict_wcs(reference_wcs, shift):
+    """
+    WCS of a chip of the same focal plane, whose pixel (0, 0) is at pixel `shift` of the reference chip.
+    The distortion (SIP) of the reference is left out, this is a starting point for a solve.
+
+    Parameters:
+    reference_wcs (astropy.wcs.WCS): solution of the reference chip.
+    shift (numpy array (2,)): x, y in pixels of the reference chip.
+
+    Returns:
+    astropy.wcs.WCS
+    """
+    wcs = reference_wcs.celestial.deepcopy()
+    wcs.sip = None
+    wcs.wcs.ctype = [ctype.replace('-SIP', '') for ctype in wcs.wcs.ctype]
+    wcs.wcs.crpix = wcs.wcs.crpix - shift
+    wcs.wcs.set()
+    return wcs
+
+
+def _read_plane(hdu, index):
+    # the HDU is memory-mapped: only this plane is read.
+    data = hdu.data if index is None else hdu.data[index]
+    image = np.asarray(data, dtype=float)
+    bscale, bzero = hdu.header.get('BSCALE', 1.), hdu.header.get('BZERO', 0.)
+    if bscale != 1.:
+        image *= bscale
+    if bzero != 0.:
+        image += bzero
+    return image
+
+
+def solved_planes(hdul):
+    """
+    The solutions previously written by plate_solve_planes.
+
+    Returns:
+    dict {(HDU index, plane index or None): WCS header}.
+    """
+    solutions = {}
+    for hdu_index, hdu in enumerate(hdul):
+        if hdu.is_image and hdu.header.get('NAXIS', 0) == 2 and 'PL-SLVED' in hdu.header:
+            solutions[(hdu_index, None)] = hdu.header
+    if plane_wcs_extname in hdul:
+        for row in hdul[plane_wcs_extname].data:
+            solutions[(int(row['HDU']), int(row['PLANE']))] = fits.Header.fromstring(row['WCS'])
+    return solutions
+
+
+def write_plane_solutions(fits_file_path, solutions):
+    """
+    Write the solutions of the planes back to the file, in a single update: the WCS of a 2D image goes to the
+    header of its HDU, those of the planes of a cube to the PLANEWCS table (one row per plane, replaced if
+    present), the header of the cube getting the WCS of its first solved plane. Each is flagged as plate solved.
+
+    Parameters:
+    fits_file_path (Path or str): Path to the FITS file.
+    solutions (list of PlaneSolution): only those with a WCS are written.
+    """
+    solved = [solution for solution in solutions if solution.wcs is not None]
+    cube_planes = sorted((solution for solution in solved if solution.plane.index is not None),
+                         key=lambda solution: solution.plane[:2])
+    with fits.open(fits_file_path, mode='update') as hdul:
+        for solution in solved:
+            if solution.plane.index is None:
+                header = hdul[solution.plane.hdu].header
+                header.update(solution.wcs)
+                header['PL-SLVED'] = 'done'
+        first_planes = {}
+        for solution in cube_planes:
+            first_planes.setdefault(solution.plane.hdu, solution)
+        for hdu_index, solution in first_planes.items():
+            header = hdul[hdu_index].header
+            header.update(solution.wcs)
+            header['PL-SLVED'] = (f"done, plane {solution.plane.index}", f"planes in {plane_wcs_extname}")
+        if cube_planes:
+            text = [solution.wcs.tostring(padding=False) for solution in cube_planes]
+            table = fits.BinTableHDU.from_columns([
+                fits.Column(name='HDU', format='J', array=[solution.plane.hdu for solution in cube_planes]),
+                fits.Column(name='PLANE', format='J', array=[solution.plane.index for solution in cube_planes]),
+                fits.Column(name='WCS', format=f"{max(len(t) for t in text)}A", array=text),
+            ], name=plane_wcs_extname)
+            if plane_wcs_extname in hdul:
+                hdul[plane_wcs_extname] = table
+            else:
+                hdul.append(table)
+        hdul.flush()
+
+
+def plate_solve_planes(fits_file_path, planes=None, reference=None, chip_offsets=None, solve_seeded=True,
+                       seed_scale_tolerance=0.05, n_threads=None, redo_if_done=False, write_to_file=True,
+                       do_debug_plot=False, extract_kwargs=None, tracker_kwargs=None,
+                       use_n_brightest_only=None, use_api=True, ra_approx=None, dec_approx=None,
+                       scale_min=None, scale_max=None, odds_to_solve=None, engine=None, quad_index=None, plan=None,
+                       parallel_plan=False, api_client=None, solver_profile=None, metrics=None):
+    """
+    Plate solve all the images of a FITS file: each image HDU of a multi-extension file (e.g. the chips of a
+    mosaic camera), each plane of a data cube (e.g. the frames of a fast camera), or both.
+
+    The file is opened once, memory-mapped, and the sources of the planes are extracted in a pool of threads,
+    each plane being read from disk once. Then:
+    - the reference plane is solved with the hints given (or blind),
+    - the other planes of a cube are matched to the previous plane (see SequenceTracker), and solved only if that
+      fails, using the pointing of the reference,
+    - the other chips, when their position in the focal plane is known (chip_offsets, or the DETSEC keywords),
+      are solved with the pointing and scale predicted from the reference solution (a narrow, fast search), or
+      just given the predicted WCS if not solve_seeded. Those of unknown position are solved around the pointing
+      of the reference.
+    All the solutions are written back in a single update of the file, see write_plane_solutions.
+
+    Parameters:
+    fits_file_path (Path or str): Path to the FITS file.
+    planes (list of Plane): the planes to solve. If None, all of them (see image_planes).
+    reference (int): index in planes of the plane solved first. If None, the planes are tried in decreasing
+                     number of sources until one solves.
+    chip_offsets (dict): {HDU index or EXTNAME: (x, y)}, position in pixels of the first pixel of each chip in a
+                         common frame (e.g. the mosaic). If None, from the DETSEC keywords of the headers, if any.
+    solve_seeded (bool): solve the chips of known position with the predicted pointing as a guess. If False, their
+                         predicted WCS is taken as is (no distortion terms), no solve.
+    seed_scale_tolerance (float): relative range around the scale of the reference for the seeded solves.
+    n_threads (int): number of planes extracted (and of seeded solves run) at the same time.
+                     If None, number of CPUs.
+    redo_if_done (bool): Redo even if the planes were solved before?
+    write_to_file (bool): write the solutions to the file. If False, only return them.
+    do_debug_plot (bool): will dump an image of the extracted sources of each plane next to the file.
+    extract_kwargs (dict): more arguments for extract_stars, e.g. dict(n_brightest=300).
+                           The buffers argument is not used, each thread having its own.
+    tracker_kwargs (dict): arguments of the SequenceTracker matching the planes of cubes, e.g. dict(max_shift=20).
+    use_n_brightest_only, use_api, ra_approx, dec_approx, scale_min, scale_max, odds_to_solve, engine, quad_index,
+    plan, parallel_plan, api_client, solver_profile: the solver to use and the hints, as in plate_solve.
+    metrics (SolveMetrics): if provided, records the time spent in each stage, summed over the planes
+                            (see plate_solve). It is not finished here: its callback is not called.
+
+    Returns:
+    list of PlaneSolution, in the order of planes.
+    """
+    # imported here as the package's __init__ imports us.
+    from . import _solve_with_backend
+    from . import extract_stars
+
+    fits_file_path = Path(fits_file_path)
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    extract_kwargs = {key: value for key, value in (extract_kwargs or {}).items() if key != 'buffers'}
+
+    with fits.open(fits_file_path, memmap=True, do_not_scale_image_data=True) as hdul:
+        if planes is None:
+            planes = image_planes(hdul)
+        if not redo_if_done:
+            done = solved_planes(hdul)
+            if all((plane.hdu, plane.index) in done for plane in planes):
+                logger.info(f"plate_solve_planes: {fits_file_path} was already plate solved, no redoing.")
+                return [PlaneSolution(plane, done[(plane.hdu, plane.index)], None, 'done', None) for plane in planes]
+        headers = [hdul[plane.hdu].header for plane in planes]
+        origins = chip_origins(hdul, chip_offsets)
+        # map the HDUs before the threads do.
+        for hdu_index in {plane.hdu for plane in planes}:
+            hdul[hdu_index].data
+
+        def extract(plane):
+            debug_plot_path = None
+            if do_debug_plot:
+                debug_plot_path = fits_file_path.parent / f"{fits_file_path.stem}_{plane.name}_sources.jpeg"
+            with stage(metrics, 'read'):
+                image = _read_plane(hdul[plane.hdu], plane.index)
+            with stage(metrics, 'extract'):
+                return extract_stars(image, debug_plot_path=debug_plot_path, metrics=metrics, **extract_kwargs)
+
+        logger.info(f"plate_solve_planes: extracting the sources of {len(planes)} planes of {fits_file_path}")
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            all_sources = list(executor.map(extract, planes))
+
+    solutions = [None] * len(planes)
+
+    def solve(i, hints):
+        hints = {**dict(ra_approx=None, dec_approx=None, scale_min=None, scale_max=None), **hints}
+        with stage(metrics, 'solve'):
+            return _solve_with_backend(fits_file_path, all_sources[i], headers[i], hints, use_n_brightest_only, use_api,
+                                       odds_to_solve, engine, quad_index, plan, parallel_plan, api_client, logger,
+                                       metrics, solver_profile)
+
+    if reference is None:
+        candidates = sorted(range(len(planes)), key=lambda i: -len(all_sources[i]))
+    else:
+        candidates = [reference]
+    given_hints = dict(ra_approx=ra_approx, dec_approx=dec_approx, scale_min=scale_min, scale_max=scale_max)
+    reference_wcs = None
+    for i in candidates:
+        try:
+            wcs = solve(i, given_hints)
+        except Exception as e:
+            logger.info(f"plate_solve_planes: could not solve {planes[i].name} ({e})")
+            solutions[i] = PlaneSolution(planes[i], None, len(all_sources[i]), 'solved', e)
+            continue
+        solutions[i] = PlaneSolution(planes[i], wcs, len(all_sources[i]), 'solved', None)
+        reference, reference_wcs = i, WCS(wcs)
+        logger.info(f"plate_solve_planes: reference plane {planes[i].name} solved")
+        break
+    for i in candidates:
+        if i != reference and solutions[i] is not None:
+            # tried blind, it gets a second chance with the pointing of the reference.
+            solutions[i] = None
+    if reference_wcs is None:
+        for i in range(len(planes)):
+            if solutions[i] is None:
+                solutions[i] = PlaneSolution(planes[i], None, len(all_sources[i]), 'solved',
+                                             CouldNotSolveError('no plane of the file could be solved'))
+        return solutions
+
+    pixel_scale = 3600 * np.mean(proj_plane_pixel_scales(reference_wcs.celestial))
+    seed_scales = dict(scale_min=(1 - seed_scale_tolerance) * pixel_scale,
+                       scale_max=(1 + seed_scale_tolerance) * pixel_scale)
+
+    def seeded_solve(i, predicted_wcs, method):
+        # pointing of the center of the plane, as predicted.
+        header = headers[i]
+        ra, dec = predicted_wcs.pixel_to_world_values((header['NAXIS1'] - 1) / 2, (header['NAXIS2'] - 1) / 2)
+        try:
+            wcs = solve(i, dict(ra_approx=float(ra), dec_approx=float(dec), **seed_scales))
+            return PlaneSolution(planes[i], wcs, len(all_sources[i]), method, None)
+        except Exception as e:
+            logger.info(f"plate_solve_planes: could not solve {planes[i].name} ({e})")
+            return PlaneSolution(planes[i], None, len(all_sources[i]), method, e)
+
+    reference_hdu = planes[reference].hdu
+
+    def seed(hdu_index):
+        # the predicted WCS of the chip if its position is known, else only the pointing of the reference.
+        if hdu_index == reference_hdu:
+            return reference_wcs, 'seeded'
+        if hdu_index in origins and reference_hdu in origins:
+            return predict_wcs(reference_wcs, origins[hdu_index] - origins[reference_hdu]), 'seeded'
+        return reference_wcs, 'solved'
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = {}
+        for i, plane in enumerate(planes):
+            if solutions[i] is not None or plane.index is not None:
+                continue
+            predicted_wcs, method = seed(plane.hdu)
+            if method == 'seeded' and not solve_seeded:
+                solutions[i] = PlaneSolution(plane, predicted_wcs.to_header(), len(all_sources[i]), 'offset', None)
+            else:
+                futures[i] = executor.submit(seeded_solve, i, predicted_wcs, method)
+
+        # the planes of the cubes, in order, each from the previous one.
+        cubes = {}
+        for i, plane in enumerate(planes):
+            if plane.index is not None:
+                cubes.setdefault(plane.hdu, []).append(i)
+        for hdu_index, indices in cubes.items():
+            tracker = SequenceTracker(**(tracker_kwargs or {}))
+            if hdu_index == reference_hdu:
+                start = indices.index(reference)
+                # both ways from the reference plane.
+                sequences = [indices[start:], indices[start::-1]]
+            else:
+                sequences = [indices]
+            for sequence in sequences:
+                tracker.reset()
+                for i in sequence:
+                    if i == reference:
+                        tracker.update(solutions[i].wcs, all_sources[i])
+                        continue
+                    solution = None
+                    if tracker.has_reference:
+                        try:
+                            with stage(metrics, 'track'):
+                                tracked_wcs = tracker.track(all_sources[i])
+                            solution = PlaneSolution(planes[i], tracked_wcs, len(all_sources[i]), 'tracked', None)
+                        except CouldNotSolveError as e:
+                            logger.info(f"plate_solve_planes: tracking lost on {planes[i].name} ({e}), solving it.")
+                    if solution is None and tracker.has_reference:
+                        solution = seeded_solve(i, tracker.wcs, 'seeded')
+                    elif solution is None:
+                        solution = seeded_solve(i, *seed(hdu_index))
+                    solutions[i] = solution
+                    if solution.wcs is not None:
+                        tracker.update(solution.wcs, all_sources[i])
+                    else:
+                        tracker.reset()
+
+        for i, future in futures.items():
+            solutions[i] = future.result()
+
+    n_solved = sum(solution.wcs is not None for solution in solutions)
+    logger.info(f"plate_solve_planes: {n_solved} of {len(planes)} planes of {fits_file_path} solved")
+    if write_to_file and n_solved > 0:
+        with stage(metrics, 'write_wcs'):
+            write_plane_solutions(fits_file_path, solutions)
+    return solutions
@@ -11,7 +11,7 @@ def plot_stars_with_wcs(fits_file_path, sources=None, savepath=None):
 
     Parameters:
     fits_file_path (str): Path to the updated FITS file with WCS.
-    sources (astropy.table.Table): Table of detected sources.
+    sources (SourceList or astropy.table.Table): detected sources.
     """
     with fits.open(fits_file_path) as hdul:
         wcs = WCS(hdul[0].header)
@@ -44,7 +44,7 @@ def plot_stars(sources, image, savepath=None):
     Plot the image with detected sources marked (for debugging).
 
     Parameters:
-    sources (astropy.table.Table): Table of detected sources.
+    sources (SourceList or astropy.table.Table): detected sources.
     image (numpy.ndarray): Image data.
     """
     plt.figure(figsize=(15, 15))
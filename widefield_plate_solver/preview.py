@@ -0,0 +1,219 @@
+import logging
+import multiprocessing.util
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def bin_image(image, max_size=1024):
+    """
+    Average the image in square blocks, so that its longest side is at most max_size pixels.
+    Read band by band: works on memory-mapped images without loading them whole.
+
+    Parameters:
+    image (numpy.ndarray): 2D image, possibly memory-mapped.
+    max_size (int): longest side of the result, in pixels.
+
+    Returns:
+    the binned image (float32), and the binning factor.
+    """
+    height, width = image.shape
+    factor = max(1, int(np.ceil(max(height, width) / max_size)))
+    if factor == 1:
+        # a copy: the image may be a buffer about to be reused.
+        return np.array(image[:, :], dtype=np.float32), 1
+    n_rows, n_columns = height // factor, width // factor
+    binned = np.empty((n_rows, n_columns), dtype=np.float32)
+    for row in range(n_rows):
+        band = np.asarray(image[row * factor:(row + 1) * factor, :n_columns * factor], dtype=np.float32)
+        binned[row] = band.reshape(factor, n_columns, factor).mean(axis=(0, 2))
+    return binned, factor
+
+
+def _binned_positions(sources, factor):
+    # pixel centers of the blocks, as astropy slices a WCS.
+    x = (np.asarray(sources['xcentroid']) - (factor - 1) / 2) / factor
+    y = (np.asarray(sources['ycentroid']) - (factor - 1) / 2) / factor
+    return x, y
+
+
+def render_preview(image, savepath, sources=None, wcs=None, max_size=1024, factor=1, title=None):
+    """
+    Quick-look JPEG (or PNG...) of an image: binned to max_size pixels, zscale computed on the binned pixels,
+    rendered with the Agg backend without going through pyplot (no display needed, usable from any thread).
+    The output has about the size of the binned image.
+
+    Parameters:
+    image (numpy.ndarray): 2D image.
+    savepath (Path or str): where to write it, the format given by the extension.
+    sources (SourceList or astropy.table.Table): if provided, circled (xcentroid, ycentroid in pixels of the
+                                                 original image).
+    wcs (astropy.wcs.WCS): if provided, a coordinate grid is overlaid.
+    max_size (int): longest side of the image in the output, in pixels.
+    factor (int): binning already applied to the image (see bin_image).
+    title (str): title of the figure.
+    """
+    from astropy.visualization import ZScaleInterval
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    image, more_factor = bin_image(image, max_size)
+    factor *= more_factor
+
+    vmin, vmax = ZScaleInterval(contrast=0.1).get_limits(image[np.isfinite(image)])
+    dpi = 100
+    height, width = image.shape
+    # room for the labels around the image.
+    margin = 0.8 if wcs is not None else 0.1
+    fig = Figure(figsize=(width / dpi + 2 * margin, height / dpi + 2 * margin), dpi=dpi)
+    FigureCanvasAgg(fig)
+    rect = [margin / fig.get_figwidth(), margin / fig.get_figheight(),
+            1 - 2 * margin / fig.get_figwidth(), 1 - 2 * margin / fig.get_figheight()]
+    if wcs is not None:
+        binned_wcs = wcs.celestial.slice((slice(None, None, factor), slice(None, None, factor)))
+        ax = fig.add_axes(rect, projection=binned_wcs)
+        ax.coords.grid(color='white', ls='solid', alpha=0.5)
+        ax.set_xlabel('Right Ascension')
+        ax.set_ylabel('Declination')
+    else:
+        ax = fig.add_axes(rect)
+        ax.set_axis_off()
+    ax.imshow(image, cmap='gray', origin='lower', vmin=vmin, vmax=vmax, interpolation='nearest')
+
+    if sources is not None and len(sources) > 0:
+        x, y = _binned_positions(sources, factor)
+        ax.scatter(x, y, s=60, facecolors='none', edgecolors='red', linewidths=0.8, alpha=0.7)
+        ax.set_xlim(-0.5, width - 0.5)
+        ax.set_ylim(-0.5, height - 0.5)
+    if title is not None:
+        ax.set_title(title)
+    fig.savefig(savepath, dpi=dpi)
+
+
+def render_fits_preview(fits_file_path, savepath, sources=None, max_size=1024, wcs=None):
+    """
+    render_preview of the primary image of a FITS file, read memory-mapped and binned band by band,
+    with its WCS as a coordinate grid.
+
+    Parameters:
+    fits_file_path (Path or str): Path to the FITS file.
+    savepath (Path or str): where to write the preview.
+    sources (SourceList or astropy.table.Table): if provided, circled.
+    max_size (int): longest side of the image in the output, in pixels.
+    wcs (astropy.io.fits.Header): the WCS to show, e.g. as returned by plate_solve. If None, the one in the
+                                  header of the file (if any).
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    with fits.open(fits_file_path, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        image, factor = bin_image(hdul[0].data, max_size)
+    # scaling commutes with the binning.
+    image = image * header.get('BSCALE', 1.) + header.get('BZERO', 0.)
+    wcs = WCS(header if wcs is None else wcs)
+    if not wcs.is_celestial:
+        wcs = None
+    render_preview(image, savepath, sources=sources, wcs=wcs, max_size=max_size, factor=factor,
+                   title=Path(fits_file_path).name)
+
+
+class PreviewRenderer:
+    """
+    Renders previews in background threads, so that solving never waits for the JPEG.
+
+    submit() bins the image right away (cheap, and the image may be a buffer reused for the next frame), the
+    rendering itself happens in the background. At most max_pending previews wait: beyond that, submit blocks
+    rather than piling up images in memory.
+
+        with PreviewRenderer(max_size=800) as renderer:
+            renderer.submit(image, 'frame_sources.jpeg', sources=sources)
+            renderer.submit_fits('frame.fits', 'frame.jpeg')
+        # all written here.
+    """
+
+    def __init__(self, max_size=1024, n_threads=1, max_pending=8):
+        """
+        Parameters:
+        max_size (int): longest side of the images in the previews, in pixels.
+        n_threads (int): number of previews rendered at the same time.
+        max_pending (int): maximum number of previews waiting to be rendered.
+        """
+        # imported here rather than in the threads: importing concurrently with the caller (e.g. while astropy
+        # emits warnings, which walk sys.modules) is not safe.
+        import astropy.visualization  # noqa: F401
+        import astropy.wcs  # noqa: F401
+        import matplotlib.backends.backend_agg  # noqa: F401
+        import matplotlib.figure  # noqa: F401
+
+        self.max_size = max_size
+        self._executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix='preview')
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Wait for the previews submitted so far.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _run(self, function, *args, **kwargs):
+        try:
+            function(*args, **kwargs)
+        except Exception as e:
+            # a diagnostic, not worth failing anything for.
+            logger.warning(f"PreviewRenderer: could not render {args[1]} ({e})")
+        finally:
+            self._pending.release()
+
+    def submit(self, image, savepath, sources=None, wcs=None, max_size=None):
+        """
+        Queue render_preview of an image.
+
+        Returns:
+        concurrent.futures.Future, done once written.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        binned, factor = bin_image(image, max_size)
+        self._pending.acquire()
+        return self._executor.submit(self._run, render_preview, binned, savepath, sources=sources, wcs=wcs,
+                                     max_size=max_size, factor=factor)
+
+    def submit_fits(self, fits_file_path, savepath, sources=None, max_size=None, wcs=None):
+        """
+        Queue render_fits_preview of a FITS file.
+
+        Returns:
+        concurrent.futures.Future, done once written.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        self._pending.acquire()
+        return self._executor.submit(self._run, render_fits_preview, fits_file_path, savepath, sources=sources,
+                                     max_size=max_size, wcs=wcs)
+
+
+_default_renderer = None
+_default_renderer_lock = threading.Lock()
+
+
+def default_renderer():
+    """
+    The PreviewRenderer shared by the debug plots of extract_stars; the previews still pending when the
+    process exits are written first.
+    """
+    global _default_renderer
+    with _default_renderer_lock:
+        if _default_renderer is None:
+            _default_renderer = PreviewRenderer()
+            # also run when a worker process of plate_solve_many exits, unlike atexit.
+            multiprocessing.util.Finalize(_default_renderer, _default_renderer.close, exitpriority=10)
+    return _default_renderer
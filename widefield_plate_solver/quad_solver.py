@@ -0,0 +1,545 @@
+"""
+In-process blind solver: a triangle hash index built from a star catalog, no external binary or network.
+
+Stars of the catalog are thinned to a uniform density (the brightest few per sky cell), and each star forms
+triangles with its nearest neighbours. A triangle is described by the ratios of its sides, which do not change
+with position, rotation and scale: those are the hash codes. For an image, the same is done with the brightest
+sources, codes are looked up in the index with a KD-tree, every close code gives a candidate pointing,
+and the most voted candidate pointings are verified by projecting the catalog onto the image. The solution is
+then fitted to all the sources matched to all the catalog stars of the field, which the index also keeps.
+"""
+import json
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from scipy.spatial import cKDTree
+
+from .exceptions import CouldNotSolveError
+from .fits_io import write_wcs_to_fits
+from .metrics import stage, count
+from .sources import as_source_list
+
+logger = logging.getLogger(__name__)
+
+
+magnitude_columns = ['mag', 'phot_g_mean_mag', 'gmag', 'vmag', 'vtmag', 'btmag', 'rmag']
+
+
+def read_catalog(catalog):
+    """
+    Read a star catalog into ra, dec, mag arrays.
+
+    Parameters:
+    catalog: (ra, dec) or (ra, dec, mag) arrays in degrees, or the path to a FITS table or a structured
+             .npy file with ra and dec columns, and ideally a magnitude column (e.g. Gaia's phot_g_mean_mag).
+             Without magnitudes, the stars are assumed to be sorted brightest first.
+
+    Returns:
+    ra, dec, mag numpy arrays.
+    """
+    if isinstance(catalog, (str, Path)):
+        catalog = Path(catalog)
+        if catalog.suffix == '.npy':
+            table = np.load(catalog)
+            names = table.dtype.names
+        else:
+            table = Table.read(catalog)
+            names = table.colnames
+        lower = {name.lower(): name for name in names}
+        ra, dec = np.asarray(table[lower['ra']], dtype=float), np.asarray(table[lower['dec']], dtype=float)
+        mag_column = next((lower[m] for m in magnitude_columns if m in lower), None)
+        mag = np.asarray(table[mag_column], dtype=float) if mag_column else np.arange(len(ra), dtype=float)
+    else:
+        ra, dec = np.asarray(catalog[0], dtype=float), np.asarray(catalog[1], dtype=float)
+        mag = np.asarray(catalog[2], dtype=float) if len(catalog) > 2 else np.arange(len(ra), dtype=float)
+    good = np.isfinite(ra) & np.isfinite(dec) & np.isfinite(mag)
+    return ra[good], dec[good], mag[good]
+
+
+def _unit_vectors(ra, dec):
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack((np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)), axis=-1)
+
+
+def _radec(unit_vectors):
+    x, y, z = np.moveaxis(unit_vectors, -1, 0)
+    return np.degrees(np.arctan2(y, x)) % 360, np.degrees(np.arcsin(np.clip(z, -1, 1)))
+
+
+def _gnomonic(ra, dec, ra0, dec0):
+    """
+    Tangent plane coordinates (xi, eta) in degrees of ra, dec around ra0, dec0 (all in degrees, broadcast).
+    """
+    ra, dec, ra0, dec0 = np.radians(ra), np.radians(dec), np.radians(ra0), np.radians(dec0)
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    xi = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c
+    return np.degrees(xi), np.degrees(eta)
+
+
+def _chord(angle_degrees):
+    return 2 * np.sin(np.radians(angle_degrees) / 2)
+
+
+def _fibonacci_sphere(n_points):
+    i = np.arange(n_points) + 0.5
+    z = 1 - 2 * i / n_points
+    phi = np.pi * (1 + 5**0.5) * i
+    r = np.sqrt(1 - z**2)
+    return np.column_stack((r * np.cos(phi), r * np.sin(phi), z))
+
+
+def _keep_brightest_per_cell(cells, brightness_rank, n_per_cell):
+    """
+    Indices of the n_per_cell brightest (lowest rank) elements of each cell.
+    """
+    order = np.lexsort((brightness_rank, cells))
+    sorted_cells = cells[order]
+    first_of_cell = np.searchsorted(sorted_cells, sorted_cells, side='left')
+    rank_in_cell = np.arange(len(order)) - first_of_cell
+    return order[rank_in_cell < n_per_cell]
+
+
+def _neighbour_triangles(points, n_neighbours):
+    """
+    (T, 3) array of unique triangles formed by each point and pairs of its nearest neighbours.
+    """
+    k = min(n_neighbours + 1, len(points))
+    if k < 3:
+        return np.zeros((0, 3), dtype=np.int32)
+    _, neighbours = cKDTree(points).query(points, k=k)
+    i, j = np.triu_indices(k - 1, 1)
+    triangles = np.stack((np.repeat(neighbours[:, 0], len(i)),
+                          neighbours[:, 1:][:, i].ravel(),
+                          neighbours[:, 1:][:, j].ravel()), axis=1)
+    triangles = np.unique(np.sort(triangles, axis=1), axis=0)
+    return triangles.astype(np.int32)
+
+
+def _triangle_codes(points, triangles, min_side_gap):
+    """
+    Scale and rotation invariant codes of triangles: (shortest side / longest, middle side / longest).
+    Vertices are reordered by the length of the side opposite to them, so that matched triangles have
+    matched vertices. Triangles with nearly equal sides, where this order is ambiguous, are dropped.
+
+    Returns:
+    codes (T', 2), ordered triangles (T', 3)
+    """
+    p = points[triangles]
+    # side opposite to vertex 0, 1, 2
+    opposite = np.stack((np.linalg.norm(p[:, 1] - p[:, 2], axis=1),
+                         np.linalg.norm(p[:, 0] - p[:, 2], axis=1),
+                         np.linalg.norm(p[:, 0] - p[:, 1], axis=1)), axis=1)
+    order = np.argsort(opposite, axis=1)
+    sides = np.take_along_axis(opposite, order, axis=1)
+    triangles = np.take_along_axis(triangles, order, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        codes = sides[:, :2] / sides[:, 2:]
+    good = ((sides[:, 1] - sides[:, 0] > min_side_gap * sides[:, 2]) &
+            (sides[:, 2] - sides[:, 1] > min_side_gap * sides[:, 2]) &
+            np.isfinite(codes).all(axis=1))
+    return codes[good], triangles[good]
+
+
+def build_quad_index(catalog, index_path, field_radius, stars_per_cell=3, n_neighbours=5, code_tolerance=0.005):
+    """
+    Build a triangle hash index from a star catalog, for images of a given field size.
+
+    Parameters:
+    catalog: see read_catalog, e.g. the path to a Gaia or Tycho subset as a FITS table.
+    index_path (Path or str): directory where the index is written (a few .npy files, memory-mapped when loaded).
+    field_radius (float): degrees, half diagonal of the images to solve. Images from about 0.6 to 1.6 times
+                          this size solve fine, build one index per field size otherwise.
+    stars_per_cell (int): number of stars kept in each quarter-field cell of the sky.
+    n_neighbours (int): each star forms triangles with pairs of this many nearest neighbours.
+    code_tolerance (float): expected code accuracy, triangles whose vertex order is ambiguous
+                            at this level are not indexed.
+
+    Returns:
+    QuadIndex
+    """
+    index_path = Path(index_path)
+    index_path.mkdir(parents=True, exist_ok=True)
+
+    ra, dec, mag = read_catalog(catalog)
+    xyz = _unit_vectors(ra, dec)
+
+    # same relative density as the image side: cells of a quarter of the field diagonal.
+    cell_area = np.radians(field_radius / 2)**2
+    n_cells = max(int(4 * np.pi / cell_area), 1)
+    centers = _fibonacci_sphere(n_cells)
+    _, cells = cKDTree(centers).query(xyz)
+
+    # the whole catalog too, sorted by cell, to fit the solutions to all the stars of the field.
+    by_cell = np.lexsort((mag, cells))
+    np.save(index_path / 'catalog_radec.npy', np.column_stack((ra[by_cell], dec[by_cell])))
+    np.save(index_path / 'catalog_mag.npy', mag[by_cell])
+    np.save(index_path / 'catalog_cell_starts.npy', np.searchsorted(cells[by_cell], np.arange(n_cells + 1)))
+
+    keep = _keep_brightest_per_cell(cells, mag, stars_per_cell)
+    keep = keep[np.argsort(mag[keep])]
+    ra, dec, mag, xyz = ra[keep], dec[keep], mag[keep], xyz[keep]
+
+    # chord lengths are angles at these small scales, good enough for similarity-invariant codes.
+    triangles = _neighbour_triangles(xyz, n_neighbours)
+    codes, triangles = _triangle_codes(xyz, triangles, 2 * code_tolerance)
+
+    np.save(index_path / 'stars_radec.npy', np.column_stack((ra, dec)))
+    np.save(index_path / 'stars_mag.npy', mag)
+    np.save(index_path / 'triangles.npy', triangles)
+    np.save(index_path / 'codes.npy', codes.astype(np.float32))
+    meta = {'field_radius': field_radius, 'n_cells': n_cells, 'stars_per_cell': stars_per_cell,
+            'n_neighbours': n_neighbours, 'code_tolerance': code_tolerance}
+    with open(index_path / 'meta.json', 'w') as f:
+        json.dump(meta, f)
+
+    logger.info(f"build_quad_index: {len(ra)} stars, {len(triangles)} triangles written to {index_path}")
+    return QuadIndex(index_path)
+
+
+class QuadIndex:
+    """
+    A triangle hash index written by build_quad_index, loaded memory-mapped.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = Path(index_path)
+        with open(self.index_path / 'meta.json') as f:
+            self.meta = json.load(f)
+        self.field_radius = self.meta['field_radius']
+        self.stars_radec = np.load(self.index_path / 'stars_radec.npy', mmap_mode='r')
+        self.triangles = np.load(self.index_path / 'triangles.npy', mmap_mode='r')
+        self.codes = np.load(self.index_path / 'codes.npy', mmap_mode='r')
+        if (self.index_path / 'catalog_radec.npy').exists():
+            self.catalog_radec = np.load(self.index_path / 'catalog_radec.npy', mmap_mode='r')
+            self.catalog_mag = np.load(self.index_path / 'catalog_mag.npy', mmap_mode='r')
+            self.catalog_cell_starts = np.load(self.index_path / 'catalog_cell_starts.npy')
+        else:
+            # built before the index kept the whole catalog: only its stars.
+            self.catalog_radec = None
+        self._code_tree = None
+        self._star_tree = None
+        self._cell_tree = None
+
+    @property
+    def code_tree(self):
+        if self._code_tree is None:
+            self._code_tree = cKDTree(self.codes)
+        return self._code_tree
+
+    @property
+    def star_tree(self):
+        if self._star_tree is None:
+            self._star_tree = cKDTree(_unit_vectors(self.stars_radec[:, 0], self.stars_radec[:, 1]))
+        return self._star_tree
+
+    def stars_around(self, ra, dec, radius):
+        """
+        ra, dec of the index stars within radius (degrees) of ra, dec.
+        """
+        indices = self.star_tree.query_ball_point(_unit_vectors(ra, dec), r=_chord(radius))
+        stars = self.stars_radec[np.sort(np.asarray(indices, dtype=int))]
+        return stars[:, 0], stars[:, 1]
+
+    def catalog_around(self, ra, dec, radius):
+        """
+        ra, dec, mag of all the catalog stars within radius (degrees) of ra, dec (mag None for an index built
+        without the whole catalog: then only its stars).
+        """
+        if self.catalog_radec is None:
+            ra_stars, dec_stars = self.stars_around(ra, dec, radius)
+            return ra_stars, dec_stars, None
+        if self._cell_tree is None:
+            self._cell_tree = cKDTree(_fibonacci_sphere(self.meta['n_cells']))
+        # the cells whose center is within radius plus the size of a cell, then the stars one by one.
+        cells = np.sort(np.asarray(self._cell_tree.query_ball_point(_unit_vectors(ra, dec),
+                                                                    r=_chord(radius + self.field_radius / 2)),
+                                   dtype=int))
+        starts, ends = self.catalog_cell_starts[cells], self.catalog_cell_starts[cells + 1]
+        rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] + [np.zeros(0, int)])
+        stars = np.asarray(self.catalog_radec[rows])
+        around = np.linalg.norm(_unit_vectors(stars[:, 0], stars[:, 1]) - _unit_vectors(ra, dec),
+                                axis=1) < _chord(radius)
+        return stars[around, 0], stars[around, 1], np.asarray(self.catalog_mag[rows])[around]
+
+
+def _image_triangles(xy, width, cell_size, index):
+    """
+    Same selection as in the index: brightest sources per cell, then nearest neighbour triangles.
+    xy is sorted brightest first, cell_size in pixels should match the sky size of the index cells.
+    """
+    n_cells_x = int(np.ceil(width / cell_size))
+    cells = (np.clip(xy[:, 1] // cell_size, 0, None) * n_cells_x + np.clip(xy[:, 0] // cell_size, 0, None))
+    keep = np.sort(_keep_brightest_per_cell(cells.astype(int), np.arange(len(xy)), index.meta['stars_per_cell']))
+    points = xy[keep]
+    triangles = _neighbour_triangles(points, index.meta['n_neighbours'])
+    codes, triangles = _triangle_codes(points, triangles, index.meta['code_tolerance'])
+    return points, codes, triangles
+
+
+def _cell_sizes(width, height, index, scale_min, scale_max):
+    """
+    Image cell sizes (pixels) to try, such that the density of the image stars matches that of the index.
+    """
+    if scale_min is not None and scale_max is not None:
+        # from the pixel scale range, in steps of 30%.
+        n_steps = max(int(np.ceil(np.log(scale_max / scale_min) / np.log(1.3))), 1)
+        scales = np.sqrt(scale_min * scale_max) * 1.3**(np.arange(n_steps) - (n_steps - 1) / 2)
+        return 3600 * (index.field_radius / 2) / scales
+    # blind: assume the image is about the size the index was built for, then a bit smaller, a bit bigger ...
+    half_diagonal = 0.5 * np.hypot(width, height)
+    return half_diagonal / 2 * np.array([1., 1.3, 1 / 1.3, 1.3**2, 1 / 1.3**2])
+
+
+def _fit_tangent_plane(pixels, xi, eta):
+    """
+    Least squares affine transformation from pixels (n, 2) to tangent plane coordinates, works on stacks
+    of candidates: pixels (..., n, 2), xi and eta (..., n).
+
+    Returns:
+    cd (..., 2, 2), offset (..., 2) such that (xi, eta) = cd @ pixel + offset.
+    """
+    design = np.concatenate((pixels, np.ones(pixels.shape[:-1] + (1,))), axis=-1)
+    target = np.stack((xi, eta), axis=-1)
+    if design.shape[-2] == 3:
+        solution = np.linalg.solve(design, target)
+    else:
+        solution = np.linalg.lstsq(design, target, rcond=None)[0]
+    cd = np.swapaxes(solution[..., :2, :], -1, -2)
+    return cd, solution[..., 2, :]
+
+
+def _make_wcs(ra0, dec0, cd, offset):
+    # crpix is where the tangent plane coordinates vanish, +1 as FITS pixels start at 1.
+    crpix0 = -np.linalg.solve(cd, offset)
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra0, dec0]
+    wcs.wcs.crpix = crpix0 + 1
+    wcs.wcs.cd = cd
+    wcs.wcs.set()
+    return wcs
+
+
+def _project(wcs, ra, dec):
+    xi, eta = _gnomonic(ra, dec, *wcs.wcs.crval)
+    return (np.stack((xi, eta), axis=-1) @ np.linalg.inv(wcs.wcs.cd).T) + (wcs.wcs.crpix - 1)
+
+
+def _verify(index, wcs, image_tree, width, height, match_radius):
+    """
+    Project the index stars around the field onto the image, and match them to the sources.
+
+    Returns:
+    number of index stars landing in the image, indices of the matched sources, matched ra, dec
+    """
+    center_ra, center_dec = wcs.all_pix2world([[width / 2, height / 2]], 0)[0]
+    scale = np.sqrt(abs(np.linalg.det(wcs.wcs.cd)))
+    ra, dec = index.stars_around(center_ra, center_dec, 1.1 * scale * 0.5 * np.hypot(width, height))
+    xy = _project(wcs, ra, dec)
+    inside = (xy[:, 0] >= 0) & (xy[:, 0] < width) & (xy[:, 1] >= 0) & (xy[:, 1] < height)
+    distances, indices = image_tree.query(xy[inside], distance_upper_bound=match_radius)
+    matched = np.isfinite(distances)
+    return inside.sum(), indices[matched], ra[inside][matched], dec[inside][matched]
+
+
+def plate_solve_with_index(fits_file_path, sources, index,
+                           ra_approx=None, dec_approx=None, search_radius=None,
+                           scale_min=None, scale_max=None, use_n_brightest_only=None,
+                           min_matches=8, match_radius=2., max_candidates=50, max_rms=1.5, solution_index=None,
+                           write_to_file=True, header=None, metrics=None):
+    """
+    Calculate the WCS in-process with a triangle hash index built by build_quad_index.
+
+    Parameters:
+    fits_file_path (Path or str): Path to the FITS file.
+    sources (SourceList or astropy.table.Table): detected sources.
+    index (QuadIndex, or Path or str): the index, or the directory it was written to.
+    ra_approx (float): Approximate RA in degrees.
+    dec_approx (float): Approximate DEC in degrees.
+    search_radius (float): degrees around ra_approx, dec_approx where the field center can be. Default: the
+                           field radius of the index.
+    scale_min (float): lowest pixel scale to consider in arcsec/pixel
+    scale_max (float): largest pixel scale to consider in arcsec/pixel
+    use_n_brightest_only (int): number of sources to consider. If None using all. The triangles are always built
+                                from the brightest sources at the density of the index, the others are only used
+                                to verify the solution.
+    min_matches (int): number of index stars that must land on a source to accept a solution.
+    match_radius (float): pixels, distance for an index star to match a source.
+    max_candidates (int): number of candidate pointings to verify, most voted first.
+    max_rms (float): pixels. A verified candidate is fitted to all the sources matched to all the catalog stars
+                     of the field (PL-RMS and PL-NREF in the header), and accepted if the rms of that fit is
+                     below this.
+    solution_index (SolutionIndex): if provided, record the solution there.
+    write_to_file (bool): write the WCS to the FITS file (and solution_index). If False, only return it.
+    header (astropy.io.fits.Header): primary header of the file, if already read (e.g. FitsFrame.header).
+    metrics (SolveMetrics): if provided, records the time spent loading the index and searching it, and the
+                            number of cell sizes tried.
+
+    Returns:
+    WCS header if successful.
+    Also, updates the given fits file with the same WCS if successful.
+    """
+    logger.info(f"plate_solve_with_index on {fits_file_path}")
+    start_time = time.time()
+    if not isinstance(index, QuadIndex):
+        with stage(metrics, 'load_index'):
+            index = QuadIndex(index)
+    if use_n_brightest_only is None:
+        use_n_brightest_only = len(sources)
+
+    if header is None:
+        header = fits.getheader(fits_file_path)
+    width, height = header['NAXIS1'], header['NAXIS2']
+
+    sources = as_source_list(sources)
+    xy = np.column_stack(sources.positions(use_n_brightest_only)).astype(float)
+    if len(xy) < min_matches:
+        raise CouldNotSolveError(f'plate_solve_with_index: only {len(xy)} sources, need at least {min_matches}.')
+    image_tree = cKDTree(xy)
+
+    for cell_size in _cell_sizes(width, height, index, scale_min, scale_max):
+        count(metrics, 'cell_sizes')
+        with stage(metrics, 'quad_search'):
+            wcs = _solve_with_cell_size(xy, image_tree, sources, width, height, cell_size, index,
+                                        ra_approx, dec_approx, search_radius, scale_min, scale_max,
+                                        min_matches, match_radius, max_candidates, max_rms)
+        if wcs is not None:
+            if write_to_file:
+                logger.info(f"plate_solve_with_index: {fits_file_path} solved, writing the WCS")
+                write_wcs_to_fits(fits_file_path, wcs)
+                if solution_index is not None:
+                    solution_index.record(fits_file_path, wcs, header=header, solve_time=time.time() - start_time)
+            return wcs
+
+    logger.error("plate_solve_with_index: no candidate verified.")
+    raise CouldNotSolveError('failed to solve astrometry')
+
+
+def _solve_with_cell_size(xy, image_tree, sources, width, height, cell_size, index,
+                          ra_approx, dec_approx, search_radius, scale_min, scale_max,
+                          min_matches, match_radius, max_candidates, max_rms):
+    """
+    One attempt of plate_solve_with_index, selecting the image stars with the given cell size.
+
+    Returns:
+    WCS header if verified, None otherwise.
+    """
+    # 1. look up the image triangles in the index.
+    points, codes, image_triangles = _image_triangles(xy, width, cell_size, index)
+    if len(codes) == 0:
+        return None
+    neighbours = index.code_tree.query_ball_point(codes, r=index.meta['code_tolerance'])
+    counts = np.array([len(n) for n in neighbours])
+    if counts.sum() == 0:
+        return None
+    image_tri = np.repeat(image_triangles, counts, axis=0)
+    index_tri = np.asarray(index.triangles)[np.concatenate([np.asarray(n, dtype=int) for n in neighbours])]
+
+    # 2. one candidate WCS per matched triangle pair, all at once.
+    star_ra, star_dec = index.stars_radec[:, 0], index.stars_radec[:, 1]
+    tri_ra, tri_dec = star_ra[index_tri], star_dec[index_tri]
+    center_ra, center_dec = _radec(_unit_vectors(tri_ra, tri_dec).mean(axis=1))
+    xi, eta = _gnomonic(tri_ra, tri_dec, center_ra[:, None], center_dec[:, None])
+    cd, offset = _fit_tangent_plane(points[image_tri], xi, eta)
+
+    # a real match is a similarity (no shear), with a plausible pixel scale and pointing.
+    singular_values = np.linalg.svd(cd, compute_uv=False)
+    scale = 3600 * np.sqrt(singular_values[:, 0] * singular_values[:, 1])
+    good = singular_values[:, 1] > 0.95 * singular_values[:, 0]
+    if scale_min is not None:
+        good &= scale >= scale_min
+    if scale_max is not None:
+        good &= scale <= scale_max
+    # field center: tangent plane coordinates of the image center, back to the sky
+    field_xieta = np.einsum('nij,j->ni', cd, [width / 2, height / 2]) + offset
+    field_xyz = _deproject(field_xieta, center_ra, center_dec)
+    if ra_approx is not None and dec_approx is not None:
+        if search_radius is None:
+            search_radius = index.field_radius
+        distance = np.linalg.norm(field_xyz - _unit_vectors(ra_approx, dec_approx), axis=1)
+        good &= distance < _chord(search_radius)
+    if not good.any():
+        return None
+
+    # 3. vote: true matches agree on the field center, scale and orientation.
+    idx = np.flatnonzero(good)
+    angle = np.degrees(np.arctan2(cd[idx, 1, 0], cd[idx, 0, 0]))
+    position_bin = np.floor(field_xyz[idx] / _chord(index.field_radius / 20)).astype(np.int64)
+    bins = np.column_stack((position_bin, np.floor(np.log(scale[idx]) / 0.05), np.floor(angle / 5.)))
+    _, bin_of, votes = np.unique(bins, axis=0, return_inverse=True, return_counts=True)
+    bin_of = bin_of.ravel()
+    ranking = np.argsort(-votes[bin_of], kind='stable')
+    # one candidate per bin is enough.
+    _, first_of_bin = np.unique(bin_of[ranking], return_index=True)
+    candidates = idx[ranking[np.sort(first_of_bin)]][:max_candidates]
+
+    # 4. verify.
+    for candidate in candidates:
+        wcs = _make_wcs(center_ra[candidate], center_dec[candidate], cd[candidate], offset[candidate])
+        n_inside, matched_sources, matched_ra, matched_dec = _verify(index, wcs, image_tree,
+                                                                     width, height, 3 * match_radius)
+        if len(matched_sources) < min_matches:
+            continue
+        # refine with all matched stars around the image center, then check again, stricter.
+        for _ in range(2):
+            ra0, dec0 = wcs.all_pix2world([[width / 2, height / 2]], 0)[0]
+            xi, eta = _gnomonic(matched_ra, matched_dec, ra0, dec0)
+            wcs = _make_wcs(ra0, dec0, *_fit_tangent_plane(xy[matched_sources], xi, eta))
+            n_inside, matched_sources, matched_ra, matched_dec = _verify(index, wcs, image_tree,
+                                                                         width, height, match_radius)
+            if len(matched_sources) < 3:
+                break
+        if len(matched_sources) >= min_matches and len(matched_sources) >= 0.3 * n_inside:
+            logger.info(f"plate_solve_with_index: {len(matched_sources)} of {n_inside} index stars matched")
+            header = _refit(wcs, sources, index, width, height, min_matches, match_radius, max_rms)
+            if header is not None:
+                return header
+    return None
+
+
+def _refit(wcs, sources, index, width, height, min_matches, match_radius, max_rms):
+    """
+    Fit a verified solution to all the sources matched to all the catalog stars of the field (refine_wcs at
+    order 1): the few index stars it was verified with are too few for an accurate solution.
+
+    Returns:
+    WCS header, None if there are too few matches or their rms is over max_rms pixels.
+    """
+    from .refine import refine_wcs
+
+    center_ra, center_dec = wcs.all_pix2world([[width / 2, height / 2]], 0)[0]
+    scale = np.sqrt(abs(np.linalg.det(wcs.wcs.cd)))
+    ra, dec, mag = index.catalog_around(center_ra, center_dec, 1.1 * scale * 0.5 * np.hypot(width, height))
+    catalog = (ra, dec) if mag is None else (ra, dec, mag)
+    try:
+        header, residuals = refine_wcs(wcs.to_header(), sources, catalog, width, height, sip_order=1,
+                                       match_radius=match_radius, min_matches=min_matches)
+    except CouldNotSolveError as e:
+        logger.info(f"plate_solve_with_index: candidate rejected ({e})")
+        return None
+    rms = residuals.rms / (3600 * scale)
+    if rms > max_rms:
+        logger.info(f"plate_solve_with_index: candidate rejected, rms of {rms:.2f} pixels over "
+                    f"{residuals.n_matched} stars")
+        return None
+    return header
+
+
+def _deproject(xieta, ra0, dec0):
+    """
+    Unit vectors of tangent plane coordinates (n, 2) in degrees around ra0, dec0 (n,).
+    """
+    xi, eta = np.radians(xieta[:, 0]), np.radians(xieta[:, 1])
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    # local basis at the tangent point: east, north, and the tangent point itself.
+    point = np.stack((np.cos(dec0) * np.cos(ra0), np.cos(dec0) * np.sin(ra0), np.sin(dec0)), axis=1)
+    east = np.stack((-np.sin(ra0), np.cos(ra0), np.zeros_like(ra0)), axis=1)
+    north = np.stack((-np.sin(dec0) * np.cos(ra0), -np.sin(dec0) * np.sin(ra0), np.cos(dec0)), axis=1)
+    vector = point + xi[:, None] * east + eta[:, None] * north
+    return vector / np.linalg.norm(vector, axis=1, keepdims=True)
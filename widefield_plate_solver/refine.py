@@ -0,0 +1,277 @@
+"""
+Refinement of a solution with all the sources: solve-field (or the API) only sees the brightest few stars, and
+on wide fields its WCS drifts away towards the edges. Here the whole source list is matched to a reference
+catalog through that first WCS, and a TAN-SIP solution of a higher order is fitted to all the matches by linear
+least squares, with sigma clipping of the mismatches. No second solve.
+"""
+import logging
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+from astropy.wcs import WCS, Sip
+from scipy.spatial import cKDTree
+
+from .exceptions import CouldNotSolveError
+from .sources import as_source_list
+
+logger = logging.getLogger(__name__)
+
+
+AstrometricResiduals = namedtuple('AstrometricResiduals',
+                                  ['n_matched', 'n_rejected', 'sip_order', 'rms', 'median', 'p90', 'max',
+                                   'rms_before'])
+AstrometricResiduals.__doc__ = """
+Quality of a refined solution: `n_matched` sources matched to the catalog and kept in the fit, `n_rejected` those
+clipped as mismatches, `sip_order` the order fitted, `rms`, `median`, `p90` (90th percentile) and `max` of the
+distances between the sources and their catalog star in arcsec, and `rms_before` the rms of the same matches with
+the WCS before refinement.
+"""
+
+
+def _terms(order):
+    # exponents (p, q) of u^p v^q, from order 1 up.
+    return [(p, total - p) for total in range(1, order + 1) for p in range(total, -1, -1)]
+
+
+def _design(u, v, terms, norm):
+    # normalized coordinates, for a well conditioned least squares.
+    u, v = u / norm, v / norm
+    return np.stack([np.ones_like(u)] + [u**p * v**q for p, q in terms], axis=-1)
+
+
+def _tangent_wcs(crval):
+    # pixels of this WCS are the intermediate world coordinates in degrees, around crval.
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = crval
+    wcs.wcs.crpix = [1., 1.]
+    wcs.wcs.cd = np.eye(2)
+    wcs.wcs.set()
+    return wcs
+
+
+def _catalog_around(catalog, ra, dec, radius):
+    """
+    ra, dec and mag of the catalog stars within radius (degrees) of ra, dec.
+    """
+    from .quad_solver import QuadIndex, read_catalog
+
+    if isinstance(catalog, QuadIndex):
+        if catalog.catalog_radec is None:
+            # only the few stars of the quads: not enough to refine on.
+            raise ValueError("refine_wcs: this QuadIndex does not keep its whole catalog, rebuild it with "
+                             "build_quad_index.")
+        return catalog.catalog_around(ra, dec, radius)
+    if isinstance(catalog, (str, Path)) or len(catalog) < 3:
+        catalog = read_catalog(catalog)
+    ra_stars, dec_stars, mag = (np.asarray(column, dtype=float) for column in catalog[:3])
+    # angular distance from the dot product of the unit vectors.
+    ra0, dec0 = np.radians(ra), np.radians(dec)
+    cos_distance = (np.sin(dec0) * np.sin(np.radians(dec_stars)) +
+                    np.cos(dec0) * np.cos(np.radians(dec_stars)) * np.cos(np.radians(ra_stars) - ra0))
+    around = cos_distance > np.cos(np.radians(radius))
+    return ra_stars[around], dec_stars[around], mag[around]
+
+
+def match_catalog(wcs, x, y, ra, dec, width, height, match_radius):
+    """
+    Match the sources to the catalog stars projected through the WCS, one to one, nearest first.
+
+    Parameters:
+    wcs (astropy.wcs.WCS): the solution.
+    x, y (numpy arrays): 0-based pixel positions of the sources.
+    ra, dec (numpy arrays): the catalog, in degrees.
+    width, height (int): size of the image.
+    match_radius (float): pixels.
+
+    Returns:
+    indices of the matched sources, indices of their catalog stars.
+    """
+    projected = np.column_stack(wcs.all_world2pix(ra, dec, 0, quiet=True))
+    inside = np.flatnonzero(np.all(np.isfinite(projected), axis=1) &
+                            (projected[:, 0] > -match_radius) & (projected[:, 0] < width + match_radius) &
+                            (projected[:, 1] > -match_radius) & (projected[:, 1] < height + match_radius))
+    if len(inside) == 0 or len(x) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    distances, source_indices = cKDTree(np.column_stack((x, y))).query(projected[inside],
+                                                                       distance_upper_bound=match_radius)
+    matched = np.isfinite(distances)
+    distances, source_indices, star_indices = distances[matched], source_indices[matched], inside[matched]
+    # a source claimed by several stars keeps the closest one.
+    order = np.argsort(distances)
+    _, first = np.unique(source_indices[order], return_index=True)
+    keep = order[first]
+    return source_indices[keep], star_indices[keep]
+
+
+def _fit(u, v, ra, dec, crval, order, norm):
+    """
+    Polynomial from the pixel offsets (u, v) to the intermediate world coordinates, the tangent point being
+    moved to where the constant term vanishes.
+
+    Returns:
+    crval, terms, coefficients (1 + len(terms), 2) in degrees for normalized u, v.
+    """
+    terms = _terms(order)
+    design = _design(u, v, terms, norm)
+    for _ in range(5):
+        xi_eta = np.column_stack(_tangent_wcs(crval).wcs_world2pix(ra, dec, 0))
+        coefficients = np.linalg.lstsq(design, xi_eta, rcond=None)[0]
+        offset = coefficients[0]
+        if np.hypot(*offset) < 1e-9:
+            break
+        crval = _tangent_wcs(crval).wcs_pix2world(offset[None, :], 0)[0]
+    return crval, terms, coefficients
+
+
+def _sip_wcs(crval, crpix, terms, coefficients, order, norm, width, height):
+    """
+    The TAN-SIP WCS of a fitted polynomial, with its inverse (AP, BP) fitted on a grid over the image.
+    """
+    scaled = {term: coefficients[1 + i] / norm**sum(term) for i, term in enumerate(terms)}
+    cd = np.column_stack((scaled[(1, 0)], scaled[(0, 1)]))
+    wcs = WCS(naxis=2)
+    wcs.wcs.crval = crval
+    wcs.wcs.crpix = crpix
+    wcs.wcs.cd = cd
+    if order < 2:
+        wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        wcs.wcs.set()
+        return wcs
+
+    wcs.wcs.ctype = ['RA---TAN-SIP', 'DEC--TAN-SIP']
+    # (xi, eta) = CD (u + f(u, v), v + g(u, v)): the higher terms brought back to pixels are the SIP terms.
+    inverse_cd = np.linalg.inv(cd)
+    a, b = np.zeros((order + 1, order + 1)), np.zeros((order + 1, order + 1))
+    for (p, q), coefficient in scaled.items():
+        if p + q >= 2:
+            a[p, q], b[p, q] = inverse_cd @ coefficient
+
+    # inverse polynomial, one order higher, from a grid of the forward one.
+    u, v = (grid.ravel() for grid in np.meshgrid(np.linspace(0, width, 25) - (crpix[0] - 1),
+                                                 np.linspace(0, height, 25) - (crpix[1] - 1)))
+    forward_terms = [(p, q) for p, q in _terms(order) if p + q >= 2]
+    design = np.stack([u**p * v**q for p, q in forward_terms], axis=-1)
+    big_u = u + design @ np.array([a[p, q] for p, q in forward_terms])
+    big_v = v + design @ np.array([b[p, q] for p, q in forward_terms])
+    inverse_order = order + 1
+    inverse_terms = _terms(inverse_order)
+    inverse_design = _design(big_u, big_v, inverse_terms, norm)
+    inverse = np.linalg.lstsq(inverse_design, np.column_stack((u - big_u, v - big_v)), rcond=None)[0]
+    ap, bp = np.zeros((inverse_order + 1, inverse_order + 1)), np.zeros((inverse_order + 1, inverse_order + 1))
+    ap[0, 0], bp[0, 0] = inverse[0]
+    for i, (p, q) in enumerate(inverse_terms):
+        ap[p, q], bp[p, q] = inverse[1 + i] / norm**(p + q)
+
+    wcs.sip = Sip(a, b, ap, bp, wcs.wcs.crpix)
+    wcs.wcs.set()
+    return wcs
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    # in degrees, haversine: exact at small distances.
+    ra1, dec1, ra2, dec2 = (np.radians(angle) for angle in (ra1, dec1, ra2, dec2))
+    sin_half = np.sqrt(np.sin((dec2 - dec1) / 2)**2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2)**2)
+    return np.degrees(2 * np.arcsin(np.clip(sin_half, 0, 1)))
+
+
+def _distances(wcs, x, y, ra, dec):
+    """
+    Distances in arcsec between the sources seen through the WCS and their catalog stars.
+    """
+    return 3600 * _separation(*wcs.all_pix2world(x, y, 0), ra, dec)
+
+
+def refine_wcs(wcs_header, sources, catalog, width, height, sip_order=3, match_radius=3., clip_sigma=3.,
+               max_iterations=5, min_matches=20, max_residual=None):
+    """
+    Refine a plate solution with all the sources matched to a reference catalog.
+
+    The catalog stars around the field are projected through the WCS and matched to the sources with a KD-tree.
+    A TAN-SIP solution of order sip_order is fitted to the matches by least squares, rejecting the matches
+    beyond clip_sigma times the robust rms, until no more are rejected. The sources are then matched again
+    through the refined WCS (reaching the edges of the field), and fitted once more.
+    The order is lowered if there are not enough matches for it (at least 3 per coefficient).
+
+    Parameters:
+    wcs_header (astropy.io.fits.Header): the solution to refine.
+    sources (SourceList or astropy.table.Table): detected sources, all of them.
+    catalog: (ra, dec, mag) arrays in degrees, the path to a catalog file (see quad_solver.read_catalog, better
+             read once for many frames), or a QuadIndex (the whole catalog it was built from).
+    width, height (int): size of the image in pixels.
+    sip_order (int): order of the polynomial, 1 for a plain TAN solution.
+    match_radius (float): pixels, distance to the projected catalog star under which a source is matched.
+    clip_sigma (float): rejection threshold, in units of the robust rms of the distances.
+    max_iterations (int): of the sigma clipping.
+    min_matches (int): fewest matches accepted.
+    max_residual (float): if provided, arcsec, largest rms accepted.
+
+    Raises CouldNotSolveError if there are fewer than min_matches matches, or if the rms exceeds max_residual:
+    then the solution is likely wrong.
+
+    Returns:
+    refined WCS header, AstrometricResiduals.
+    """
+    initial_wcs = WCS(wcs_header)
+    sources = as_source_list(sources)
+    x, y = np.asarray(sources['x'], dtype=float), np.asarray(sources['y'], dtype=float)
+
+    center = initial_wcs.all_pix2world([[(width - 1) / 2, (height - 1) / 2]], 0)[0]
+    corners = initial_wcs.all_pix2world([[0, 0], [width - 1, 0], [0, height - 1], [width - 1, height - 1]], 0)
+    radius = 1.1 * np.max(_separation(center[0], center[1], corners[:, 0], corners[:, 1]))
+    ra, dec, mag = _catalog_around(catalog, *center, radius)
+    if len(ra) > 3 * len(x):
+        # deeper than the sources: the faint stars would only make false matches.
+        brightest = np.argsort(mag)[:3 * len(x)]
+        ra, dec = ra[brightest], dec[brightest]
+
+    crpix = np.array([(width + 1) / 2, (height + 1) / 2])
+    norm = 0.5 * np.hypot(width, height)
+    wcs = initial_wcs
+    for _ in range(2):
+        source_indices, star_indices = match_catalog(wcs, x, y, ra, dec, width, height, match_radius)
+        n_matches = len(source_indices)
+        if n_matches < min_matches:
+            raise CouldNotSolveError(f"refine_wcs: only {n_matches} sources matched to the catalog.")
+        order = sip_order
+        while order > 1 and n_matches < 3 * (len(_terms(order)) + 1):
+            order -= 1
+        u, v = x[source_indices] - (crpix[0] - 1), y[source_indices] - (crpix[1] - 1)
+        ra_matched, dec_matched = ra[star_indices], dec[star_indices]
+
+        def fit(keep):
+            crval, terms, coefficients = _fit(u[keep], v[keep], ra_matched[keep], dec_matched[keep],
+                                              initial_wcs.wcs.crval, order, norm)
+            wcs = _sip_wcs(crval, crpix, terms, coefficients, order, norm, width, height)
+            return wcs, _distances(wcs, x[source_indices], y[source_indices], ra_matched, dec_matched)
+
+        keep = np.ones(n_matches, dtype=bool)
+        for _ in range(max_iterations):
+            wcs, distances = fit(keep)
+            # the median of a 2D gaussian distance is 1.18 sigma, its rms 1.41 sigma.
+            robust_rms = 1.2 * np.median(distances[keep])
+            new_keep = distances < clip_sigma * max(robust_rms, 1e-3)
+            if np.array_equal(new_keep, keep) or new_keep.sum() < min_matches:
+                break
+            keep = new_keep
+        else:
+            # out of iterations: the fit (and its residuals) of the last matches kept.
+            wcs, distances = fit(keep)
+
+    distances_before = _distances(initial_wcs, x[source_indices][keep], y[source_indices][keep],
+                                  ra_matched[keep], dec_matched[keep])
+    kept = distances[keep]
+    residuals = AstrometricResiduals(int(keep.sum()), int(n_matches - keep.sum()), order,
+                                     float(np.sqrt(np.mean(kept**2))), float(np.median(kept)),
+                                     float(np.percentile(kept, 90)), float(kept.max()),
+                                     float(np.sqrt(np.mean(distances_before**2))))
+    logger.info(f"refine_wcs: {residuals.n_matched} matches ({residuals.n_rejected} rejected), order {order}, "
+                f"rms {residuals.rms_before:.2f} -> {residuals.rms:.2f} arcsec")
+    if max_residual is not None and residuals.rms > max_residual:
+        raise CouldNotSolveError(f"refine_wcs: rms of {residuals.rms:.2f} arcsec, over {max_residual}.")
+
+    header = wcs.to_header(relax=True)
+    header['PL-RMS'] = (round(residuals.rms, 4), 'arcsec, rms of the catalog matches')
+    header['PL-NREF'] = (residuals.n_matched, 'sources matched to the catalog')
+    return header, residuals
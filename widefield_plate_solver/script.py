@@ -1,25 +1,118 @@
 #!/usr/bin/env python
 import argparse
+import os
+import signal
+import threading
 from pathlib import Path
-from widefield_plate_solver import plate_solve
-from widefield_plate_solver.plotter import plot_stars_with_wcs
+# only what every run needs here, the rest is imported when its option is used: starting up stays fast.
+from widefield_plate_solver import plate_solve, SolveMetrics, MetricsRecorder
 
 
 def main():
     parser = argparse.ArgumentParser(description="Plate solve astronomical images. We will extract the sources.")
-    parser.add_argument("fits_file_path", help="Path to the FITS file to add astrometry to.")
+    parser.add_argument("fits_file_path", nargs='+',
+                        help="Path to the FITS file to add astrometry to. "
+                             "Several paths or glob patterns (e.g. 'night/*.fits') solve them as a batch. "
+                             "With --watch, the directories to watch.")
     parser.add_argument("--do_not_guess_from_header", action="store_false", help="No guess from the fits header.")
     parser.add_argument("--use_api", action="store_true", help="Use API for plate solving. Else use local installation.")
+    parser.add_argument("--api_url", default='http://nova.astrometry.net',
+                        help="Root URL of the astrometry.net API server, default nova.astrometry.net.")
+    parser.add_argument("--escalate", action="store_true",
+                        help="Try a tight solve with 15 stars, then a wider one with 40 stars, then a blind one, "
+                             "then the API, until one succeeds.")
+    parser.add_argument("--race", action="store_true",
+                        help="With --escalate, run all those attempts at once and keep the first solution.")
+    parser.add_argument("--wcs_write_mode", choices=['update', 'in_place', 'sidecar', 'atomic'],
+                        help="How to store the solution: 'update' the FITS file (may rewrite it whole if its header "
+                             "grows), rewrite only its header 'in_place' (sidecar if no room), write a 'sidecar' "
+                             ".wcs file next to it, or write an updated copy and rename it over the file ('atomic', "
+                             "safe for concurrent readers). Default 'update', 'atomic' with --lease_dir.")
+    parser.add_argument("--solver_profile", choices=['lean', 'bounded', 'parallel', 'full'], default='lean',
+                        help="How to run solve-field: 'lean' writes only the solution, in /dev/shm when available; "
+                             "'bounded' also gives up after 60 s of CPU (120 s wall clock); 'parallel' also searches "
+                             "all index files at once; 'full' keeps all solve-field outputs, on disk.")
+    parser.add_argument("--cpulimit", type=int, help="CPU seconds after which solve-field gives up on a frame.")
+    parser.add_argument("--timeout", type=float, help="Seconds after which solve-field is killed on a frame.")
+    parser.add_argument("--refine_catalog",
+                        help="Reference star catalog (FITS table or .npy with ra, dec and a magnitude column) "
+                             "covering the fields: each solution is refined with all the extracted sources matched "
+                             "to it, with a higher order SIP fit.")
+    parser.add_argument("--sip_order", type=int, default=3, help="With --refine_catalog, order of the fit. Default 3.")
+    parser.add_argument("--max_residual", type=float,
+                        help="With --refine_catalog, reject the solutions whose matches have an rms over this "
+                             "many arcsec.")
     parser.add_argument("--redo", action="store_true", help="Redo plate solving even if already done")
     parser.add_argument("--verbose", action="store_true", help="Print the WCS if success.")
     parser.add_argument("--plot", action="store_true", help="Plot the field with coordinate grid overlayed if success.")
+    parser.add_argument("--plot_size", type=int, default=1024,
+                        help="Longest side of the image in the plots, in pixels (the image is binned to it). "
+                             "Default 1024.")
     parser.add_argument("--ra_approx", type=float, help="Approximate RA in degrees.")
     parser.add_argument("--dec_approx", type=float, help="Approximate DEC in degrees.")
     parser.add_argument("--scale_min", type=float, help="Lowest pixel scale to consider in arcsec/pixel.")
     parser.add_argument("--scale_max", type=float, help="Largest pixel scale to consider in arcsec/pixel.")
     parser.add_argument("--use_n_brightest_only", type=int, help="Default 15. Number of sources to use, Brightest first.")
+    parser.add_argument("--tile_size", type=int,
+                        help="Extract the sources in tiles of this many pixels on a side, for very large sensors.")
+    parser.add_argument("--low_memory", action="store_true",
+                        help="Extract the sources in float32 from the memory-mapped file, with in-place background "
+                             "subtraction.")
+    parser.add_argument("--budgeted_extraction", action="store_true",
+                        help="Extract only the sources we use (see --use_n_brightest_only) in a single pass, "
+                             "faster on crowded fields.")
+    parser.add_argument("--source_cache", help="Directory caching the extracted sources, to skip the extraction "
+                                                "when solving a frame again.")
+    parser.add_argument("--source_cache_size", type=float, default=2048., help="Size limit of the cache in MB.")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="Only extract the sources of the given files into the --source_cache, no solving.")
+    parser.add_argument("--solution_index",
+                        help="SQLite database of the solved frames: skips those already solved without opening them, "
+                             "and guesses the pointing of new frames from previous solves of the same target "
+                             "(only the pixel scale from the same instrument).")
+    parser.add_argument("--metrics_jsonl",
+                        help="Append the timings of each stage of each solve to this JSON lines file.")
+    parser.add_argument("--metrics_prometheus",
+                        help="Write histograms of the stage timings and solve counts to this Prometheus textfile "
+                             "(for node_exporter's textfile collector).")
+    parser.add_argument("--watch", action="store_true",
+                        help="Daemon mode: watch the given directories and solve each new frame once written, "
+                             "until interrupted. Progress is kept in --progress_file, so a restart resumes.")
+    parser.add_argument("--progress_file",
+                        help="With --watch, the file recording the frames already processed. "
+                             "Default: .plate_solve_progress.jsonl in the first directory.")
+    parser.add_argument("--settle_time", type=float, default=2.,
+                        help="With --watch, seconds a file must stay unchanged before it is solved. Default 2.")
+    parser.add_argument("--poll_interval", type=float, default=5.,
+                        help="With --watch, seconds between two listings of the directories when inotify is not "
+                             "available or with --no_inotify. Default 5.")
+    parser.add_argument("--no_inotify", action="store_true",
+                        help="With --watch, list the directories periodically instead of using inotify "
+                             "(e.g. for network filesystems written by other machines).")
+    parser.add_argument("--retry_failed", action="store_true",
+                        help="With --watch, try again the frames that failed before the restart. With --lease_dir, "
+                             "those marked failed in the lease directory.")
+    parser.add_argument("--all_planes", action="store_true",
+                        help="Solve every image of the files: each extension of multi-extension files (e.g. mosaic "
+                             "cameras) and each plane of data cubes, the first solution seeding the others.")
+    parser.add_argument("--lease_dir",
+                        help="Distributed mode: solve the files together with the other workers started with the "
+                             "same files and --lease_dir (a directory on the shared storage), on this node or others. "
+                             "Each frame is solved once, those of dead workers are taken over. Not with --all_planes.")
+    parser.add_argument("--worker_id", help="With --lease_dir, name of this worker. Default: host name and pid.")
+    parser.add_argument("--lease_timeout", type=float, default=300.,
+                        help="With --lease_dir, seconds without heartbeat after which the frames of a worker are "
+                             "taken over. Default 300.")
+    parser.add_argument("--workers", type=int,
+                        help="Batch mode: number of source extraction processes. Default: number of CPUs.")
+    parser.add_argument("--solvers", type=int, help="Batch mode: number of concurrent solves. Default: same as workers.")
 
     args = parser.parse_args()
+    if args.lease_dir is not None and args.all_planes:
+        # plate_solve_planes writes all the planes of a file in one update, not through the leases.
+        parser.error("--all_planes cannot be used with --lease_dir")
+    if args.wcs_write_mode is None:
+        args.wcs_write_mode = 'atomic' if args.lease_dir is not None else 'update'
 
     if args.ra_approx is not None or args.dec_approx is not None or args.scale_min is not None or args.scale_max is not None:
         use_existing_wcs_as_guess = False
@@ -28,24 +121,232 @@ def main():
 
     use_n_brightest_only = 15 if args.use_n_brightest_only is None else args.use_n_brightest_only
 
-    wcs_header = plate_solve(args.fits_file_path, sources=None, use_api=args.use_api, redo_if_done=args.redo,
-                             use_existing_wcs_as_guess=use_existing_wcs_as_guess,
-                             ra_approx=args.ra_approx, dec_approx=args.dec_approx,
-                             scale_min=args.scale_min, scale_max=args.scale_max,
-                             use_n_brightest_only=use_n_brightest_only, do_debug_plot=args.plot)
+    extract_kwargs = {}
+    if args.tile_size is not None:
+        extract_kwargs['tile_size'] = args.tile_size
+    if args.low_memory:
+        extract_kwargs['low_memory'] = True
+    if args.budgeted_extraction:
+        extract_kwargs['n_brightest'] = use_n_brightest_only
+    if args.plot:
+        extract_kwargs['debug_plot_size'] = args.plot_size
+
+    source_cache = None
+    if args.source_cache is not None:
+        from widefield_plate_solver import SourceCache
+        source_cache = SourceCache(args.source_cache, max_bytes=int(args.source_cache_size * 1024**2))
+    elif args.prewarm:
+        parser.error("--prewarm needs a --source_cache directory.")
+
+    solution_index = None
+    if args.solution_index is not None:
+        from widefield_plate_solver import SolutionIndex
+        solution_index = SolutionIndex(args.solution_index)
+
+    solver_profile = args.solver_profile
+    if args.cpulimit is not None or args.timeout is not None:
+        from widefield_plate_solver import solver_profiles
+        solver_profile = solver_profiles[args.solver_profile]
+        if args.cpulimit is not None:
+            solver_profile = solver_profile._replace(cpulimit=args.cpulimit)
+        if args.timeout is not None:
+            solver_profile = solver_profile._replace(timeout=args.timeout)
+
+    # plate_solve arguments of the refinement, the catalog read once for all the frames.
+    refinement = {}
+    if args.refine_catalog is not None:
+        from widefield_plate_solver.quad_solver import read_catalog
+        refinement = dict(refine_catalog=read_catalog(args.refine_catalog),
+                          refine_kwargs=dict(sip_order=args.sip_order, max_residual=args.max_residual))
+
+    recorder = None
+    if args.metrics_jsonl is not None or args.metrics_prometheus is not None:
+        recorder = MetricsRecorder(jsonl_path=args.metrics_jsonl, prometheus_path=args.metrics_prometheus)
+
+    from widefield_plate_solver.batch import expand_fits_file_paths
+    fits_file_paths = expand_fits_file_paths(args.fits_file_path)
+    if args.prewarm:
+        n_cached = source_cache.prewarm(fits_file_paths, n_workers=args.workers, extract_kwargs=extract_kwargs)
+        print(f"Sources of {n_cached} of {len(fits_file_paths)} files in the cache.")
+        return
+
+    # with --escalate, the plan decides which attempts use the API.
+    plan = None
+    if args.escalate:
+        from widefield_plate_solver import default_plan
+        plan = default_plan
+    if plan is not None and args.use_api:
+        parser.error("--escalate already ends with an API attempt, do not combine it with --use_api.")
+
+    # one API session for all the frames. (without a key, the API attempt of the plan fails, the others still run)
+    use_api_client = args.use_api or (plan is not None and 'astrometry_net_api_key' in os.environ)
+    api_client = None
+    if use_api_client:
+        from widefield_plate_solver import AstrometryNetClient
+        api_client = AstrometryNetClient(base_url=args.api_url)
+    try:
+        if api_client is not None:
+            api_client.start()
+        if args.watch:
+            watch(args, use_existing_wcs_as_guess, use_n_brightest_only, extract_kwargs, source_cache,
+                  solution_index, api_client, plan, recorder, solver_profile, refinement)
+            return
+        if args.lease_dir is not None:
+            distributed_solve(fits_file_paths, args, use_existing_wcs_as_guess, use_n_brightest_only,
+                              extract_kwargs, source_cache, solution_index, api_client, plan, recorder,
+                              solver_profile, refinement)
+            return
+        if args.all_planes:
+            solve_planes(fits_file_paths, args, use_n_brightest_only, extract_kwargs, api_client, plan,
+                         solver_profile)
+            return
+        if len(fits_file_paths) != 1 or fits_file_paths[0] != args.fits_file_path[0]:
+            # several files or a glob: batch mode.
+            batch_solve(fits_file_paths, args, use_existing_wcs_as_guess, use_n_brightest_only, extract_kwargs,
+                        source_cache, solution_index, api_client, plan, recorder, solver_profile, refinement)
+            return
+        fits_file_path = fits_file_paths[0]
+
+        wcs_header = plate_solve(fits_file_path, sources=None, use_api=args.use_api, redo_if_done=args.redo,
+                                 use_existing_wcs_as_guess=use_existing_wcs_as_guess,
+                                 ra_approx=args.ra_approx, dec_approx=args.dec_approx,
+                                 scale_min=args.scale_min, scale_max=args.scale_max,
+                                 use_n_brightest_only=use_n_brightest_only, do_debug_plot=args.plot,
+                                 extract_kwargs=extract_kwargs, source_cache=source_cache,
+                                 solution_index=solution_index, api_client=api_client,
+                                 plan=plan, parallel_plan=args.race, wcs_write_mode=args.wcs_write_mode,
+                                 solver_profile=solver_profile, **refinement,
+                                 metrics=None if recorder is None else SolveMetrics(fits_file_path, callback=recorder))
+    finally:
+        if api_client is not None:
+            api_client.close()
 
     if len(wcs_header) == 0:
-        print(f"Failed to solve field: {args.fits_file_path}")
+        print(f"Failed to solve field: {fits_file_path}")
         return
 
     if len(wcs_header) > 0 and args.plot:
-        savepath = Path(args.fits_file_path).with_suffix('.jpeg')
-        plot_stars_with_wcs(args.fits_file_path, savepath=savepath)
+        from widefield_plate_solver.preview import render_fits_preview
+        savepath = Path(fits_file_path).with_suffix('.jpeg')
+        render_fits_preview(fits_file_path, savepath, max_size=args.plot_size, wcs=wcs_header)
 
     if args.verbose:
         print("Plate solving completed. WCS Header:")
         print(wcs_header)
 
 
+def solve_planes(fits_file_paths, args, use_n_brightest_only, extract_kwargs, api_client, plan, solver_profile):
+    from widefield_plate_solver import plate_solve_planes
+
+    for fits_file_path in fits_file_paths:
+        solutions = plate_solve_planes(fits_file_path, n_threads=args.workers, redo_if_done=args.redo,
+                                       do_debug_plot=args.plot, extract_kwargs=extract_kwargs,
+                                       use_n_brightest_only=use_n_brightest_only, use_api=args.use_api,
+                                       ra_approx=args.ra_approx, dec_approx=args.dec_approx,
+                                       scale_min=args.scale_min, scale_max=args.scale_max, api_client=api_client,
+                                       plan=plan, parallel_plan=args.race, solver_profile=solver_profile)
+        for solution in solutions:
+            if solution.wcs is None:
+                print(f"Failed to solve {fits_file_path} {solution.plane.name} ({solution.error})")
+            elif args.verbose:
+                print(f"{fits_file_path} {solution.plane.name} ({solution.method}). WCS Header:")
+                print(solution.wcs)
+        n_solved = sum(solution.wcs is not None for solution in solutions)
+        print(f"Solved {n_solved} of {len(solutions)} planes of {fits_file_path}.")
+
+
+def watch(args, use_existing_wcs_as_guess, use_n_brightest_only, extract_kwargs, source_cache, solution_index,
+          api_client, plan, recorder, solver_profile, refinement):
+    from widefield_plate_solver.watch import watch_and_solve
+
+    # finish the frames being solved on ctrl-c or `kill`, then exit.
+    stop_event = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stop_event.set())
+
+    counts = watch_and_solve(args.fits_file_path, n_workers=args.solvers or 2, journal_path=args.progress_file,
+                             retry_failed=args.retry_failed, settle_time=args.settle_time,
+                             poll_interval=args.poll_interval, use_inotify=not args.no_inotify,
+                             stop_event=stop_event, metrics_callback=recorder,
+                             use_api=args.use_api, redo_if_done=args.redo, do_debug_plot=args.plot,
+                             extract_kwargs=extract_kwargs, source_cache=source_cache,
+                             solution_index=solution_index, api_client=api_client, plan=plan,
+                             parallel_plan=args.race, wcs_write_mode=args.wcs_write_mode,
+                             solver_profile=solver_profile, **refinement,
+                             use_existing_wcs_as_guess=use_existing_wcs_as_guess,
+                             ra_approx=args.ra_approx, dec_approx=args.dec_approx,
+                             scale_min=args.scale_min, scale_max=args.scale_max,
+                             use_n_brightest_only=use_n_brightest_only)
+    print(f"Solved {counts['solved']} fields, failed on {counts['failed']}.")
+
+
+def distributed_solve(fits_file_paths, args, use_existing_wcs_as_guess, use_n_brightest_only, extract_kwargs,
+                      source_cache, solution_index, api_client, plan, recorder, solver_profile, refinement):
+    from widefield_plate_solver import solve_distributed
+
+    # finish the frames being solved on ctrl-c or `kill`, then exit: the others stay for the other workers.
+    stop_event = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stop_event.set())
+
+    results = solve_distributed(fits_file_paths, args.lease_dir, worker_id=args.worker_id,
+                                n_solvers=args.solvers or 1, lease_timeout=args.lease_timeout,
+                                retry_failed=args.retry_failed, redo_if_done=args.redo, stop_event=stop_event,
+                                metrics_callback=recorder, wcs_write_mode=args.wcs_write_mode,
+                                use_api=args.use_api, do_debug_plot=args.plot, extract_kwargs=extract_kwargs,
+                                source_cache=source_cache, solution_index=solution_index, api_client=api_client,
+                                plan=plan, parallel_plan=args.race, solver_profile=solver_profile, **refinement,
+                                use_existing_wcs_as_guess=use_existing_wcs_as_guess,
+                                ra_approx=args.ra_approx, dec_approx=args.dec_approx,
+                                scale_min=args.scale_min, scale_max=args.scale_max,
+                                use_n_brightest_only=use_n_brightest_only)
+    n_solved = 0
+    for result in results:
+        if result.wcs is None:
+            print(f"Failed to solve field: {result.fits_file_path} ({result.error})")
+            continue
+        n_solved += 1
+        if args.verbose:
+            print(f"Plate solving completed for {result.fits_file_path}. WCS Header:")
+            print(result.wcs)
+    print(f"Solved {n_solved} of the {len(results)} fields taken by this worker.")
+
+
+def batch_solve(fits_file_paths, args, use_existing_wcs_as_guess, use_n_brightest_only, extract_kwargs,
+                source_cache, solution_index, api_client, plan, recorder, solver_profile, refinement):
+    from widefield_plate_solver import plate_solve_many
+    if args.plot:
+        from widefield_plate_solver.preview import PreviewRenderer
+        # the plots are rendered in the background while we go on, all written once the renderer is closed.
+        renderer = PreviewRenderer(max_size=args.plot_size)
+
+    results = plate_solve_many(fits_file_paths, n_workers=args.workers, n_solvers=args.solvers,
+                               redo_if_done=args.redo, do_debug_plot=args.plot, extract_kwargs=extract_kwargs,
+                               source_cache=source_cache, solution_index=solution_index,
+                               use_api=args.use_api, api_client=api_client, plan=plan, parallel_plan=args.race,
+                               wcs_write_mode=args.wcs_write_mode, metrics_callback=recorder,
+                               solver_profile=solver_profile, **refinement,
+                               use_existing_wcs_as_guess=use_existing_wcs_as_guess,
+                               ra_approx=args.ra_approx, dec_approx=args.dec_approx,
+                               scale_min=args.scale_min, scale_max=args.scale_max,
+                               use_n_brightest_only=use_n_brightest_only)
+
+    n_solved = 0
+    for result in results:
+        if result.error is not None or result.wcs is None or len(result.wcs) == 0:
+            print(f"Failed to solve field: {result.fits_file_path} ({result.error})")
+            continue
+        n_solved += 1
+        if args.plot:
+            savepath = Path(result.fits_file_path).with_suffix('.jpeg')
+            renderer.submit_fits(result.fits_file_path, savepath, wcs=result.wcs)
+        if args.verbose:
+            print(f"Plate solving completed for {result.fits_file_path}. WCS Header:")
+            print(result.wcs)
+    if args.plot:
+        renderer.close()
+    print(f"Solved {n_solved} of {len(results)} fields.")
+
+
 if __name__ == "__main__":
     main()
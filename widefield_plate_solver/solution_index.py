@@ -0,0 +1,144 @@
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+logger = logging.getLogger(__name__)
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS solutions (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER,
+    ra REAL,
+    dec REAL,
+    scale REAL,
+    target TEXT,
+    instrument TEXT,
+    solve_time REAL,
+    solved_at REAL,
+    wcs TEXT
+);
+CREATE INDEX IF NOT EXISTS solutions_target ON solutions (target, solved_at);
+CREATE INDEX IF NOT EXISTS solutions_instrument ON solutions (instrument, solved_at);
+"""
+
+
+class SolutionIndex:
+    """
+    A small SQLite database of the solved frames: path, modification time, WCS, center, pixel scale and
+    time spent solving.
+
+    With it, plate_solve knows a frame is done without opening it (as long as the file was not modified since),
+    and frames without any pointing information get the pointing of the last solve of the same target
+    (OBJECT keyword) as a hint, or only its pixel scale from the same instrument (INSTRUME keyword).
+    """
+
+    def __init__(self, db_path):
+        """
+        Parameters:
+        db_path (Path or str): the SQLite file, created if needed.
+        """
+        self.db_path = str(db_path)
+        with self._connect() as connection:
+            connection.executescript(_schema)
+
+    @contextmanager
+    def _connect(self):
+        # a connection per operation: safe to use from several threads and processes.
+        connection = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _key(fits_file_path):
+        return str(Path(fits_file_path).resolve())
+
+    def record(self, fits_file_path, wcs, header=None, solve_time=None):
+        """
+        Record a solved frame, after its WCS was written to it.
+
+        Parameters:
+        fits_file_path (Path or str): Path to the FITS file.
+        wcs (astropy.io.fits.Header): its WCS solution.
+        header (astropy.io.fits.Header): header of the frame, for its size, OBJECT and INSTRUME. Read if None.
+        solve_time (float): seconds spent solving.
+        """
+        if header is None:
+            header = fits.getheader(fits_file_path)
+        wcs_info = WCS(wcs)
+        width, height = header.get('NAXIS1', wcs.get('IMAGEW', 0)), header.get('NAXIS2', wcs.get('IMAGEH', 0))
+        ra, dec = wcs_info.all_pix2world([[(width - 1) / 2, (height - 1) / 2]], 0)[0]
+        scale = 3600 * (wcs_info.pixel_scale_matrix[0, 0]**2 + wcs_info.pixel_scale_matrix[0, 1]**2)**0.5
+        stat = os.stat(fits_file_path)
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO solutions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self._key(fits_file_path), stat.st_mtime_ns, stat.st_size, float(ra), float(dec), float(scale),
+                 header.get('OBJECT'), header.get('INSTRUME'), solve_time, time.time(), wcs.tostring())
+            )
+
+    def get(self, fits_file_path):
+        """
+        WCS header of this frame if it was solved and has not been modified since, None otherwise.
+        Only stats the file, does not open it.
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT mtime_ns, size, wcs FROM solutions WHERE path = ?',
+                                     (self._key(fits_file_path),)).fetchone()
+        if row is None:
+            return None
+        try:
+            stat = os.stat(fits_file_path)
+        except FileNotFoundError:
+            return None
+        if (stat.st_mtime_ns, stat.st_size) != (row[0], row[1]):
+            return None
+        return fits.Header.fromstring(row[2])
+
+    def unsolved(self, fits_file_paths):
+        """
+        The frames among fits_file_paths that are not in the index, or were modified since they were solved.
+        One query for all of them, then only a stat of each file.
+        """
+        with self._connect() as connection:
+            known = {path: (mtime_ns, size) for path, mtime_ns, size
+                     in connection.execute('SELECT path, mtime_ns, size FROM solutions')}
+        unsolved = []
+        for fits_file_path in fits_file_paths:
+            stat = os.stat(fits_file_path)
+            if known.get(self._key(fits_file_path)) != (stat.st_mtime_ns, stat.st_size):
+                unsolved.append(fits_file_path)
+        return unsolved
+
+    def hint(self, target=None, instrument=None):
+        """
+        Guess for a new frame from the previous solves: the pointing and pixel scale of the latest solve of the
+        same target, or else only the pixel scale of the latest solve of the same instrument (its pointing says
+        nothing about where a new target is, and searching around it would miss).
+
+        Returns:
+        (ra, dec, scale) in degrees and arcsec/pixel, ra and dec None if only the instrument matched,
+        or None if nothing matches.
+        """
+        with self._connect() as connection:
+            if target is not None:
+                row = connection.execute('SELECT ra, dec, scale FROM solutions WHERE target = ? '
+                                         'ORDER BY solved_at DESC LIMIT 1', (target,)).fetchone()
+                if row is not None:
+                    return row
+            if instrument is not None:
+                row = connection.execute('SELECT scale FROM solutions WHERE instrument = ? '
+                                         'ORDER BY solved_at DESC LIMIT 1', (instrument,)).fetchone()
+                if row is not None:
+                    return None, None, row[0]
+        return None
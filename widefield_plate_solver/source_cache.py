@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from . import extract_stars
+from .sources import SourceList, as_source_list
+
+logger = logging.getLogger(__name__)
+
+
+# extract_stars arguments that do not change the sources, left out of the cache key.
+_not_in_key = ['buffers', 'n_threads', 'debug_plot_path', 'debug_plot_size']
+# bump when the extraction changes, so that old entries are not used anymore.
+_cache_version = 1
+
+
+class SourceCache:
+    """
+    On-disk cache of extracted sources, so that solving a frame again (redo, other scale range or number of
+    stars, ...) does not extract its sources again.
+
+    Entries are keyed on a hash of the pixels of the frame and the extraction parameters: writing the WCS to the
+    header does not invalidate them. To avoid reading the pixels each time, the hash of each file is remembered
+    along with its size and modification time. Once the cache is above max_bytes, the least recently used
+    entries are deleted.
+
+    The cache is only a directory, it can be shared by processes (e.g., plate_solve_many's workers).
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        """
+        Parameters:
+        cache_dir (Path or str): directory of the cache, created if needed.
+        max_bytes (int): size limit of the cached sources.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        (self.cache_dir / 'sources').mkdir(parents=True, exist_ok=True)
+        (self.cache_dir / 'files').mkdir(parents=True, exist_ok=True)
+
+    def data_hash(self, fits_file_path, hdu=0):
+        """
+        Hash of the pixels of an HDU (the primary one by default, see extract_stars' hdu), reused as long as the
+        size and modification time of the file did not change.
+        """
+        fits_file_path = Path(fits_file_path).resolve()
+        stat = fits_file_path.stat()
+        record_name = json.dumps([str(fits_file_path), hdu])
+        record_path = self.cache_dir / 'files' / f"{hashlib.sha1(record_name.encode()).hexdigest()}.json"
+        try:
+            with open(record_path) as f:
+                record = json.load(f)
+            if record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+                return record['hash']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        with fits.open(fits_file_path) as hdul:
+            info = hdul[hdu].fileinfo()
+            data_start, data_span = info['datLoc'], info['datSpan']
+        digest = hashlib.blake2b(digest_size=20)
+        with open(fits_file_path, 'rb') as f:
+            f.seek(data_start)
+            remaining = data_span
+            while remaining > 0:
+                chunk = f.read(min(remaining, 16 * 1024**2))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+
+        record = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+        self._atomic_write(record_path, json.dumps(record).encode())
+        return record['hash']
+
+    def _entry_path(self, fits_file_path, extract_kwargs):
+        parameters = {key: value for key, value in (extract_kwargs or {}).items() if key not in _not_in_key}
+        data_hash = self.data_hash(fits_file_path, (extract_kwargs or {}).get('hdu', 0))
+        key = json.dumps([_cache_version, data_hash, parameters], sort_keys=True, default=str)
+        return self.cache_dir / 'sources' / f"{hashlib.sha1(key.encode()).hexdigest()}.npy"
+
+    def get(self, fits_file_path, extract_kwargs=None):
+        """
+        Cached sources of this file for these extract_stars arguments, None if not in the cache.
+        """
+        entry_path = self._entry_path(fits_file_path, extract_kwargs)
+        try:
+            sources = SourceList(np.load(entry_path))
+        except (OSError, ValueError):
+            return None
+        # mark as recently used.
+        os.utime(entry_path)
+        logger.info(f"SourceCache: sources of {fits_file_path} found in the cache")
+        return sources
+
+    def put(self, fits_file_path, extract_kwargs, sources):
+        """
+        Store the sources extracted from this file with these extract_stars arguments.
+        """
+        entry_path = self._entry_path(fits_file_path, extract_kwargs)
+        with tempfile.NamedTemporaryFile(dir=entry_path.parent, suffix='.tmp', delete=False) as f:
+            np.save(f, as_source_list(sources).as_array())
+        os.replace(f.name, entry_path)
+        self.evict()
+
+    def get_or_extract(self, fits_file_path, debug_plot_path=None, extract_kwargs=None):
+        """
+        extract_stars(fits_file_path, debug_plot_path, **extract_kwargs), through the cache.
+        """
+        sources = self.get(fits_file_path, extract_kwargs)
+        if sources is None:
+            sources = extract_stars(fits_file_path, debug_plot_path=debug_plot_path, **(extract_kwargs or {}))
+            self.put(fits_file_path, extract_kwargs, sources)
+        return sources
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir / 'sources'):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # evicted by another process meanwhile.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def prewarm(self, fits_file_paths, n_workers=None, extract_kwargs=None):
+        """
+        Extract the sources of files not in the cache yet, in a pool of processes.
+
+        Parameters:
+        fits_file_paths (str, Path or list): paths or glob patterns, e.g. "night/*.fits".
+        n_workers (int): number of processes. If None, number of CPUs.
+        extract_kwargs (dict): arguments of extract_stars, as they will be given when solving.
+
+        Returns:
+        number of files whose sources are now in the cache.
+        """
+        from .batch import expand_fits_file_paths
+
+        fits_file_paths = expand_fits_file_paths(fits_file_paths)
+        n_cached = 0
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_prewarm_one, self, path, extract_kwargs) for path in fits_file_paths]
+            for path, future in zip(fits_file_paths, futures):
+                try:
+                    future.result()
+                    n_cached += 1
+                except Exception as e:
+                    logger.info(f"SourceCache: could not extract the sources of {path} ({e})")
+        return n_cached
+
+    @staticmethod
+    def _atomic_write(path, content):
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as f:
+            f.write(content)
+        os.replace(f.name, path)
+
+
+def _prewarm_one(source_cache, fits_file_path, extract_kwargs):
+    source_cache.get_or_extract(fits_file_path, extract_kwargs=extract_kwargs)
@@ -0,0 +1,152 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# columns that are other names of the same values: sep's x, y are the xcentroid, ycentroid of photutils' finders.
+_aliases = [('x', 'xcentroid'), ('y', 'ycentroid')]
+# columns computed when asked for, not stored.
+_derived = {'elongation': lambda data: data['a'] / data['b']}
+
+
+def _with_aliases(data):
+    """
+    View of a structured array with the missing alias columns added, pointing to the same bytes (no copy).
+    """
+    fields = data.dtype.fields
+    layout = {name: fields[name][:2] for name in data.dtype.names}
+    for name, alias in _aliases:
+        if name in fields and alias not in fields:
+            layout[alias] = fields[name][:2]
+        elif alias in fields and name not in fields:
+            layout[name] = fields[alias][:2]
+    if len(layout) == len(data.dtype.names):
+        return data
+    dtype = np.dtype({'names': list(layout), 'formats': [f for f, _ in layout.values()],
+                      'offsets': [offset for _, offset in layout.values()], 'itemsize': data.dtype.itemsize})
+    return data.view(dtype)
+
+
+def brightest_indices(flux, n):
+    """
+    Indices of the n largest fluxes, largest first: a partial sort (argpartition), then only those n are sorted.
+    """
+    flux = np.asarray(flux)
+    if n is None or n >= len(flux):
+        return np.argsort(-flux, kind='stable')
+    if n <= 0:
+        return np.zeros(0, dtype=int)
+    top = np.argpartition(-flux, n - 1)[:n]
+    return top[np.argsort(-flux[top], kind='stable')]
+
+
+class SourceList:
+    """
+    The sources of a frame, as one numpy structured array (one row per source, the columns of sep: x, y, flux,
+    a, b, npix, flag...). xcentroid and ycentroid are other names of the x and y columns, not copies, and
+    elongation (a / b) is computed when asked for.
+
+    Used like the astropy Table it replaces:
+
+        sources['xcentroid']        # numpy view of a column
+        sources[:15]                # the first rows, a view
+        sources[sources['flux'] > 1000]
+        len(sources), sources.colnames, for source in sources: ...
+
+    and sources.to_table() for anything else. The functions taking sources accept astropy Tables as well
+    (see as_source_list).
+    """
+
+    def __init__(self, data):
+        """
+        Parameters:
+        data (numpy structured array): one row per source, with at least x, y (or xcentroid, ycentroid) and
+                                       preferably flux.
+        """
+        self.data = _with_aliases(np.asarray(data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self.data.dtype.names and key in _derived:
+                return _derived[key](self.data)
+            return self.data[key]
+        if isinstance(key, (int, np.integer)):
+            return self.data[key]
+        return SourceList(self.data[key])
+
+    def __repr__(self):
+        return f"<SourceList of {len(self)} sources, columns {', '.join(self.colnames)}>"
+
+    def __reduce__(self):
+        # without the aliases, not all numpy versions pickle overlapping columns.
+        return SourceList, (self.as_array(),)
+
+    @property
+    def colnames(self):
+        return list(self.data.dtype.names)
+
+    def as_array(self):
+        """
+        The columns as a plain structured array, without the aliases (e.g. to save it).
+        """
+        fields = self.data.dtype.fields
+        names, offsets = [], set()
+        for name in self.data.dtype.names:
+            # the aliases come after the columns they stand for.
+            if fields[name][1] not in offsets:
+                names.append(name)
+                offsets.add(fields[name][1])
+        if len(names) == len(fields):
+            return self.data
+        dtype = np.dtype({'names': names, 'formats': [fields[name][0] for name in names],
+                          'offsets': [fields[name][1] for name in names], 'itemsize': self.data.dtype.itemsize})
+        return self.data.view(dtype)
+
+    def to_table(self):
+        """
+        An astropy Table of the sources (a copy), with the xcentroid and ycentroid columns.
+        """
+        from astropy.table import Table
+
+        table = Table(self.as_array())
+        for name, alias in _aliases:
+            if name in table.colnames and alias not in table.colnames:
+                table[alias] = table[name]
+        return table
+
+    def brightest(self, n=None):
+        """
+        The n brightest sources, brightest first (all of them sorted if n is None).
+        """
+        return SourceList(self.data[brightest_indices(self.data['flux'], n)])
+
+    def positions(self, n=None):
+        """
+        x and y arrays of the n brightest sources, brightest first (in the order given if there is no flux).
+        """
+        if n is not None and 'flux' in self.data.dtype.names:
+            rows = brightest_indices(self.data['flux'], n)
+            return self.data['x'][rows], self.data['y'][rows]
+        return self.data['x'][:n], self.data['y'][:n]
+
+
+def as_source_list(sources):
+    """
+    The sources as a SourceList, without copying the columns when possible: an astropy Table (e.g. from
+    photutils, with xcentroid and ycentroid) or a structured array is wrapped, a SourceList returned as is.
+    """
+    if isinstance(sources, SourceList):
+        return sources
+    if hasattr(sources, 'as_array'):
+        sources = sources.as_array()
+        if isinstance(sources, np.ma.MaskedArray):
+            sources = sources.filled()
+    return SourceList(sources)
@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from astropy.io import fits
+
+from .exceptions import CouldNotSolveError
+from .fits_io import write_wcs_to_fits
+from .local_solver import plate_solve_locally
+from .metrics import count
+
+logger = logging.getLogger(__name__)
+
+
+SolveAttempt = namedtuple('SolveAttempt',
+                          ['name', 'backend', 'use_n_brightest_only', 'use_position', 'search_radius',
+                           'scale_widen', 'timeout', 'odds_to_solve'],
+                          defaults=['local', 15, True, 1., 1., None, 1e6])
+SolveAttempt.__doc__ = """
+One attempt of a solve plan:
+`backend` 'local' (solve-field) or 'api' (astrometry.net),
+`use_n_brightest_only` the number of sources to send,
+`use_position` whether to restrict the search to `search_radius` degrees around the approximate pointing,
+`scale_widen` widens the approximate scale range by this factor on both sides (None: no scale constraint),
+`timeout` in seconds (None: no limit), `odds_to_solve` for solve-field.
+"""
+
+# tight hint first, then less and less constrained.
+default_plan = [
+    SolveAttempt('tight', use_n_brightest_only=15, search_radius=1., scale_widen=1., timeout=30),
+    SolveAttempt('wide', use_n_brightest_only=40, search_radius=5., scale_widen=1.5, timeout=60),
+    SolveAttempt('blind', use_n_brightest_only=40, use_position=False, scale_widen=None, timeout=300),
+    SolveAttempt('api', backend='api', use_n_brightest_only=40, search_radius=5., scale_widen=1.5, timeout=600),
+]
+
+
+def solve_with_strategy(fits_file_path, sources, plan=None, parallel=False,
+                        ra_approx=None, dec_approx=None, scale_min=None, scale_max=None,
+                        api_client=None, solution_index=None, write_to_file=True, header=None,
+                        solver_profile=None, metrics=None):
+    """
+    Run a plan of solve attempts on a frame, until one succeeds.
+
+    In sequence, each attempt starts when the previous one failed or timed out. In parallel, all attempts
+    start at once and as soon as one succeeds the others are cancelled: their solve-field processes are killed,
+    and their API jobs are not waited for anymore (with an api_client; plate_solve_with_API can only be left
+    running in its thread). Either way, only the winning WCS is written to the file.
+
+    Parameters:
+    fits_file_path (Path or str): Path to the FITS file.
+    sources (SourceList or astropy.table.Table): detected sources.
+    plan (list of SolveAttempt): the attempts, in order. If None, default_plan.
+    parallel (bool): race the attempts instead of running them one after the other.
+    ra_approx (float): Approximate RA in degrees.
+    dec_approx (float): Approximate DEC in degrees.
+    scale_min (float): lowest pixel scale to consider in arcsec/pixel
+    scale_max (float): largest pixel scale to consider in arcsec/pixel
+    api_client (AstrometryNetClient): a started client for the 'api' attempts. If None, plate_solve_with_API.
+    solution_index (SolutionIndex): if provided, record the solution there.
+    write_to_file (bool): write the WCS to the FITS file (and solution_index). If False, only return it.
+    header (astropy.io.fits.Header): primary header of the file, if already read (e.g. FitsFrame.header).
+    solver_profile (SolverProfile or str): how to run solve-field for the 'local' attempts (see plate_solve_locally),
+                                           the timeout of each attempt taking precedence over the profile's.
+    metrics (SolveMetrics): if provided, passed to the backend of each attempt (the stages of parallel attempts
+                            add up), and counts the attempts started.
+
+    Returns:
+    WCS header of the first successful attempt.
+    Also, updates the given fits file with the same WCS.
+    """
+    if header is None:
+        header = fits.getheader(fits_file_path)
+    if plan is None:
+        plan = default_plan
+    start_time = time.time()
+
+    # attempts identical once the missing hints are dropped would only do the same work twice.
+    attempts, seen = [], set()
+    for attempt in plan:
+        arguments = _attempt_arguments(attempt, ra_approx, dec_approx, scale_min, scale_max)
+        key = (attempt.backend, attempt.odds_to_solve, tuple(sorted(arguments.items())))
+        if key in seen:
+            logger.info(f"solve_with_strategy: skipping attempt '{attempt.name}', same as a previous one here")
+            continue
+        seen.add(key)
+        attempts.append((attempt, arguments))
+    if not attempts:
+        raise CouldNotSolveError('solve_with_strategy: empty plan')
+
+    cancel_event = threading.Event()
+    wcs = None
+    if parallel:
+        # not a context manager: it would wait for API calls we cannot interrupt.
+        pool = ThreadPoolExecutor(max_workers=len(attempts))
+        pending = {pool.submit(_run_attempt, fits_file_path, sources, attempt, arguments,
+                               api_client, cancel_event, header, solver_profile, metrics): attempt
+                   for attempt, arguments in attempts}
+        while pending and wcs is None:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempt = pending.pop(future)
+                try:
+                    wcs = future.result()
+                    logger.info(f"solve_with_strategy: attempt '{attempt.name}' solved {fits_file_path}")
+                    break
+                except Exception as e:
+                    logger.info(f"solve_with_strategy: attempt '{attempt.name}' failed ({e})")
+        # stop the others.
+        cancel_event.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+    else:
+        for attempt, arguments in attempts:
+            try:
+                wcs = _run_attempt(fits_file_path, sources, attempt, arguments, api_client, cancel_event, header,
+                                   solver_profile, metrics)
+                logger.info(f"solve_with_strategy: attempt '{attempt.name}' solved {fits_file_path}")
+                break
+            except Exception as e:
+                logger.info(f"solve_with_strategy: attempt '{attempt.name}' failed ({e})")
+
+    if wcs is None:
+        raise CouldNotSolveError(f"solve_with_strategy: all {len(attempts)} attempts failed on {fits_file_path}")
+
+    if write_to_file:
+        write_wcs_to_fits(fits_file_path, wcs)
+        if solution_index is not None:
+            solution_index.record(fits_file_path, wcs, header=header, solve_time=time.time() - start_time)
+    return wcs
+
+
+def _attempt_arguments(attempt, ra_approx, dec_approx, scale_min, scale_max):
+    """
+    Hints given to the backend for this attempt.
+    """
+    arguments = {'use_n_brightest_only': attempt.use_n_brightest_only}
+    if attempt.use_position and ra_approx is not None and dec_approx is not None:
+        arguments.update(ra_approx=ra_approx, dec_approx=dec_approx, search_radius=attempt.search_radius)
+    if attempt.scale_widen is not None and scale_min is not None and scale_max is not None:
+        arguments.update(scale_min=scale_min / attempt.scale_widen, scale_max=scale_max * attempt.scale_widen)
+    return arguments
+
+
+def _run_attempt(fits_file_path, sources, attempt, arguments, api_client, cancel_event, header, solver_profile,
+                 metrics=None):
+    if cancel_event.is_set():
+        raise CouldNotSolveError('cancelled')
+    count(metrics, 'attempts')
+    logger.info(f"solve_with_strategy: attempt '{attempt.name}' on {fits_file_path}")
+
+    if attempt.backend == 'local':
+        return plate_solve_locally(fits_file_path, sources, odds_to_solve=attempt.odds_to_solve,
+                                   timeout=attempt.timeout, cancel_event=cancel_event, write_to_file=False,
+                                   header=header, profile=solver_profile, metrics=metrics, **arguments)
+    if attempt.backend != 'api':
+        raise ValueError(f"solve_with_strategy: unknown backend '{attempt.backend}'")
+    if api_client is None:
+        from .api_solver import plate_solve_with_API
+        return plate_solve_with_API(fits_file_path, sources, timeout=attempt.timeout, write_to_file=False,
+                                    header=header, metrics=metrics, **arguments)
+
+    future = api_client.submit(fits_file_path, sources, write_to_file=False, header=header, metrics=metrics,
+                               **arguments)
+    deadline = None if attempt.timeout is None else time.time() + attempt.timeout
+    while True:
+        try:
+            return future.result(timeout=0.1)
+        except FutureTimeoutError:
+            pass
+        if cancel_event.is_set() or (deadline is not None and time.time() > deadline):
+            future.cancel()
+            raise CouldNotSolveError('cancelled' if cancel_event.is_set() else f"timed out after {attempt.timeout} s")
@@ -0,0 +1,179 @@
+import logging
+
+import numpy as np
+from astropy.wcs import WCS
+from scipy.spatial import cKDTree
+
+from .exceptions import CouldNotSolveError
+from .sources import as_source_list
+
+logger = logging.getLogger(__name__)
+
+
+def _brightest_positions(sources, n_stars):
+    """
+    (n, 2) array of the x, y positions of the n_stars brightest sources.
+    """
+    return np.column_stack(as_source_list(sources).positions(n_stars)).astype(float)
+
+
+def fit_similarity(reference, current):
+    """
+    Least-squares similarity transform (scale, rotation, translation) such that
+    current ≈ scale * rotation @ reference + translation (Umeyama's method).
+
+    Parameters:
+    reference (numpy array (n, 2)): matched positions in the reference frame.
+    current (numpy array (n, 2)): the same stars in the current frame.
+
+    Returns:
+    scale (float), rotation (2x2 numpy array), translation (numpy array (2,))
+    """
+    ref_mean, cur_mean = reference.mean(axis=0), current.mean(axis=0)
+    ref_c, cur_c = reference - ref_mean, current - cur_mean
+    covariance = cur_c.T @ ref_c / len(reference)
+    u, singular_values, vt = np.linalg.svd(covariance)
+    # no mirroring between two frames of the same camera.
+    d = np.diag([1., np.sign(np.linalg.det(u @ vt))])
+    rotation = u @ d @ vt
+    scale = np.trace(np.diag(singular_values) @ d) / np.mean(np.sum(ref_c**2, axis=1))
+    translation = cur_mean - scale * rotation @ ref_mean
+    return scale, rotation, translation
+
+
+class SequenceTracker:
+    """
+    Follows the pointing along a time series of frames by matching the stars of each frame to the previous one,
+    instead of blind solving every frame.
+
+    The tracker keeps the last good WCS and the positions of its stars. For a new frame, the stars are
+    cross-matched with a KD-tree (after estimating the bulk shift from the histogram of pairwise offsets),
+    and the small shift, rotation and scale change is fitted. The previous WCS moved by this transformation is
+    the new WCS. If too few stars match or the residuals are too large, track raises CouldNotSolveError and
+    the caller should fall back to a full solve (see the tracker argument of plate_solve).
+
+    Note: SIP distortion terms, if any, are carried over unchanged, fine as long as the frames only drift a bit.
+    """
+
+    def __init__(self, n_stars=100, max_shift=100., match_radius=3., min_matches=10, max_residual=1.):
+        """
+        Parameters:
+        n_stars (int): number of brightest sources used for matching.
+        max_shift (float): largest shift in pixels between two consecutive frames.
+        match_radius (float): pixels, distance under which two stars are matched once the shift is corrected.
+        min_matches (int): minimum number of matched stars to accept the tracked solution.
+        max_residual (float): pixels, maximum rms of the matched stars around the fitted transformation.
+        """
+        self.n_stars = n_stars
+        self.max_shift = max_shift
+        self.match_radius = match_radius
+        self.min_matches = min_matches
+        self.max_residual = max_residual
+
+        self.wcs = None
+        self.positions = None
+
+    @property
+    def has_reference(self):
+        return self.wcs is not None
+
+    def reset(self):
+        self.wcs = None
+        self.positions = None
+
+    def update(self, wcs_header, sources):
+        """
+        Make this frame the reference for the next one.
+
+        Parameters:
+        wcs_header (astropy.io.fits.Header): the WCS solution of the frame.
+        sources (SourceList or astropy.table.Table): detected sources in the frame.
+        """
+        self.wcs = WCS(wcs_header)
+        self.positions = _brightest_positions(sources, self.n_stars)
+
+    def _estimate_shift(self, tree, current):
+        # all pairs closer than max_shift vote for their offset, the bulk shift is the most voted one.
+        neighbours = tree.query_ball_point(current, r=self.max_shift)
+        counts = np.array([len(n) for n in neighbours])
+        if counts.sum() == 0:
+            return None
+        ref_indices = np.concatenate([np.asarray(n, dtype=int) for n in neighbours])
+        offsets = np.repeat(current, counts, axis=0) - self.positions[ref_indices]
+        n_bins = max(int(2 * self.max_shift / self.match_radius), 1)
+        histogram, xedges, yedges = np.histogram2d(offsets[:, 0], offsets[:, 1], bins=n_bins,
+                                                   range=[[-self.max_shift, self.max_shift]] * 2)
+        ix, iy = np.unravel_index(np.argmax(histogram), histogram.shape)
+        # refine with the mean of the offsets falling in the winning bin.
+        in_bin = ((offsets[:, 0] >= xedges[ix]) & (offsets[:, 0] <= xedges[ix + 1]) &
+                  (offsets[:, 1] >= yedges[iy]) & (offsets[:, 1] <= yedges[iy + 1]))
+        return offsets[in_bin].mean(axis=0)
+
+    def _match(self, tree, current, scale, rotation, translation):
+        # bring the current stars back into the reference frame, and look for their nearest neighbour.
+        back = ((current - translation) @ rotation) / scale
+        distances, indices = tree.query(back, distance_upper_bound=self.match_radius)
+        matched = np.isfinite(distances)
+        return indices[matched], matched
+
+    def track(self, sources):
+        """
+        Compute the WCS of a new frame from the reference one.
+
+        Parameters:
+        sources (SourceList or astropy.table.Table): detected sources in the new frame.
+
+        Returns:
+        WCS header of the new frame. Raises CouldNotSolveError if the match is not good enough.
+        """
+        if not self.has_reference:
+            raise CouldNotSolveError('SequenceTracker: no reference frame yet.')
+
+        current = _brightest_positions(sources, self.n_stars)
+        if len(current) < self.min_matches or len(self.positions) < self.min_matches:
+            raise CouldNotSolveError('SequenceTracker: not enough stars to track.')
+
+        tree = cKDTree(self.positions)
+        shift = self._estimate_shift(tree, current)
+        if shift is None:
+            raise CouldNotSolveError('SequenceTracker: no star within max_shift of the previous frame.')
+
+        scale, rotation, translation = 1., np.eye(2), shift
+        for _ in range(3):
+            ref_indices, matched = self._match(tree, current, scale, rotation, translation)
+            if matched.sum() < self.min_matches:
+                raise CouldNotSolveError(f'SequenceTracker: only {matched.sum()} stars matched.')
+            reference, cur = self.positions[ref_indices], current[matched]
+            scale, rotation, translation = fit_similarity(reference, cur)
+            residuals = np.linalg.norm(cur - (scale * reference @ rotation.T + translation), axis=1)
+            # drop the odd mismatch and fit again.
+            keep = residuals <= max(3 * np.median(residuals), 0.1)
+            if keep.sum() >= self.min_matches and not keep.all():
+                scale, rotation, translation = fit_similarity(reference[keep], cur[keep])
+                residuals = np.linalg.norm(cur[keep] - (scale * reference[keep] @ rotation.T + translation),
+                                           axis=1)
+
+        rms = np.sqrt(np.mean(residuals**2))
+        n_matched = len(residuals)
+        if n_matched < self.min_matches or rms > self.max_residual:
+            raise CouldNotSolveError(f'SequenceTracker: poor match ({n_matched} stars, rms {rms:.2f} px).')
+        logger.info(f"SequenceTracker: tracked with {n_matched} stars, rms {rms:.3f} px, "
+                    f"shift ({translation[0]:.1f}, {translation[1]:.1f}) px, "
+                    f"rotation {np.degrees(np.arctan2(rotation[1, 0], rotation[0, 0])):.3f} deg, scale {scale:.5f}")
+
+        return self._moved_wcs(scale, rotation, translation).to_header(relax=True)
+
+    def _moved_wcs(self, scale, rotation, translation):
+        # with p_current = scale * R p_reference + t, the pixel-to-world transformation of the current frame is
+        # the reference one evaluated at R^T (p_current - t) / scale.
+        wcs = self.wcs.deepcopy()
+        crpix0 = wcs.wcs.crpix - 1  # 0-based pixels, like our sources
+        wcs.wcs.crpix = scale * rotation @ crpix0 + translation + 1
+        matrix = wcs.pixel_scale_matrix @ rotation.T / scale
+        if wcs.wcs.has_cd():
+            wcs.wcs.cd = matrix
+        else:
+            wcs.wcs.pc = matrix
+            wcs.wcs.cdelt = [1., 1.]
+        wcs.wcs.set()
+        return wcs
@@ -0,0 +1,397 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import json
+import logging
+import os
+import queue
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+# from <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_event_header = struct.Struct('iIII')
+
+_fits_block_size = 2880
+
+default_patterns = ('*.fits', '*.fit', '*.fts', '*.FITS', '*.FIT', '*.FTS')
+
+
+def _load_inotify():
+    """
+    The libc with inotify (Linux), None elsewhere.
+    """
+    library = ctypes.util.find_library('c')
+    if library is None:
+        return None
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FolderWatcher:
+    """
+    Reports the files appearing in some directories once they are fully written.
+
+    On Linux the kernel tells us (inotify) when a file was closed after writing or moved into a directory, elsewhere
+    (or with use_inotify=False, e.g. for network filesystems where inotify does not see the other machines' writes)
+    the directories are listed every poll_interval seconds.
+    Either way, a file is reported once its size and modification time have not changed for settle_time seconds
+    and its size is a whole number of FITS blocks, so that we never read a frame the camera is still writing.
+
+        watcher = FolderWatcher(['/data/night'])
+        while True:
+            for path in watcher.poll(timeout=1.):
+                ...
+
+    Files already there when the watcher starts are reported too (once settled), unless skip(path, stat) says so.
+    """
+
+    def __init__(self, directories, patterns=default_patterns, settle_time=2., poll_interval=5., use_inotify=True,
+                 skip=None):
+        """
+        Parameters:
+        directories (list of Path or str): directories to watch (not their subdirectories).
+        patterns (tuple of str): glob patterns of the file names to report.
+        settle_time (float): seconds a file must stay unchanged before being reported.
+        poll_interval (float): seconds between two listings of the directories when not using inotify.
+        use_inotify (bool): use inotify if available. If False, always poll.
+        skip (callable): skip(path, os.stat_result) -> bool, files to ignore (e.g. already processed).
+        """
+        self.directories = [Path(directory) for directory in directories]
+        for directory in self.directories:
+            if not directory.is_dir():
+                raise NotADirectoryError(f"FolderWatcher: {directory} is not a directory")
+        self.patterns = patterns
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.skip = skip
+
+        # path -> (size, mtime_ns, time since when they did not change)
+        self._candidates = {}
+        # files already reported, with the stat they had then.
+        self._reported = {}
+        self._last_scan = None
+        self._inotify_fd = None
+        self._watch_descriptors = {}
+        if use_inotify:
+            self._start_inotify()
+        if self._inotify_fd is None:
+            logger.info(f"FolderWatcher: polling {', '.join(map(str, self.directories))} every {poll_interval} s")
+        self._scan()
+
+    def _start_inotify(self):
+        libc = _load_inotify()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            logger.warning(f"FolderWatcher: inotify unavailable ({os.strerror(ctypes.get_errno())}), polling instead")
+            return
+        for directory in self.directories:
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), _IN_CLOSE_WRITE | _IN_MOVED_TO)
+            if wd < 0:
+                logger.warning(f"FolderWatcher: cannot watch {directory} with inotify "
+                               f"({os.strerror(ctypes.get_errno())}), polling instead")
+                os.close(fd)
+                self._watch_descriptors = {}
+                return
+            self._watch_descriptors[wd] = directory
+        self._inotify_fd = fd
+        logger.info(f"FolderWatcher: watching {', '.join(map(str, self.directories))} with inotify")
+
+    @property
+    def uses_inotify(self):
+        return self._inotify_fd is not None
+
+    def close(self):
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _matches(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns)
+
+    def _consider(self, path, now):
+        """
+        Start (or keep) following a file until it settles.
+        """
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self._candidates.pop(path, None)
+            return
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if self._reported.get(path) == signature:
+            return
+        if self.skip is not None and self.skip(path, stat):
+            self._candidates.pop(path, None)
+            self._reported[path] = signature
+            return
+        previous = self._candidates.get(path)
+        if previous is None or previous[:2] != signature:
+            self._candidates[path] = signature + (now,)
+
+    def _scan(self):
+        now = time.monotonic()
+        for directory in self.directories:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and self._matches(entry.name):
+                        self._consider(Path(entry.path), now)
+        self._last_scan = now
+
+    def _read_events(self, timeout):
+        readable, _, _ = select.select([self._inotify_fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            buffer = os.read(self._inotify_fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        now = time.monotonic()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _event_header.unpack_from(buffer, offset)
+            name = buffer[offset + _event_header.size:offset + _event_header.size + length].rstrip(b'\0')
+            offset += _event_header.size + length
+            if mask & _IN_Q_OVERFLOW:
+                # the kernel dropped events, we do not know what changed.
+                logger.warning('FolderWatcher: inotify queue overflow, rescanning')
+                self._scan()
+            elif mask & _IN_IGNORED:
+                logger.warning(f"FolderWatcher: {self._watch_descriptors.get(wd)} is not watched anymore")
+            elif wd in self._watch_descriptors and name:
+                name = os.fsdecode(name)
+                if self._matches(name):
+                    self._consider(self._watch_descriptors[wd] / name, now)
+
+    def poll(self, timeout=1.):
+        """
+        Wait up to timeout seconds for changes.
+
+        Returns:
+        list of Path, the files that settled since the last call.
+        """
+        if self._inotify_fd is not None:
+            # when files are pending, come back in time to check whether they settled.
+            self._read_events(min(timeout, self.settle_time / 2) if self._candidates else timeout)
+        else:
+            wait = self.poll_interval - (time.monotonic() - self._last_scan)
+            if self._candidates:
+                wait = min(wait, self.settle_time / 2)
+            time.sleep(max(0., min(wait, timeout)))
+            if time.monotonic() - self._last_scan >= self.poll_interval:
+                self._scan()
+
+        now = time.monotonic()
+        settled = []
+        for path, (size, mtime_ns, since) in list(self._candidates.items()):
+            # inotify does not report every write, check again.
+            self._consider(path, now)
+            if self._candidates.get(path) != (size, mtime_ns, since) or now - since < self.settle_time:
+                continue
+            if size == 0 or size % _fits_block_size != 0:
+                # not a whole FITS file, the camera must be slow: keep waiting.
+                continue
+            del self._candidates[path]
+            self._reported[path] = (size, mtime_ns)
+            settled.append(path)
+        return sorted(settled)
+
+
+class ProgressJournal:
+    """
+    What the watch daemon already did, kept in a JSON lines file so that a restarted daemon does not open again
+    every frame of the night: a file is skipped if it was processed with the same size and modification time.
+    Thread-safe.
+    """
+
+    def __init__(self, journal_path):
+        """
+        Parameters:
+        journal_path (Path or str): the file, created if needed.
+        """
+        self.journal_path = Path(journal_path)
+        self._entries = {}
+        self._lock = threading.Lock()
+        n_lines = 0
+        if self.journal_path.exists():
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line, if we were killed while writing it.
+                        continue
+                    self._entries[entry['path']] = entry
+                    n_lines += 1
+        if n_lines > 2 * len(self._entries) + 100:
+            self._compact()
+        logger.info(f"ProgressJournal: {len(self._entries)} files already processed in {self.journal_path}")
+
+    def _compact(self):
+        temporary_path = self.journal_path.with_suffix('.tmp')
+        with open(temporary_path, 'w') as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(temporary_path, self.journal_path)
+
+    def get(self, path):
+        with self._lock:
+            return self._entries.get(str(Path(path).absolute()))
+
+    def is_done(self, path, stat, retry_failed=False):
+        """
+        Whether the file was processed in this state (same size and modification time).
+        """
+        entry = self.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            return False
+        return entry['status'] == 'solved' or not retry_failed
+
+    def record(self, path, stat, status, error=None):
+        """
+        Parameters:
+        path (Path or str): the file.
+        stat (os.stat_result): its stat when it was processed.
+        status (str): 'solved' or 'failed'.
+        error (Exception): why it failed.
+        """
+        entry = {'path': str(Path(path).absolute()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                 'status': status, 'error': None if error is None else str(error), 'time': time.time()}
+        with self._lock:
+            self._entries[entry['path']] = entry
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+def watch_and_solve(directories, n_workers=2, queue_size=None, journal_path=None, retry_failed=False,
+                    settle_time=2., poll_interval=5., use_inotify=True, patterns=default_patterns,
+                    stop_event=None, metrics_callback=None, **plate_solve_kwargs):
+    """
+    Solve the frames landing in some directories, as they land, until stop_event is set (or forever).
+
+    A FolderWatcher reports each frame once written, it is queued, and n_workers threads solve the queued frames
+    with plate_solve (which skips those already flagged PL-SLVED). When the queue is full, new frames wait to be
+    queued: the solvers are never overwhelmed, however many frames arrive at once.
+    Each frame processed is recorded in a ProgressJournal, so that after a restart only new or modified frames
+    are looked at. Frames that failed are not retried unless modified, or with retry_failed.
+
+        watch_and_solve(['/data/night'], n_workers=4, use_api=False, solution_index=SolutionIndex('solves.sqlite'))
+
+    Parameters:
+    directories (list of Path or str): directories to watch.
+    n_workers (int): number of frames solved at the same time.
+    queue_size (int): maximum number of frames waiting for a worker. Default: 2 * n_workers.
+    journal_path (Path or str): progress file. Default: .plate_solve_progress.jsonl in the first directory.
+    retry_failed (bool): on restart, try again the frames that failed before.
+    settle_time (float): seconds a file must stay unchanged before being solved.
+    poll_interval (float): seconds between two listings of the directories without inotify.
+    use_inotify (bool): use inotify if available, else poll.
+    patterns (tuple of str): glob patterns of the file names to solve.
+    stop_event (threading.Event): set it to stop: the frames being solved are finished, the queued ones are left
+                                  for the next start.
+    metrics_callback (callable): if provided, each frame's solve is measured (see SolveMetrics) and passed to
+                                 this callback, e.g. a MetricsRecorder.
+    plate_solve_kwargs: passed to plate_solve for each frame (use_api, scale_min, ...)
+
+    Returns:
+    dict of counts: 'solved', 'failed'.
+    """
+    # imported here as the package's __init__ imports us.
+    from . import plate_solve
+    from .metrics import SolveMetrics
+
+    directories = [Path(directory) for directory in directories]
+    if queue_size is None:
+        queue_size = 2 * n_workers
+    if journal_path is None:
+        journal_path = directories[0] / '.plate_solve_progress.jsonl'
+    if stop_event is None:
+        stop_event = threading.Event()
+    journal = ProgressJournal(journal_path)
+    frames = queue.Queue(maxsize=queue_size)
+    counts = {'solved': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = frames.get()
+            if item is None:
+                return
+            path, stat = item
+            try:
+                metrics = None if metrics_callback is None else SolveMetrics(path, callback=metrics_callback)
+                plate_solve(path, metrics=metrics, **plate_solve_kwargs)
+                status, error = 'solved', None
+                logger.info(f"watch_and_solve: {path} solved")
+            except Exception as e:
+                status, error = 'failed', e
+                logger.info(f"watch_and_solve: failed on {path} ({e})")
+            try:
+                # as left by the solve (which wrote the WCS into it): the watcher sees that write, it must be
+                # recognized as done.
+                stat = path.stat()
+            except FileNotFoundError:
+                pass
+            journal.record(path, stat, status, error)
+            with counts_lock:
+                counts[status] += 1
+
+    workers = [threading.Thread(target=worker, name=f"watch_and_solve-{i}", daemon=True) for i in range(n_workers)]
+    for thread in workers:
+        thread.start()
+
+    skip = lambda path, stat: journal.is_done(path, stat, retry_failed)  # noqa: E731
+    with FolderWatcher(directories, patterns=patterns, settle_time=settle_time, poll_interval=poll_interval,
+                       use_inotify=use_inotify, skip=skip) as watcher:
+        pending = []
+        while not stop_event.is_set():
+            pending += watcher.poll(timeout=1.)
+            while pending and not stop_event.is_set():
+                path = pending[0]
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    pending.pop(0)
+                    continue
+                try:
+                    # not forever, to notice stop_event. (meanwhile the kernel or the next scan keeps the new files)
+                    frames.put((path, stat), timeout=1.)
+                except queue.Full:
+                    continue
+                pending.pop(0)
+
+    logger.info('watch_and_solve: stopping, finishing the frames being solved')
+    # leave the queued frames for next time.
+    while True:
+        try:
+            frames.get_nowait()
+        except queue.Empty:
+            break
+    for _ in workers:
+        frames.put(None)
+    for thread in workers:
+        thread.join()
+    return counts